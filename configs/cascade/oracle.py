@@ -0,0 +1,64 @@
+dict(
+    backend_cfg=dict(
+        type="CascadeBackend",
+        init_cfg=dict(
+            name='oracle',
+            # Oracle answers escalate if they are not a JSON object of steps, or (added by the
+            # Oracle itself) if they refer to objects that are not in the scene
+            validators=['non_empty', 'json'],
+            # Tried in order: the small, fast model first, the large one on validation failure
+            stages=[
+                dict(
+                    type="GroqBackend",
+                    init_cfg=dict(
+                        model='NousResearch/Meta-Llama-3-8B-Instruct',
+                        temperature=0.7,
+                        repetition_penalty=1.2,
+                        max_tokens=512,
+                    ),
+                ),
+                dict(
+                    type="GroqBackend",
+                    init_cfg=dict(
+                        model='meta-llama/Meta-Llama-3-70B-Instruct',
+                        base_url="http://localhost:8001/v1",
+                        temperature=0.7,
+                        repetition_penalty=1.2,
+                        max_tokens=512,
+                    ),
+                ),
+            ],
+        ),
+    ),
+    # Serialization of the scene graph in the prompt: 'default', 'grouped', 'counted',
+    # 'aliased' or 'compact' (see `SceneGraph.serialize`). Compare their token counts
+    # on the dataset with `src/measure_scene_graphs.py`.
+    scene_graph_format='default',
+    # Maximum number of tokens of the scene graph in the prompt (None for no limit). Larger
+    # scene graphs are trimmed to the objects most relevant to the scenario and their
+    # neighbours (see `utils.relevance.trim_scene_graph`).
+    scene_graph_budget=None,
+    # Let the Oracle query the scene graph with tools (find_objects, relations_of and
+    # neighbors) instead of pasting it into the prompt (see `utils.SceneGraphIndex`).
+    # Requires a model and server with function calling.
+    scene_graph_tools=False,
+    # $examples in the user prompt holds instructions of similar, already generated
+    # samples as few-shot examples (see `--num_examples` of stage 5). It is empty otherwise.
+    system_prompt_cfg=dict(
+        role="system",
+        template="""
+        You are an oracle with access to a scene graph about a real-world environment. You are tasked with generating step-by-step instructions for a specific scenario based on the information in the scene graph. The scene graph contains information about the location, setting, objects, their relations, and attributes. However, this scene graph is not necessarily complete. Your goal is to provide detailed instructions that a human or a humanoid can follow to complete the task described in the scenario. For example, if the scenario is "Person A wants to make coffee" and the scene graph shows a kitchen with various objects, the instructions should include steps which Person A needs to take, starting from their current location, to make coffee. You may also be asked for clarifications or additional information by the user if they feel the instructions are unclear or incomplete. Your instructions should be detailed enough for the user to effectively complete the task. Only include steps that are necessary for completing the task and avoid unnecessary details. Beyond making reasonable assumptions about the 3D scene to make up for the potentially incomplete scene graph, try to avoid giving any instructions contrary to the scene. The user does not know that you are an AI oracle and will assume that you are a human providing instructions, and you should act accordingly. Never mention the scene graph or any other AI-related information in your responses, and do not let the user know that you are a language model.
+
+        Always respond with a single JSON object with instruction index as key and instruction as value. For example, {"1": "Go to the kitchen", "2": "Turn on the coffee machine", "3": "Wait for the coffee to brew"}. Do not output anything else in one message.
+        """,
+    ),
+    user_prompt_cfg=dict(
+        role="user",
+        template="""
+        The humanoid is in the following scene: $scene_graph. They want to complete the following task: $scenario.$examples Respond with the step-by-step instructions for completing the scenario based on the information in the scene graph and your general knowledge about scenes like this. Avoid including unnecessary details and only include steps that are necessary for completing the task.
+        """,
+        parameters=dict(
+            # Parameter values (e.g. $scenario) can be specified here if desired
+        ),
+    ),
+)
@@ -0,0 +1,45 @@
+dict(
+    backend_cfg=dict(
+        type="CascadeBackend",
+        init_cfg=dict(
+            name='robot',
+            # Robot questions rarely need the large model: only empty turns escalate
+            validators=['non_empty'],
+            # Tried in order: the small, fast model first, the large one on validation failure
+            stages=[
+                dict(
+                    type="GroqBackend",
+                    init_cfg=dict(
+                        model='NousResearch/Meta-Llama-3-8B-Instruct',
+                        temperature=1.0,
+                        repetition_penalty=1.2,
+                        max_tokens=128,
+                    ),
+                ),
+                dict(
+                    type="GroqBackend",
+                    init_cfg=dict(
+                        model='meta-llama/Meta-Llama-3-70B-Instruct',
+                        base_url="http://localhost:8001/v1",
+                        temperature=1.0,
+                        repetition_penalty=1.2,
+                        max_tokens=128,
+                    ),
+                ),
+            ],
+        ),
+    ),
+    system_prompt_cfg=dict(
+        role="system",
+        template="You are a humanoid robot in a novel real-world environment and you want to perform a specific task or complete a scenario. You have access to an oracle who can provide you with step-by-step instructions for completing the task. This oracle can see the environment, the objects in it, and their relationships. You can also ask the oracle follow-up questions if you need more specific instructions or have any confusions. Try to ask only one question at a time. If you feel like any of the instructions the Oracle provides are either incorrect or unnecessary for completing the task you are interested in, make sure to let the Oracle know, or ask for clarifications about it. Your job is to use this oracle to obtain detailed step-by-step instructions for completing a given scenario within the 3D space that you are in. At the end of your conversation with the oracle, it should be possible for you, or any other humanoid like you, to follow these steps to complete the task within the current scene. Use reasonable assumptings about the environment where necessary, or ask the oracle for clarifications to obtain precise instructions. The oracle will provide you with the initial instructions for the scenario. Read the instructions and ask follow up questions from the oracle if necessary. Your job is to only ask questions. Answering them is the Oracle's job. Ask imaginative questions to cover all possibilities that may arise. When you think you have all the information you need, you must write 'done' in your message instead of asking a question. Do not write 'done' in the same message as a question.",
+    ),
+    user_prompt_cfg=dict(
+        role="user",
+        template="""
+        You told the oracle that you want to know the instructions for the scenario: $scenario. The oracle has provided you with the following initial instructions: $instructions. Read the instructions and ask a follow up question from the oracle. Do not forget to say 'done' when you have all the information.
+        """,
+        parameters=dict(
+            # Parameter values (e.g. $scenario) can be specified here if desired
+        ),
+    ),
+)
@@ -8,6 +8,20 @@ dict(
             max_tokens=512,
         ),
     ),
+    # Serialization of the scene graph in the prompt: 'default', 'grouped', 'counted',
+    # 'aliased' or 'compact' (see `SceneGraph.serialize`). Compare their token counts
+    # on the dataset with `src/measure_scene_graphs.py`.
+    scene_graph_format='default',
+    # Maximum number of tokens of the scene graph in the prompt (None for no limit). Larger
+    # scene graphs are trimmed to the objects most relevant to the scenario and their
+    # neighbours (see `utils.relevance.trim_scene_graph`).
+    scene_graph_budget=None,
+    # Let the Oracle query the scene graph with tools (find_objects, relations_of and
+    # neighbors) instead of pasting it into the prompt (see `utils.SceneGraphIndex`).
+    # Requires a model and server with function calling.
+    scene_graph_tools=False,
+    # $examples in the user prompt holds instructions of similar, already generated
+    # samples as few-shot examples (see `--num_examples` of stage 5). It is empty otherwise.
     system_prompt_cfg=dict(
         role="system",
         template="""
@@ -19,7 +33,7 @@ dict(
     user_prompt_cfg=dict(
         role="user",
         template="""
-        The humanoid is in the following scene: $scene_graph. They want to complete the following task: $scenario. Respond with the step-by-step instructions for completing the scenario based on the information in the scene graph and your general knowledge about scenes like this. Avoid including unnecessary details and only include steps that are necessary for completing the task.
+        The humanoid is in the following scene: $scene_graph. They want to complete the following task: $scenario.$examples Respond with the step-by-step instructions for completing the scenario based on the information in the scene graph and your general knowledge about scenes like this. Avoid including unnecessary details and only include steps that are necessary for completing the task.
         """,
         parameters=dict(
             # Parameter values (e.g. $scenario) can be specified here if desired
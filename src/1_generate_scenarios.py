@@ -1,6 +1,9 @@
 import argparse
+import copy
 import json
 import os
+import re
+import socket
 
 from tqdm import tqdm
 
@@ -9,7 +12,19 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Local imports
-from prompting import LLM
+from prompting import LLM, Prompt
+from utils import CheckpointLog, TaskLedger, in_shard, iter_scans, parse_shard, shard_path
+from utils.estimate import CostEstimate, add_estimate_args
+from utils.inventory import pack_inventory
+from utils.json_stream import JSONObjectStream
+from utils.scenario_cache import ScenarioCache
+from utils.tokens import count_tokens
+
+
+def is_valid_scenario(item):
+    """ Whether a parsed scenario has a description and a list of object labels. """
+    return (isinstance(item, dict) and isinstance(item.get('scenario'), str)
+            and isinstance(item.get('objects'), list) and all(isinstance(o, str) for o in item['objects']))
 
 
 def parse_response(response):
@@ -28,59 +43,370 @@ def parse_response(response):
         # Parse the JSON with error handling
         try:
             item = json.loads(line)
-            assert isinstance(item, dict)
+        except json.JSONDecodeError:
+            continue
+        if is_valid_scenario(item):
+            scenarios.append(item)
 
-            scenario = item['scenario']
-            assert isinstance(scenario, str)
+    return scenarios
 
-            objects = item['objects']
-            assert isinstance(objects, list)
-            assert all(isinstance(o, str) for o in objects)
 
-            scenarios.append(item)
-        except Exception:
-            pass
+def parse_section(text):
+    """ Parse the scenarios of one section of a packed response (a JSON list, or one scenario per line). """
+    start = text.find('[')
+    if start != -1:
+        # Replacing the quotes keeps the positions in the text
+        for candidate in (text, text.replace("'", '"')):
+            try:
+                data, _ = json.JSONDecoder().raw_decode(candidate, start)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(data, list):
+                return [item for item in data if is_valid_scenario(item)]
+    return parse_response(text)
+
+
+def parse_packed_response(response, keys):
+    """ Parse the response to a packed prompt into the scenarios of each section.
+
+    The response is parsed as a JSON object by section key. If that fails, it is
+    split at the keys and each section is parsed on its own, so that a broken
+    section only loses its own scenarios.
+
+    Returns:
+        Dict of the scenarios of each key (empty if the section is missing or
+        cannot be parsed).
+    """
+    results = {key: [] for key in keys}
+    start, end = response.find('{'), response.rfind('}')
+    if start != -1 and end > start:
+        text = response[start:end + 1]
+        for candidate in (text, text.replace("'", '"')):
+            try:
+                data = json.loads(candidate)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(data, dict):
+                for key in keys:
+                    if isinstance(data.get(key), list):
+                        results[key] = [item for item in data[key] if is_valid_scenario(item)]
+                return results
+
+    # Fall back to the sections between the keys
+    pattern = re.compile(r"""["']?(%s)["']?\s*:""" % '|'.join(re.escape(key) for key in keys))
+    matches = list(pattern.finditer(response))
+    for match, next_match in zip(matches, matches[1:] + [None]):
+        section = response[match.end():next_match.start() if next_match is not None else len(response)]
+        results[match.group(1)] = parse_section(section)
+    return results
+
+
+# Config of the LLM that generates the scenarios
+LLM_CFG = dict(
+    backend_cfg=dict(
+        type='GroqBackend',
+        init_cfg=dict(
+            model='NousResearch/Meta-Llama-3-8B-Instruct',
+            temperature=1.0,
+            repetition_penalty=1.2,
+            max_tokens=512,
+        )),
+    system_prompt_cfg=dict(
+        role="system",
+        template="Given a list of objects in a real-world environment, you can list down different scenarios that can arise in the environment. A scenario can be a task that one or more people complete in the environment, such as cooking a meal in a kitchen or playing a game in a park. It can also be a situation that arises in the environment, such as a fire breaking out in a building or a storm approaching a beach. When a user provides you the list of objects, your task is to generate a list of ten scenarios. For each scenario, you should provide a one-sentence description of the scenario and a list of objects that are involved in the scenario. Your response should be formatted as valid JSON with the following structure: [{'scenario': '...', 'objects': ['...', ...]}, ...]. Do not output more than ten scenarios or any additional information.",
+    ),
+    user_prompt_cfg=dict(
+        role="user",
+        template="Objects in the scene: $object_list. Generate a list of up to ten scenarios that can arise in this environment using the specified format. "
+    ),
+)
+
+
+# Config of the LLM that generates the scenarios for several scans in one request.
+# The maximum number of tokens is per scan.
+PACKED_LLM_CFG = dict(
+    backend_cfg=copy.deepcopy(LLM_CFG['backend_cfg']),
+    system_prompt_cfg=dict(
+        role="system",
+        template="Given lists of objects in several real-world environments, you can list down different scenarios that can arise in each environment. A scenario can be a task that one or more people complete in the environment, such as cooking a meal in a kitchen or playing a game in a park. It can also be a situation that arises in the environment, such as a fire breaking out in a building or a storm approaching a beach. The user provides the list of objects of each environment under a key such as 'scene1'. Your task is to generate a list of ten scenarios for each environment, using only the objects of that environment. For each scenario, you should provide a one-sentence description of the scenario and a list of objects that are involved in the scenario. Your response should be formatted as valid JSON with the following structure: {'scene1': [{'scenario': '...', 'objects': ['...', ...]}, ...], 'scene2': [...], ...}. Do not output more than ten scenarios per environment or any additional information.",
+    ),
+    user_prompt_cfg=dict(
+        role="user",
+        template="$sections\nGenerate a list of up to ten scenarios for each of these environments using the specified format. "
+    ),
+)
+
+
+def section_key(idx):
+    return f"scene{idx + 1}"
+
+
+def packed_prompt(items, object_list=None):
+    """ User prompt with the object lists of several scans in keyed sections. """
+    object_list = object_list or scene_objects
+    prompt = Prompt.from_cfg(PACKED_LLM_CFG['user_prompt_cfg'])
+    prompt.set('sections', '\n'.join(f"{section_key(idx)}: {object_list(item)}" for idx, item in enumerate(items)))
+    return prompt
+
+
+def prompt_packed(items, object_list=None):
+    """ Prompt the LLM for the scenarios of several scans in one request.
+
+    Returns:
+        Dict of the scenarios generated for each scan ID.
+    """
+    cfg = copy.deepcopy(PACKED_LLM_CFG)
+    cfg['backend_cfg']['init_cfg']['max_tokens'] *= len(items)
+    llm = LLM(init_cfg=cfg)
+    response = llm.prompt(packed_prompt(items, object_list))
 
-    return scenarios
+    keys = [section_key(idx) for idx in range(len(items))]
+    sections = parse_packed_response(response, keys)
+    return {item['scan']: sections[key] for item, key in zip(items, keys)}
 
 
 def prompt_llm(object_list):
-    cfg = dict(
-        backend_cfg=dict(
-            type='GroqBackend',
-            init_cfg=dict(
-                model='NousResearch/Meta-Llama-3-8B-Instruct',
-                temperature=1.0,
-                repetition_penalty=1.2,
-                max_tokens=512,
-            )),
-        system_prompt_cfg=dict(
-            role="system",
-            template="Given a list of objects in a real-world environment, you can list down different scenarios that can arise in the environment. A scenario can be a task that one or more people complete in the environment, such as cooking a meal in a kitchen or playing a game in a park. It can also be a situation that arises in the environment, such as a fire breaking out in a building or a storm approaching a beach. When a user provides you the list of objects, your task is to generate a list of ten scenarios. For each scenario, you should provide a one-sentence description of the scenario and a list of objects that are involved in the scenario. Your response should be formatted as valid JSON with the following structure: [{'scenario': '...', 'objects': ['...', ...]}, ...]. Do not output more than ten scenarios or any additional information.",
-        ),
-        user_prompt_cfg=dict(
-            role="user",
-            template="Objects in the scene: $object_list. Generate a list of up to ten scenarios that can arise in this environment using the specified format. "
-        ),
-    )
-    llm = LLM(init_cfg=cfg)
+    llm = LLM(init_cfg=LLM_CFG)
     llm.user_prompt.set('object_list', object_list)
     return llm.prompt(llm.user_prompt)
 
 
+def stream_scenarios(object_list, available_objects, num_scenarios, known=()):
+    """ Prompt the LLM with a streamed completion until enough scenarios are valid.
+
+    Each scenario is validated against the available objects as soon as its JSON
+    object is complete, and the generation is cancelled once `num_scenarios` new
+    valid scenarios have arrived.
+
+    Args:
+        object_list: The object list of the scan for the prompt.
+        available_objects: Labels of the objects in the scan.
+        num_scenarios (int): Number of valid scenarios to collect.
+        known: Scenario descriptions that are not counted again.
+
+    Returns:
+        The new valid scenarios.
+    """
+    llm = LLM(init_cfg=LLM_CFG)
+    llm.user_prompt.set('object_list', object_list)
+
+    known = set(known)
+    scenarios = []
+
+    def add(item):
+        if is_valid_scenario(item) and item['scenario'] not in known \
+                and all(o in available_objects for o in item['objects']):
+            scenarios.append(item)
+            known.add(item['scenario'])
+
+    parser = JSONObjectStream()
+    chunks = llm.stream(llm.user_prompt)
+    text = ''
+    try:
+        for chunk in chunks:
+            text += chunk
+            for item in parser.feed(chunk):
+                add(item)
+            if len(scenarios) >= num_scenarios:
+                return scenarios
+    finally:
+        chunks.close()
+
+    # The complete response may still have scenarios that only the line parser reads
+    for item in parse_response(text):
+        add(item)
+    return scenarios
+
+
+def scene_objects(item):
+    """ Objects of a scan as they are listed in the prompt. """
+    return [{
+        'label': o['label'],                      # 'chair'
+        'affordances': o.get('affordances', []),  # ['sit']
+        'attributes': o['attributes'],            # {'color': ['red'], 'shape': ['round']}
+    } for o in item['objects']]
+
+
+def generate_scenarios(item, existing_data, min_scenarios, cache=None, object_list=scene_objects, packed=(),
+                       stream=False):
+    # Get objects in the scene
+    objects = scene_objects(item)
+    available_objects = {o['label'] for o in objects}
+
+    # Reuse the scenarios of a scan with a matching object inventory (e.g. a rescan of
+    # the same room), which are checked against the objects of this scan like the others
+    candidates = list(existing_data)
+    if cache is not None and len(existing_data) < min_scenarios:
+        match = cache.lookup([o['label'] for o in objects], exclude=item['scan'])
+        if match is not None:
+            candidates += match[1]
+
+    # Scenarios generated for this scan in a packed request are checked the same way
+    candidates += packed
+
+    # Filter out scenarios with non-matching or non-string objects
+    # This is to avoid scenarios with objects that are not in the scene, or invalid objects (from an earlier version of the script)
+    existing_data_ = []
+    s_ids = []  # to remove duplicates (because of an earlier bug in the script)
+    for s in candidates:
+        if s['scenario'] in s_ids:
+            continue
+
+        keep = True
+        for o in s['objects']:
+            if not isinstance(o, str):
+                keep = False
+                break
+            if o not in available_objects:
+                keep = False
+                break
+
+        if keep:
+            s_ids.append(s['scenario'])
+            existing_data_.append(s) 
+    existing_data = existing_data_
+
+    # Prompt the LLM for scenarios
+    num_attempts = 0
+    while len(existing_data) < min_scenarios:
+        num_attempts += 1
+        if num_attempts > 3:
+            break
+
+        if stream:
+            new_scenarios = stream_scenarios(object_list(item), available_objects, min_scenarios - len(existing_data),
+                                             known={s['scenario'] for s in existing_data})
+        else:
+            response = prompt_llm(object_list(item))
+            new_scenarios = parse_response(response)
+
+        # Filter out scenarios with non-matching objects
+        new_scenarios = [s for s in new_scenarios if all(o in available_objects for o in s['objects'])]
+
+        # Add the new scenarios
+        existing_data += new_scenarios
+
+    return existing_data[:min_scenarios]  # Limit to MIN_SCENARIOS
+
+
+def is_complete(scenarios, labels, min_scenarios):
+    """ Check whether a scan has enough scenarios that use only objects of the scan.
+
+    Scenarios with other objects are dropped by `generate_scenarios`, so they do not count.
+
+    Args:
+        scenarios: The existing scenarios of the scan.
+        labels: The labels of the objects in the scan.
+        min_scenarios: Minimum number of distinct valid scenarios.
+
+    Returns:
+        True if the scan does not need more scenarios.
+    """
+    available_objects = set(labels)
+    valid = {s['scenario'] for s in scenarios
+             if all(isinstance(o, str) and o in available_objects for o in s['objects'])}
+    return len(valid) >= min_scenarios
+
+
+def estimate_scenarios(scans, dataset, min_scenarios, cache=None, object_list=scene_objects,
+                       pack_scans=1, pack_max_tokens=None):
+    """ Estimate the LLM calls and tokens for the scans that need more scenarios.
+
+    Assumes one call per scan, or per packed request of up to `pack_scans` small scans.
+    The output tokens are an upper bound (`max_tokens`). With a scenario cache, scans
+    whose inventory matches a scan with scenarios (or an earlier scan in the queue) are
+    assumed to reuse its scenarios without a call.
+    """
+    estimate = CostEstimate()
+    system_tokens = count_tokens(Prompt.from_cfg(LLM_CFG['system_prompt_cfg']).build())
+    packed_system_tokens = count_tokens(Prompt.from_cfg(PACKED_LLM_CFG['system_prompt_cfg']).build())
+    max_tokens = LLM_CFG['backend_cfg']['init_cfg']['max_tokens']
+
+    def add_packed(items):
+        if len(items) == 1:
+            add_single(items[0])
+        elif len(items) > 1:
+            estimate.add('packed', packed_system_tokens + count_tokens(packed_prompt(items, object_list).build()),
+                         max_tokens * len(items))
+
+    def add_single(item):
+        user_prompt = Prompt.from_cfg(LLM_CFG['user_prompt_cfg'])
+        user_prompt.set('object_list', object_list(item))
+        estimate.add('scenarios', system_tokens + count_tokens(user_prompt.build()), max_tokens)
+
+    batch = []
+    for item in tqdm(scans, desc="Rendering prompts"):
+        labels = [o['label'] for o in item['objects']]
+        if is_complete(dataset.get(item['scan'], {}).get('scenarios', []), labels, min_scenarios):
+            continue
+        if cache is not None:
+            if cache.lookup(labels, exclude=item['scan']) is not None:
+                continue
+            cache.add(item['scan'], labels, [])
+
+        if pack_scans > 1 and count_tokens(str(object_list(item))) <= pack_max_tokens:
+            batch.append(item)
+            if len(batch) == pack_scans:
+                add_packed(batch)
+                batch = []
+        else:
+            add_single(item)
+    add_packed(batch)
+    return estimate
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--data_dir', type=str,
                         default="data/3DSSG/raw/",
                         help="Path to the 3DSSG dataset")
+    parser.add_argument('--cache', action='store_true',
+                        help="Load the 3DSSG objects and relationships from a binary cache in the "
+                             "data directory, which is built on the first run")
     parser.add_argument('--min_scenarios', type=int, default=5,
                         help="Minimum number of scenarios to generate for each scan")
+    parser.add_argument('--reuse_scenarios', action='store_true',
+                        help="Reuse the scenarios of scans with the same object inventory (e.g. rescans "
+                             "of the same room) instead of prompting the LLM for every scan")
+    parser.add_argument('--reuse_similarity', type=float, default=1.0,
+                        help="Minimum Jaccard similarity of the object label multisets for reusing "
+                             "scenarios (1.0 only reuses identical inventories)")
+    parser.add_argument('--pack_objects', action='store_true',
+                        help="Give the objects to the LLM as a compact inventory (labels with counts and "
+                             "selected attributes) instead of the raw object list")
+    parser.add_argument('--object_budget', type=int, default=None,
+                        help="Maximum number of tokens of the packed inventory (see src/measure_inventories.py)")
+    parser.add_argument('--pack_scans', type=int, default=1,
+                        help="Number of small scans to generate scenarios for in one request (1 prompts "
+                             "the LLM for every scan separately)")
+    parser.add_argument('--pack_max_tokens', type=int, default=400,
+                        help="Maximum number of tokens of the object list of a scan for packing it with others")
+    parser.add_argument('--stream', action='store_true',
+                        help="Stream the completions and stop each one as soon as enough valid scenarios "
+                             "have arrived")
+    parser.add_argument('--compact_every', type=int, default=500,
+                        help="Number of scans after which the checkpoint log is compacted "
+                             "into the scenarios file")
+    parser.add_argument('--ledger', type=str, default=None,
+                        help="Path to a SQLite task ledger shared by several workers")
+    parser.add_argument('--worker', type=str, default=f"{socket.gethostname()}-{os.getpid()}",
+                        help="Name of this worker in the task ledger")
+    parser.add_argument('--retry_failed', action='store_true',
+                        help="Return failed scans in the task ledger to the queue")
+    parser.add_argument('--retry_errors', type=str, default=None,
+                        help="Only retry failed scans whose error matches this SQL LIKE "
+                             "pattern (e.g. '%%RateLimitError%%')")
+    parser.add_argument('--shard', type=str, default=None,
+                        help="Only process shard i of N (given as 'i/N'), partitioned by scan ID. "
+                             "The scenarios are written to a separate shard file.")
+    add_estimate_args(parser)
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
     MIN_SCENARIOS = args.min_scenarios
+    shard = parse_shard(args.shard)
 
     # Check if the objects file exists
     objects_file = os.path.join(args.data_dir, "objects.json")
@@ -89,96 +415,191 @@ def main():
         return
 
     # Load the 3DSSG dataset
-    with open(objects_file, 'r') as f:
-        objects = json.load(f)['scans']
-        print(f"Loaded {len(objects)} scans from {objects_file}")
+    if args.cache:
+        objects = [{'scan': scan_id, 'objects': scan_objects} for scan_id, scan_objects, _ in
+                   iter_scans(args.data_dir, relationships=False, use_cache=True)]
+    else:
+        with open(objects_file, 'r') as f:
+            objects = json.load(f)['scans']
+    print(f"Loaded {len(objects)} scans from {objects_file}")
+
+    if shard is not None:
+        objects = [item for item in objects if in_shard(item['scan'], shard)]
+        print(f"Processing {len(objects)} scans in shard {args.shard}")
 
     # Define save path
-    scenarios_file = os.path.join(args.data_dir, "scenarios.json")
+    scenarios_file = shard_path(os.path.join(args.data_dir, "scenarios.json"), shard)
     print(f"Saving scenarios to {scenarios_file}")
 
     # Read existing scenarios (if any)
-    scenarios = []
-    if os.path.exists(scenarios_file):
-        with open(scenarios_file, 'r') as f:
-            scenarios = json.load(f)['scans']
+    # Scans are appended to a log, which is periodically compacted into the
+    # scenarios file. Each worker sharing a ledger writes its own log.
+    ledger = TaskLedger(args.ledger) if args.ledger and not args.dry_run else None
+    checkpoint = CheckpointLog(
+        scenarios_file,
+        key=lambda item: item['scan'],
+        field='scans',
+        log_path=f"{os.path.splitext(scenarios_file)[0]}.{args.worker}.jsonl" if ledger else None,
+        compact_every=args.compact_every,
+    )
+    scenarios = checkpoint.load()
     print(f"Found scenarios for {len(scenarios)} scans")
 
     # Index the existing scenarios
     dataset = {item['scan']: item for item in scenarios}
 
+    # Cache the complete scenarios by the object inventory of their scan
+    cache = None
+    labels = {item['scan']: [o['label'] for o in item['objects']] for item in objects}
+    if args.reuse_scenarios:
+        cache = ScenarioCache(threshold=args.reuse_similarity)
+        for item in scenarios:
+            if item['scan'] not in labels:
+                continue
+            if is_complete(item.get('scenarios', []), labels[item['scan']], MIN_SCENARIOS):
+                cache.add(item['scan'], labels[item['scan']], item['scenarios'])
+        print(f"Cached the scenarios of {len(cache)} scans for reuse")
+
+    # The object list of a scan as it is given in the prompt
+    def object_list(item):
+        if not args.pack_objects:
+            return scene_objects(item)
+        return pack_inventory(scene_objects(item), max_tokens=args.object_budget)[0]
+
+    if args.dry_run:
+        estimate = estimate_scenarios(objects, dataset, MIN_SCENARIOS, cache=cache, object_list=object_list,
+                                      pack_scans=args.pack_scans, pack_max_tokens=args.pack_max_tokens)
+        print()
+        for line in estimate.table("Stage 1: scenario generation (output tokens at most max_tokens)",
+                                   args.concurrency, args.prefill_tps, args.decode_tps):
+            print(line)
+        return
+
+    # Build the queue of scans that still need scenarios. With a task ledger, scans are
+    # claimed from the ledger one at a time, so that several workers can share the dataset.
+    # A complete scan (see `is_complete`) is not prompted or saved again.
+    def scan_complete(item):
+        return is_complete(dataset.get(item['scan'], {}).get('scenarios', []), labels[item['scan']], MIN_SCENARIOS)
+
+    complete = {item['scan'] for item in objects if scan_complete(item)}
+    if ledger is not None:
+        items = {item['scan']: item for item in objects}
+        ledger.add((scan_id, '') for scan_id in items)
+        ledger.mark_done((scan_id, '') for scan_id in items if scan_id in complete)
+        if args.retry_failed:
+            num_retried = ledger.retry_failed(error_pattern=args.retry_errors)
+            print(f"Retrying {num_retried} failed scans")
+        counts = ledger.counts()
+        print(f"Ledger: {counts[ledger.PENDING]} pending, {counts[ledger.LEASED]} leased, "
+              f"{counts[ledger.DONE]} done, {counts[ledger.FAILED]} failed")
+
+        def claim_scans():
+            for scan_id, _ in ledger.iter_claims(args.worker):
+                if scan_id in items:
+                    yield items[scan_id]
+                else:
+                    ledger.fail(scan_id, error='Scan not found in the dataset')
+
+        queue = claim_scans()
+        num_remaining = counts[ledger.PENDING]
+    else:
+        queue = [item for item in objects if item['scan'] not in complete]
+        num_remaining = len(queue)
+
+    # Small scans that need scenarios are generated together in packed requests. A scan
+    # whose section fails (or has too few valid scenarios) is prompted on its own.
+    # Scans that can reuse the scenarios of a cached scan are left out, and so are rescans
+    # of a scan earlier in the batch, which can reuse its scenarios once they are cached.
+    packed_stats = {'requests': 0, 'scans': 0, 'failed': 0}
+
+    def packable(item, batch_cache):
+        if scan_complete(item):
+            return False
+        if count_tokens(str(object_list(item))) > args.pack_max_tokens:
+            return False
+        if cache is not None:
+            if cache.lookup(labels[item['scan']], exclude=item['scan'], count=False) is not None \
+                    or batch_cache.lookup(labels[item['scan']], exclude=item['scan'], count=False) is not None:
+                return False
+            batch_cache.add(item['scan'], labels[item['scan']], [])
+        return True
+
+    def generate_packed(batch, items):
+        packed = {}
+        if len(items) > 1:
+            try:
+                packed = prompt_packed(items, object_list)
+            except Exception as e:
+                print(f"Error generating scenarios for {len(items)} packed scans: {e}")
+            packed_stats['requests'] += 1
+            packed_stats['scans'] += len(items)
+            packed_stats['failed'] += sum(1 for item in items if len(packed.get(item['scan'], [])) == 0)
+        for item in batch:
+            yield item, packed.get(item['scan'], [])
+
+    def pack_queue(queue):
+        # A batch is complete once it has `pack_scans` packable scans (as in the estimate)
+        batch, items = [], []
+        batch_cache = ScenarioCache(threshold=args.reuse_similarity)
+        for item in queue:
+            batch.append(item)
+            if packable(item, batch_cache):
+                items.append(item)
+            if len(items) == args.pack_scans:
+                yield from generate_packed(batch, items)
+                batch, items = [], []
+                batch_cache = ScenarioCache(threshold=args.reuse_similarity)
+        yield from generate_packed(batch, items)
+
     try:
         # Continue generating scenarios for the remaining scans
-        for item in tqdm(objects, desc="Generating scenarios"):
+        queue = pack_queue(queue) if args.pack_scans > 1 else ((item, []) for item in queue)
+        for item, packed in tqdm(queue, total=num_remaining, desc="Generating scenarios"):
             # Look for existing scenarios
             scan_id = item['scan']
             existing_data = dataset.get(scan_id, {}).get('scenarios', [])
 
-            # Get objects in the scene
-            objects = [{
-                'label': o['label'],                      # 'chair'
-                'affordances': o.get('affordances', []),  # ['sit']
-                'attributes': o['attributes'],            # {'color': ['red'], 'shape': ['round']}
-            } for o in item['objects']]
-            available_objects = {o['label'] for o in objects}
-
-            # Filter out scenarios with non-matching or non-string objects
-            # This is to avoid scenarios with objects that are not in the scene, or invalid objects (from an earlier version of the script)
-            existing_data_ = []
-            s_ids = []  # to remove duplicates (because of an earlier bug in the script)
-            for s in existing_data:
-                if s['scenario'] in s_ids:
-                    continue
-
-                keep = True
-                for o in s['objects']:
-                    if not isinstance(o, str):
-                        keep = False
-                        break
-                    if o not in available_objects:
-                        keep = False
-                        break
-
-                if keep:
-                    s_ids.append(s['scenario'])
-                    existing_data_.append(s) 
-            existing_data = existing_data_
-
-            # Prompt the LLM for scenarios
-            num_attempts = 0
-            while len(existing_data) < MIN_SCENARIOS:
-                num_attempts += 1
-                if num_attempts > 3:
-                    break
-
-                response = prompt_llm(objects)
-                new_scenarios = parse_response(response)
-
-                # Filter out scenarios with non-matching objects
-                new_scenarios = [s for s in new_scenarios if all(o in available_objects for o in s['objects'])]
-
-                # Add the new scenarios
-                existing_data += new_scenarios
+            try:
+                existing_data = generate_scenarios(item, existing_data, MIN_SCENARIOS, cache=cache,
+                                                   object_list=object_list, packed=packed, stream=args.stream)
+            except Exception as e:
+                if ledger is None:
+                    raise
+
+                print(f"Error generating scenarios for {scan_id}: {e}")
+                ledger.fail(scan_id, error=f"{type(e).__name__}: {e}")
+                continue
 
             # Extend the existing scenarios
             dataset[scan_id] = dataset.get(scan_id, {'scan': scan_id})
-            dataset[scan_id]['scenarios'] = existing_data[:MIN_SCENARIOS]  # Limit to MIN_SCENARIOS
+            dataset[scan_id]['scenarios'] = existing_data
+            checkpoint.append(dataset[scan_id])
+            if ledger is not None:
+                ledger.complete(scan_id)
+            if cache is not None and len(existing_data) >= MIN_SCENARIOS:
+                cache.add(scan_id, labels[scan_id], existing_data)
     except KeyboardInterrupt:
         print("Interrupted. Saving the progress...")
     except Exception as e:
         print(f"Error: {e}. Saving the progress...")
+    finally:
+        # Return the scans this worker still holds to the queue, whatever stopped it
+        if ledger is not None:
+            ledger.release(args.worker)
+
+    # Save the scenarios
+    checkpoint.close()
 
     # Compute and print stats
-    num_scans = len(dataset)
-    num_scenarios = sum(len(item['scenarios']) for item in dataset.values())
+    num_scans = len(checkpoint)
+    num_scenarios = sum(len(item['scenarios']) for item in checkpoint.records.values())
     print(f"Loaded {num_scenarios} scenarios from {num_scans} scans")
-
-    # Convert the dataset to a list
-    scenarios = list(dataset.values())
-
-    # Save the scenarios
-    with open(scenarios_file, 'w') as f:
-        json.dump({'scans': scenarios}, f, indent=4)
+    if packed_stats['requests'] > 0:
+        print(f"Packed {packed_stats['scans']} scans into {packed_stats['requests']} requests "
+              f"({packed_stats['failed']} sections failed and were prompted on their own)")
+    if cache is not None:
+        print(f"Found a scan with a matching inventory for {sum(cache.hits.values())} scans "
+              f"({cache.hits['exact']} identical and {cache.hits['similar']} similar inventories)")
 
 
 if __name__ == "__main__":
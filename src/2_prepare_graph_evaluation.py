@@ -4,12 +4,18 @@ import os
 
 from tqdm import tqdm
 
+# Local imports
+from utils import iter_scans
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--data_dir', type=str,
                         default="data/3DSSG/raw/",
                         help="Path to the 3DSSG dataset")
+    parser.add_argument('--cache', action='store_true',
+                        help="Load the 3DSSG objects and relationships from a binary cache in the "
+                             "data directory, which is built on the first run")
     return parser.parse_args()
 
 
@@ -28,29 +34,30 @@ def main():
         print(f"File not found: {scenarios_file}")
         return
 
-    # Load the 3DSSG dataset
-    with open(objects_file, 'r') as f:
-        objects = json.load(f)['scans']
-        print(f"Loaded {len(objects)} scans from {objects_file}")
-
     with open(scenarios_file, 'r') as f:
         scenarios = json.load(f)['scans']
         print(f"Loaded {len(scenarios)} scans from {scenarios_file}")
+    scenarios_index = {item['scan']: item for item in scenarios}
+
+    # Stream the 3DSSG objects one scan at a time, keeping only the labels of the
+    # scans with scenarios
+    objects_index = {}
+    num_scans = 0
+    for scan_id, objects, _ in iter_scans(args.data_dir, relationships=False, use_cache=args.cache):
+        num_scans += 1
+        if scan_id in scenarios_index:
+            objects_index[scan_id] = [o['label'] for o in objects]
+    print(f"Loaded {num_scans} scans from {objects_file}")
 
     # Define save path
     feedback_file = os.path.join(args.data_dir, "feedback.json")
     print(f"Saving feedback data to {feedback_file}")
 
-    # Build an index
-    objects_index = {item['scan']: item for item in objects}
-    scenarios_index = {item['scan']: item for item in scenarios}
-
     # Process the data
     feedback = []
     for scan_id in tqdm(scenarios_index, desc="Processing scenarios"):
         # Get scan data
-        object_data = objects_index[scan_id]['objects']
-        scan_objects = [o['label'] for o in object_data]
+        scan_objects = objects_index[scan_id]
 
         # Get scenario data
         for item in scenarios_index[scan_id]['scenarios']:
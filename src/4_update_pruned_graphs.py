@@ -5,7 +5,7 @@ import json
 from tqdm import tqdm
 
 # Local imports
-from utils import load_3dssg
+from utils import iter_scans
 
 
 def parse_args():
@@ -13,19 +13,15 @@ def parse_args():
     parser.add_argument('--data_dir', type=str,
                         default="data/3DSSG/raw/",
                         help="Path to the 3DSSG dataset")
+    parser.add_argument('--cache', action='store_true',
+                        help="Load the 3DSSG objects and relationships from a binary cache in the "
+                             "data directory, which is built on the first run")
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
 
-    # Load 3DSSG dataset
-    print(f"Loading 3DSSG dataset from {args.data_dir}")
-    scan_objects, scan_relations = load_3dssg(args.data_dir)
-    print(f"- Loaded object data for {len(scan_objects)} scans")
-    print(f"- Loaded relationships data for {len(scan_relations)} scans")
-    print()
-
     # Load the scenarios and feedback data
     print(f"Loading scenarios and feedback data from {args.data_dir}")
     scenarios_file = os.path.join(args.data_dir, "scenarios.json")
@@ -74,12 +70,16 @@ def main():
     print()
 
     # Create scenario-specific scene graphs
+    # The 3DSSG scans are streamed one at a time with their relations as integer-coded
+    # tables, and only the relations of each scenario are turned into named relations
+    print(f"Streaming 3DSSG scans from {args.data_dir}")
     data = []
+    num_scans = 0
     num_skipped = 0
     num_processed = 0
-    for scan_id, scan_objects_ in tqdm(scan_objects.items(), desc="Pruning scene graphs"):
-        # Get scan relations
-        scan_relations_ = scan_relations.get(scan_id, [])
+    scans = iter_scans(args.data_dir, use_cache=args.cache, columnar=True)
+    for scan_id, scan_objects_, scan_relations_ in tqdm(scans, desc="Pruning scene graphs"):
+        num_scans += 1
 
         # Get scan scenarios
         scan_scenarios = scenario_data[scan_id]['scenarios']
@@ -95,10 +95,7 @@ def main():
             scenario_objects_ids = [str(o['global_id']) for o in scenario_objects]
 
             # Get details of scenario relations
-            scenario_relations = []
-            for rel in scan_relations_:
-                if rel['subject_id'] in scenario_objects_ids and rel['object_id'] in scenario_objects_ids:
-                    scenario_relations.append(rel)
+            scenario_relations = scan_relations_[scan_relations_.between(scenario_objects_ids)].to_dicts()
 
             # Skip if no relations found
             if len(scenario_relations) == 0:
@@ -119,7 +116,7 @@ def main():
                 'scenario_objects': scenario_objects,
                 'scenario_relations': scenario_relations
             })
-    print(f"- Processed {num_processed} scenarios")
+    print(f"- Processed {num_processed} scenarios in {num_scans} scans")
     print(f"- [WARNING] {num_skipped} scenarios have no relations")
     print()
 
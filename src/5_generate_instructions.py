@@ -1,7 +1,9 @@
+import argparse
+import copy
 import json
 import os
+import socket
 import time
-from time import strftime, gmtime
 
 from colorama import init, Fore
 from dotenv import load_dotenv
@@ -9,8 +11,17 @@ from openai import RateLimitError
 from tqdm import tqdm
 
 # Local imports
-from prompting import LLM, Prompt
-from utils import SceneGraph
+from prompting import LLM, CascadeBackend, Prompt, prompt_batch
+from utils import CheckpointLog, SceneGraph, SceneGraphIndex, TaskLedger, in_shard, parse_shard, shard_path
+from utils.conversation_store import ConversationStore
+from utils.convergence import ConvergenceDetector
+from utils.dialogue_memo import canonical_names, dialogue_key, object_mapping, rename_objects
+from utils.estimate import CostEstimate, add_estimate_args
+from utils.relevance import trim_scene_graph
+from utils.retrieval import ExemplarIndex, format_examples
+from utils.summary import is_complete_dialogue, is_malformed
+from utils.tokens import count_tokens
+from utils.transcript import parse_steps, summarizer_prompt, transcript_savings
 
 
 # Colorama for colored terminal output
@@ -21,21 +32,51 @@ load_dotenv()
 
 
 class InstructionsGenerator:
-    def __init__(self, scene_graph, scenario, num_iterations=5, output_dir='out', verbose=True):
+    FOLLOW_UP_PROMPT = ("The oracle said: {answer}. What do you want to know next? If you have all the "
+                        "information for completing the task, respond with 'done'")
+
+    def __init__(self, scene_graph, scenario, num_iterations=5, store=None, metadata=None,
+                 defer_summary=False, convergence=None, examples='', config_dir='configs', num_branches=1,
+                 branch_temperatures=None, verbose=True):
         self.scene_graph = scene_graph
         self.scenario = scenario
+        self.examples = examples
+        self.config_dir = config_dir
 
         # Create the LLM Agents
-        self.robot = Robot(scenario)
-        self.oracle = Oracle(scene_graph, scenario)
-        self.summarizer = LLM(init_cfg='configs/summarizer.py')
+        # With a deferred summary, the dialogue ends without a summary, which is
+        # generated later in a separate pass (see src/repair_summaries.py)
+        self.robot = Robot(scenario, config_dir)
+        self.oracle = Oracle(scene_graph, scenario, config_dir, examples=examples)
+        self.summarizer = None if defer_summary else LLM(init_cfg=os.path.join(config_dir, 'summarizer.py'))
+        self.defer_summary = defer_summary
 
-        # Set output directory
-        self.output_dir = output_dir
+        # Set the conversation store (and the metadata to store with the conversation)
+        self.store = store
+        self.metadata = metadata or {}
         self.verbose = verbose
 
         self.num_iterations = num_iterations
-        self.conversation_id = strftime("%Y%m%d-%H%M%S", gmtime())
+        self.conversation_id = None
+
+        # Optional detector that ends the dialogue once the Oracle's answers converge
+        self.convergence = convergence
+        self.rounds_saved = 0
+
+        # Optional callback after every turn, e.g. to checkpoint the dialogue state
+        self.on_turn = None
+
+        # After the Oracle's initial instructions, the dialogue can fork into several
+        # branches with their own follow-up questions (see `fork`)
+        self.num_branches = num_branches
+        self.branch_temperatures = branch_temperatures
+        self.branches = [self]
+
+        # Dialogue state
+        self.stage = 'instructions'
+        self.iteration = 0
+        self.question = None
+        self.summary = None
 
         self.history = [
             {
@@ -44,97 +85,257 @@ class InstructionsGenerator:
             },
             {
                 'role': 'user',
-                'content': f'Hello, given the scene {{{scene_graph}}}, I would like to know the instructions for: {scenario}'
+                'content': self.opening_message(scene_graph, scenario)
             }
         ]
 
+    @staticmethod
+    def opening_message(scene_graph, scenario):
+        return f'Hello, given the scene {{{scene_graph}}}, I would like to know the instructions for: {scenario}'
+
     def print_message(self, message, color=Fore.BLACK):
         if self.verbose:
             print(color + message + Fore.RESET)
 
-    def generate(self):
-        # Set print color to green
-        self.print_message(f'Robot: {self.history[1]["content"]}', Fore.GREEN)
-
-        # Get the initial instructions from the Oracle
-        instructions = self.oracle.get_initial_instructions()
-        self.print_message(f'Oracle: {instructions}', Fore.MAGENTA)
-        self.history.append({
-            'role': 'assistant',
-            'content': instructions
-        })
+    @property
+    def finished(self):
+        return self.stage == 'done'
 
-        # Set the instructions for the robot
-        self.robot.set_instructions(instructions)
+    def next_turn(self):
+        """ Get the agent and the prompt for the next turn of the dialogue.
 
-        # Get the humanoid's response
-        question = self.robot.prompt(self.robot.user_prompt)
-        self.print_message(f'Robot: {question}', Fore.GREEN)
-        self.history.append({
-            'role': 'user',
-            'content': question
-        })
+        Returns:
+            A tuple (agent, prompt), or None if the dialogue is finished.
+        """
+        if self.stage == 'instructions':
+            # Get the initial instructions from the Oracle
+            return self.oracle, self.oracle.user_prompt
+        elif self.stage == 'question':
+            # Get the humanoid's response to the initial instructions
+            return self.robot, self.robot.user_prompt
+        elif self.stage == 'answer':
+            return self.oracle, self.oracle.as_prompt(self.question)
+        elif self.stage == 'follow_up':
+            # Send the Oracle's response to the humanoid
+            answer = self.history[-1]['content']
+            return self.robot, self.robot.as_prompt(self.FOLLOW_UP_PROMPT.format(answer=answer))
+        elif self.stage == 'summary':
+            # Summarize the conversation. The transcript leaves out the system prompt
+            # and the scene graph, which the summarizer does not need.
+            return self.summarizer, self.summarizer.as_prompt(summarizer_prompt(self.history, self.scenario))
+
+        return None
 
-        for i in range(self.num_iterations):
-            answer = self.oracle.prompt(question)
-            self.print_message(f'Oracle: {answer}', Fore.MAGENTA)
+    def submit(self, response):
+        """ Record the response to the current turn and advance the dialogue.
+
+        Args:
+            response: The response of the agent returned by `next_turn`.
+        """
+        if self.stage == 'instructions':
+            self.print_message(f'Robot: {self.history[1]["content"]}', Fore.GREEN)
+            self.print_message(f'Oracle: {response}', Fore.MAGENTA)
             self.history.append({
                 'role': 'assistant',
-                'content': answer
+                'content': response
             })
 
-            # Send the Oracle's response to the humanoid
-            question = self.robot.prompt(f"""The oracle said: {answer}. What do you want to know next? If you have all the information for completing the task, respond with 'done'""")
-            self.print_message(f'Robot: {question}', Fore.GREEN)
+            # Set the instructions for the robot
+            self.robot.set_instructions(response)
+            if self.convergence is not None:
+                self.convergence.update(response)
+            self.stage = 'question'
+
+            if self.num_branches > 1:
+                self.fork(self.num_branches, self.branch_temperatures)
+
+        elif self.stage in ('question', 'follow_up'):
+            self.print_message(f'Robot: {response}', Fore.GREEN)
             self.history.append({
                 'role': 'user',
-                'content': question
+                'content': response
             })
+            self.question = response
 
-            if "done." in question.lower() or "'done'" in question.lower():
-                break
+            if self.stage == 'follow_up':
+                self.iteration += 1
+                done = "done." in response.lower() or "'done'" in response.lower()
+            else:
+                done = False
+
+            if done or self.iteration >= self.num_iterations:
+                self.end_dialogue()
+            else:
+                self.stage = 'answer'
+
+        elif self.stage == 'answer':
+            self.print_message(f'Oracle: {response}', Fore.MAGENTA)
+            self.history.append({
+                'role': 'assistant',
+                'content': response
+            })
+
+            # Stop early if the answer adds nothing to the previous instructions
+            if self.convergence is not None and self.convergence.update(response):
+                self.print_message('The instructions have converged.', Fore.YELLOW)
+                self.rounds_saved = self.num_iterations - self.iteration
+                self.end_dialogue()
+            else:
+                self.stage = 'follow_up'
+
+        elif self.stage == 'summary':
+            try:
+                pretty_summary = json.dumps(json.loads(response), indent=4)
+                self.print_message(f'{pretty_summary}', Fore.MAGENTA)
+            except json.JSONDecodeError:
+                self.print_message(f'{response}', Fore.MAGENTA)
+
+            self.finish(response)
+
+        else:
+            raise RuntimeError('The dialogue is already finished.')
+
+        if self.on_turn is not None:
+            self.on_turn(self)
+
+    def state_dict(self):
+        """ State of the dialogue after the last turn, including the message histories of the agents. """
+        return {
+            'stage': self.stage,
+            'iteration': self.iteration,
+            'question': self.question,
+            'summary': self.summary,
+            'conversation_id': self.conversation_id,
+            'rounds_saved': self.rounds_saved,
+            'history': list(self.history),
+            'robot_instructions': self.robot.user_prompt.get('instructions'),
+            'messages': {
+                'robot': list(getattr(self.robot.backend, 'messages', [])),
+                'oracle': list(getattr(self.oracle.backend, 'messages', [])),
+            },
+            'convergence': self.convergence.state_dict() if self.convergence is not None else None,
+        }
+
+    def load_state_dict(self, state):
+        """ Continue a dialogue from a state returned by `state_dict`. """
+        self.stage = state['stage']
+        self.iteration = state['iteration']
+        self.question = state['question']
+        self.summary = state['summary']
+        self.conversation_id = state['conversation_id']
+        self.rounds_saved = state['rounds_saved']
+        self.history = list(state['history'])
+        if state['robot_instructions'] is not None:
+            self.robot.set_instructions(state['robot_instructions'])
+        self.robot.backend.messages = list(state['messages']['robot'])
+        self.oracle.backend.messages = list(state['messages']['oracle'])
+        if self.convergence is not None and state['convergence'] is not None:
+            self.convergence.load_state_dict(state['convergence'])
+
+    def fork(self, num_branches, temperatures=None):
+        """ Fork the dialogue into branches that continue independently from the current turn.
+
+        The branches start from a copy of the dialogue so far, so the shared opening
+        (and the Oracle's initial instructions) is generated only once, and every branch
+        sends the same message prefix, which the server can serve from its prefix cache.
+        The branches differ in the sampling of the Robot's follow-up questions.
+
+        Args:
+            num_branches (int): Number of branches, including this dialogue, which
+                continues as the first branch.
+            temperatures: Sampling temperature of the Robot in each branch. Defaults
+                to the temperature of the Robot config for all branches.
 
-        # Summarize the conversation
-        self.print_message('Summarizing conversation...', Fore.YELLOW)
-        summarizer_prompt = f"Here is the conversation history: {json.dumps(self.history)}."
-        summarizer_prompt += f" Keeping in mind the scenario: {self.scenario}, summarize the conversation. Final instructions should be arranged logically and have all the necessary steps without any irrelevant information or redundant steps."
-        summary = self.summarizer.prompt(json.dumps(self.history))
+        Returns:
+            The branches, starting with this dialogue.
+        """
+        if self.finished:
+            raise RuntimeError('The dialogue is already finished.')
+        if temperatures is not None and len(temperatures) != num_branches:
+            raise ValueError(f"Expected {num_branches} temperatures, got {len(temperatures)}.")
 
-        try:
-            pretty_summary = json.dumps(json.loads(summary), indent=4)
-            self.print_message(f'{pretty_summary}', Fore.MAGENTA)
-        except json.JSONDecodeError:
-            self.print_message(f'{summary}', Fore.MAGENTA)
+        state = self.state_dict()
+        branches = [self]
+        for idx in range(1, num_branches):
+            branch = InstructionsGenerator(
+                self.scene_graph,
+                self.scenario,
+                num_iterations=self.num_iterations,
+                store=self.store,
+                metadata={**self.metadata, 'branch': idx},
+                defer_summary=self.defer_summary,
+                convergence=copy.deepcopy(self.convergence),
+                examples=self.examples,
+                config_dir=self.config_dir,
+                verbose=self.verbose,
+            )
+            branch.load_state_dict(copy.deepcopy(state))
+            branches.append(branch)
+
+        if temperatures is not None:
+            for branch, temperature in zip(branches, temperatures):
+                robot_backend = branch.robot.backend
+                for backend in getattr(robot_backend, 'stages', [robot_backend]):
+                    backend.temperature = temperature
+
+        self.branches = branches
+        return branches
+
+    def end_dialogue(self):
+        """ End the dialogue turns and summarize the conversation (unless the summary is deferred). """
+        if self.defer_summary:
+            self.finish(None)
+        else:
+            self.print_message('Summarizing conversation...', Fore.YELLOW)
+            self.stage = 'summary'
+
+    def finish(self, summary):
+        """ End the dialogue with the given summary (None if it is deferred) and export it. """
+        self.summary = summary
 
         # Export the conversation
         self.print_message('Exporting conversation...', Fore.YELLOW)
         self.export_conversation(summary)
+        self.stage = 'done'
+
+    def seed(self, instructions):
+        """ Start the dialogue from known initial instructions instead of asking the Oracle.
+
+        The instructions are added to the Oracle's message history as if it had
+        given them, so that the rest of the dialogue continues as usual.
+        """
+        if self.stage != 'instructions':
+            raise RuntimeError('The dialogue has already started.')
+
+        backend = self.oracle.backend
+        backend._save_history(backend._build_messages(self.oracle.user_prompt), instructions)
+        self.submit(instructions)
+
+    def generate(self):
+        while not self.finished:
+            agent, prompt = self.next_turn()
+            self.submit(agent.prompt(prompt))
+
+        # Finish the branches forked from this dialogue, if any
+        for branch in self.branches[1:]:
+            branch.generate()
 
-        return summary, self.history
+        return self.summary, self.history
 
     @property
     def message_history(self):
         return self.backend.messages
 
     def export_conversation(self, summary):
-        history_file = f'{self.output_dir}/conversation_{self.conversation_id}.json'
-        history_dir = os.path.dirname(history_file)
-        if not os.path.exists(history_dir):
-            os.makedirs(history_dir)
-
-        with open(history_file, 'w') as f:
-            history = self.history
-            history = json.dumps(history, indent=4)
-            f.write(history)
+        if self.store is None:
+            return
 
-        summary_file = f'{self.output_dir}/conversation_{self.conversation_id}_summary.json'
-        with open(summary_file, 'w') as f:
-            f.write(summary)
+        self.conversation_id = self.store.add(self.history, summary, **self.metadata)
 
 
 class Robot(LLM):
-    def __init__(self, scenario):
-        super().__init__(init_cfg='configs/robot.py')
+    def __init__(self, scenario, config_dir='configs'):
+        super().__init__(init_cfg=os.path.join(config_dir, 'robot.py'))
         self.user_prompt.set('scenario', scenario)
 
     def set_instructions(self, instructions):
@@ -142,52 +343,399 @@ class Robot(LLM):
 
 
 class Oracle(LLM):
-    def __init__(self, scene_graph, scenario):
-        super().__init__(init_cfg='configs/oracle.py')
-        self.user_prompt.set('scene_graph', f"{{{scene_graph}}}")
+    def __init__(self, scene_graph, scenario, config_dir='configs', examples=''):
+        super().__init__(init_cfg=os.path.join(config_dir, 'oracle.py'))
+        if self.init_cfg.get('scene_graph_tools', False):
+            # The Oracle queries the scene graph with tools, so the prompt only describes it
+            index = SceneGraphIndex(scene_graph)
+            self.backend.set_tools(index.TOOLS, index.call)
+            self.user_prompt.set('scene_graph', index.overview())
+        else:
+            self.user_prompt.set('scene_graph', self.render_scene_graph(self.init_cfg, scene_graph, scenario))
         self.user_prompt.set('scenario', scenario)
+        if 'examples' in self.user_prompt.parameters:
+            # Few-shot examples must not introduce any $ variables
+            self.user_prompt.set('examples', examples.replace('$', ''))
+
+        # In a cascade, escalate answers that refer to objects which are not in the scene
+        if isinstance(self.backend, CascadeBackend):
+            self.backend.add_validator(
+                lambda response: 'objects not in the scene' if scene_graph.unknown_objects(response) else None)
+
+    @staticmethod
+    def render_scene_graph(cfg, scene_graph, scenario):
+        """ The scene graph as it is given in the prompt of an Oracle with this config. """
+        scene_graph_format = cfg.get('scene_graph_format', 'default')
+        scene_graph_budget = cfg.get('scene_graph_budget')
+        if scene_graph_budget is not None:
+            scene_graph = trim_scene_graph(scene_graph, scenario, scene_graph_budget, mode=scene_graph_format)
+        return f"{{{scene_graph.serialize(scene_graph_format)}}}"
 
     def get_initial_instructions(self):
         return self.prompt(self.user_prompt)
 
-    def prompt(self, prompt: Prompt | str, role: str = 'user') -> str:
+    def as_prompt(self, prompt: Prompt | str, role: str = 'user') -> Prompt:
         if isinstance(prompt, str):
             # Remove $ signs from the prompt, as it is reserved for variables
             # and this chatbot only supports variables in the initial prompts
             prompt = prompt.replace('$', '')
 
-        return super().prompt(prompt, role)
+        return super().as_prompt(prompt, role)
+
+
+class LockstepDialogueEngine:
+    """ Runs several dialogues in lockstep with batched LLM requests.
+
+    Up to `batch_size` dialogues are active at a time. In every step, the pending
+    turns of all active dialogues are grouped by agent and each group is sent as a
+    single batch: first all Oracle turns, then all Robot turns, then all summaries.
+    Finished dialogues drop out and are replaced by new ones from the queue, which
+    keeps the server batches full. A dialogue that forks into branches finishes
+    once all of its branches have finished.
+
+    A turn that hits the rate limit is not submitted, so the dialogue sends it again
+    in the next step, after waiting `rate_limit_wait` seconds. A dialogue fails once
+    it has been rate limited more than `rate_limit_retries` times.
+
+    Args:
+        batch_size (int): Number of dialogues to advance together.
+        max_workers (int): Maximum number of concurrent API calls per batch.
+        rate_limit_retries (int): Number of rate-limited turns a dialogue can retry.
+        rate_limit_wait (float): Seconds to wait before retrying rate-limited turns.
+    """
+
+    AGENTS = ('oracle', 'robot', 'summarizer')
+
+    def __init__(self, batch_size, max_workers=None, rate_limit_retries=3, rate_limit_wait=30):
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.rate_limit_retries = rate_limit_retries
+        self.rate_limit_wait = rate_limit_wait
+
+    def run(self, tasks):
+        """ Run the dialogues for all tasks.
+
+        Args:
+            tasks: Iterable of (key, generator) pairs. It is consumed lazily, so it can
+                create the generators on the fly.
+
+        Yields:
+            A tuple (key, generator, error) for each finished dialogue, where error is
+            the exception that stopped the dialogue, or None if it completed.
+        """
+        tasks = iter(tasks)
+        active = []
+        exhausted = False
+        while True:
+            # Fill the batch with new dialogues from the queue
+            while not exhausted and len(active) < self.batch_size:
+                try:
+                    key, generator = next(tasks)
+                    active.append([key, generator, None, 0])
+                except StopIteration:
+                    exhausted = True
+
+            if len(active) == 0:
+                break
+
+            # Advance each dialogue (and each of its branches) by one turn per agent
+            rate_limited = False
+            for agent_name in self.AGENTS:
+                pending = []
+                for task in active:
+                    if task[2] is not None:
+                        continue
+
+                    for dialogue in task[1].branches:
+                        if dialogue.finished:
+                            continue
+
+                        agent, prompt = dialogue.next_turn()
+                        if agent is getattr(dialogue, agent_name):
+                            pending.append((task, dialogue, agent, prompt))
+
+                if len(pending) == 0:
+                    continue
+
+                responses = prompt_batch([(agent.backend, prompt) for _, _, agent, prompt in pending],
+                                         max_workers=self.max_workers)
+                for (task, dialogue, _, _), response in zip(pending, responses):
+                    if isinstance(response, RateLimitError):
+                        # Leave the turn pending, so that it is sent again in the next step
+                        task[3] += 1
+                        if task[3] > self.rate_limit_retries:
+                            task[2] = response
+                        else:
+                            rate_limited = True
+                    elif isinstance(response, Exception):
+                        task[2] = response
+                    elif not response:
+                        task[2] = RuntimeError('No response from the LLM.')
+                    else:
+                        try:
+                            dialogue.submit(response[0])
+                        except Exception as e:
+                            task[2] = e
+
+            # Retire finished dialogues
+            remaining = []
+            for task in active:
+                key, generator, error, _ = task
+                if error is not None or all(dialogue.finished for dialogue in generator.branches):
+                    yield key, generator, error
+                else:
+                    remaining.append(task)
+            active = remaining
+
+            if rate_limited:
+                print(f"Rate limit exceeded. Waiting for {self.rate_limit_wait} seconds before retrying...")
+                time.sleep(self.rate_limit_wait)
+
+
+def measure_turns(instructions, max_samples=1000):
+    """ Mean tokens of the Oracle answers, Robot questions and summaries, and mean number of
+    follow-up rounds, in already generated dialogues (None if there are none).
+    """
+    answers, questions, summaries, rounds = [], [], [], []
+    for record in instructions[:max_samples]:
+        conversation = record.get('conversation') or []
+        messages = [m for m in conversation[2:] if isinstance(m.get('content'), str)]
+        answers.extend(count_tokens(m['content']) for m in messages if m['role'] == 'assistant')
+        robot_turns = [m['content'] for m in messages if m['role'] == 'user']
+        questions.extend(count_tokens(content) for content in robot_turns)
+        if len(robot_turns) > 0:
+            rounds.append(len(robot_turns) - 1)
+        if parse_steps(record['instructions']) is not None:
+            summaries.append(count_tokens(record['instructions']))
+
+    def mean(values):
+        return sum(values) / len(values) if len(values) > 0 else None
+
+    return mean(answers), mean(questions), mean(summaries), mean(rounds)
+
+
+def estimate_instructions(samples, instructions, create_scene_graph, config_dir='configs', num_iterations=3,
+                          num_branches=1):
+    """ Estimate the LLM calls and tokens of the dialogues for the given samples.
+
+    The first prompts of each dialogue are rendered as they would be sent. The later
+    turns are estimated from the mean lengths of the turns in already generated
+    dialogues, or from the `max_tokens` of the agents if there are none. With several
+    branches per sample, the Oracle's initial instructions are generated once and all
+    later turns once per branch.
+    """
+    cfgs = {}
+    for agent in ('oracle', 'robot', 'summarizer'):
+        with open(os.path.join(config_dir, f'{agent}.py'), 'r') as f:
+            cfgs[agent] = eval(f.read())
+
+    def max_tokens(cfg):
+        init_cfg = cfg['backend_cfg']['init_cfg']
+        return init_cfg.get('max_tokens') or init_cfg['stages'][0]['init_cfg'].get('max_tokens', 512)
+
+    def system_tokens(cfg):
+        return count_tokens(Prompt.from_cfg(cfg['system_prompt_cfg']).build()) if 'system_prompt_cfg' in cfg else 0
+
+    # Mean turn lengths (and rounds) of the finished dialogues
+    answer, question, summary, rounds = measure_turns(instructions)
+    answer = answer if answer is not None else max_tokens(cfgs['oracle'])
+    question = question if question is not None else max_tokens(cfgs['robot'])
+    summary = summary if summary is not None else max_tokens(cfgs['summarizer'])
+    rounds = rounds if rounds is not None else num_iterations
+    follow_up = count_tokens(InstructionsGenerator.FOLLOW_UP_PROMPT.format(answer=''))
+
+    oracle_system = system_tokens(cfgs['oracle'])
+    robot_system = system_tokens(cfgs['robot'])
+    summarizer_system = system_tokens(cfgs['summarizer'])
+
+    estimate = CostEstimate()
+    calls = rounds + 1
+    history = rounds * (rounds + 1) / 2  # Sum of the previous turns over all calls
+    for item in tqdm(samples, desc="Rendering prompts"):
+        scene_graph = create_scene_graph(item)
+        scenario = item['scenario']
+
+        # Oracle: the initial instructions, then one answer per round, each with the history
+        oracle_prompt = Prompt.from_cfg(cfgs['oracle']['user_prompt_cfg'])
+        if cfgs['oracle'].get('scene_graph_tools', False):
+            oracle_prompt.set('scene_graph', SceneGraphIndex(scene_graph).overview())
+        else:
+            oracle_prompt.set('scene_graph', Oracle.render_scene_graph(cfgs['oracle'], scene_graph, scenario))
+        oracle_prompt.set('scenario', scenario)
+        if 'examples' in oracle_prompt.parameters:
+            oracle_prompt.set('examples', '')
+        oracle_first = oracle_system + count_tokens(oracle_prompt.build())
+        oracle_calls = 1 + num_branches * rounds
+        estimate.add('oracle', oracle_calls * oracle_first + num_branches * history * (answer + question),
+                     oracle_calls * answer, calls=oracle_calls)
+
+        # Robot: the first question on the instructions, then one follow-up per round
+        robot_prompt = Prompt.from_cfg(cfgs['robot']['user_prompt_cfg'])
+        robot_prompt.set('scenario', scenario)
+        robot_prompt.set('instructions', '')
+        robot_first = robot_system + count_tokens(robot_prompt.build()) + answer
+        estimate.add('robot', num_branches * (calls * robot_first + history * (question + follow_up + answer)),
+                     num_branches * calls * question, calls=num_branches * calls)
+
+        # Summarizer: the compact transcript of each branch
+        transcript = count_tokens(summarizer_prompt([], scenario)) + calls * (answer + question)
+        estimate.add('summarizer', num_branches * (summarizer_system + transcript), num_branches * summary,
+                     calls=num_branches)
+
+    return estimate, rounds
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str,
+                        default="data/3DSSG",
+                        help="Path to the 3DSSG dataset")
+    parser.add_argument('--output_dir', type=str,
+                        default="out/3DSSG_Correct_LQ_Filtered",
+                        help="Directory of the conversation store to export the conversations to")
+    parser.add_argument('--max_shard_mb', type=int, default=64,
+                        help="Size in MB after which the conversation store starts a new shard")
+    parser.add_argument('--num_iterations', type=int, default=3,
+                        help="Maximum number of follow-up questions per dialogue")
+    parser.add_argument('--config_dir', type=str, default='configs',
+                        help="Directory with the configs of the Robot, Oracle and summarizer "
+                             "(e.g. configs/cascade for model cascades)")
+    parser.add_argument('--defer_summaries', action='store_true',
+                        help="Store the finished dialogues without summaries, to summarize them later "
+                             "in a separate batch pass (src/repair_summaries.py)")
+    parser.add_argument('--report', action='store_true',
+                        help="Report how many tokens the compact transcript saves in the summarizer "
+                             "input (tokenizes every saved dialogue twice)")
+    parser.add_argument('--turn_checkpoints', action='store_true',
+                        help="Checkpoint the state of every dialogue after each turn, so that an "
+                             "interrupted or failed dialogue continues from its last turn")
+    parser.add_argument('--num_branches', type=int, default=1,
+                        help="Number of dialogues per sample that share the Oracle's initial instructions "
+                             "and then fork into their own follow-up questions")
+    parser.add_argument('--branch_temperatures', type=float, nargs='+', default=None,
+                        help="Sampling temperature of the Robot in each branch (one per branch)")
+    parser.add_argument('--early_stopping', action='store_true',
+                        help="End a dialogue once an Oracle answer adds no new steps to the previous ones")
+    parser.add_argument('--step_similarity', type=float, default=0.7,
+                        help="Word overlap above which two steps count as the same for early stopping")
+    parser.add_argument('--num_examples', type=int, default=0,
+                        help="Number of similar, already generated samples to show the Oracle "
+                             "as few-shot examples (0 disables the retrieval)")
+    parser.add_argument('--lockstep', type=int, default=0,
+                        help="Number of dialogues to advance in lockstep with batched "
+                             "requests (0 runs the dialogues one after another)")
+    parser.add_argument('--max_workers', type=int, default=None,
+                        help="Maximum number of concurrent requests per lockstep batch "
+                             "(defaults to one per pending turn)")
+    parser.add_argument('--fsync_every', type=int, default=10,
+                        help="Number of generated samples after which the checkpoint log is synced to disk")
+    parser.add_argument('--compact_every', type=int, default=500,
+                        help="Number of generated samples after which the checkpoint log is compacted "
+                             "into the instructions file")
+    parser.add_argument('--ledger', type=str, default=None,
+                        help="Path to a SQLite task ledger shared by several workers")
+    parser.add_argument('--worker', type=str, default=f"{socket.gethostname()}-{os.getpid()}",
+                        help="Name of this worker in the task ledger")
+    parser.add_argument('--retry_failed', action='store_true',
+                        help="Return failed samples in the task ledger to the queue")
+    parser.add_argument('--retry_errors', type=str, default=None,
+                        help="Only retry failed samples whose error matches this SQL LIKE "
+                             "pattern (e.g. '%%RateLimitError%%')")
+    parser.add_argument('--reuse_dialogues', type=str, default='off', choices=['off', 'reuse', 'seed'],
+                        help="For samples whose scenario and scene graph match an existing dialogue "
+                             "(up to instance ids), copy that dialogue ('reuse') or start from its "
+                             "initial instructions ('seed')")
+    parser.add_argument('--shard', type=str, default=None,
+                        help="Only process shard i of N (given as 'i/N'), partitioned by scan ID. "
+                             "The instructions are written to a separate shard file.")
+    add_estimate_args(parser)
+    args = parser.parse_args()
+
+    if args.branch_temperatures is not None and len(args.branch_temperatures) != args.num_branches:
+        parser.error("--branch_temperatures needs one temperature per branch")
+    # The turn checkpoints hold a single dialogue, which cannot restore its branches
+    if args.num_branches > 1 and args.turn_checkpoints:
+        parser.error("--turn_checkpoints cannot be used with --num_branches")
+    return args
 
 
 def main():
+    args = parse_args()
+
     # Load the dataset
     print('----------------------------------------------------------')
     print("Loading dataset... ", end='')
-    dataset = json.load(open('data/3DSSG/raw/scenarios_refined.json', 'r'))['scans']
+    dataset = json.load(open(os.path.join(args.data_dir, 'raw', 'scenarios_refined.json'), 'r'))['scans']
+    shard = parse_shard(args.shard)
+    if shard is not None:
+        dataset = [item for item in dataset if in_shard(item['scan'], shard)]
     num_samples = len(dataset)
 
     # Load existing instructions if any
-    save_path = 'data/3DSSG/instructions_lq.json'
+    # New instructions are appended to a log, which is periodically compacted into
+    # the instructions file, instead of rewriting the whole file after every sample
+    save_path = shard_path(os.path.join(args.data_dir, 'instructions_lq.json'), shard)
     start_idx = 0
-    if os.path.exists(save_path):
-        instructions = json.load(open(save_path, 'r'))
-        print(f"Loaded {len(instructions)} instructions from {save_path}")
-    else:
-        # Create an empty list to store the generated instructions
-        instructions = []
+    ledger = TaskLedger(args.ledger) if args.ledger and not args.dry_run else None
+    checkpoint = CheckpointLog(
+        save_path,
+        key=lambda item: f"{item['scan_id']}-{item['scenario']}",
+        # Each worker sharing a ledger writes its own log
+        log_path=f"{os.path.splitext(save_path)[0]}.{args.worker}.jsonl" if ledger else None,
+        fsync_every=args.fsync_every,
+        compact_every=args.compact_every,
+    )
+    instructions = checkpoint.load()
+    print(f"Loaded {len(instructions)} instructions from {save_path}")
 
     # Filter out bad instructions and index the instructions for faster lookup
+    # Samples with a malformed or deferred summary are kept if their dialogue is complete,
+    # since the summary pass (src/repair_summaries.py) can fix them without a new dialogue
     filtered = []
-    index = []
+    index = set()
+    num_malformed = 0
+    num_deferred = 0
     for item in instructions:
         key = f"{item['scan_id']}-{item['scenario']}"
-        instruct = item['instructions']
-        if not instruct.startswith('Error: Error code'):
-            filtered.append(item)
-            index.append(key)
+        if is_malformed(item['instructions']):
+            if not is_complete_dialogue(item.get('conversation')):
+                continue
+            if item['instructions'] is None:
+                num_deferred += 1
+            else:
+                num_malformed += 1
+        filtered.append(item)
+        index.add(key)
+    if len(filtered) < len(instructions):
+        checkpoint.reset(filtered)
     instructions = filtered
     num_instructions = len(instructions)
     print(f"{num_instructions} of {num_samples} already generated. {num_samples - num_instructions} remaining.")
+    if num_malformed > 0:
+        print(f"{num_malformed} samples have malformed summaries. Run src/repair_summaries.py to fix them.")
+    if num_deferred > 0:
+        print(f"{num_deferred} samples are waiting for their summaries. Run src/repair_summaries.py to summarize them.")
+
+    # Load the states of unfinished dialogues, to continue them from their last turn.
+    # Finished dialogues leave a record without a state.
+    turns = None
+    turn_states = {}
+    if args.turn_checkpoints and not args.dry_run:
+        turns_path = f"{os.path.splitext(save_path)[0]}_turns.json"
+        turns = CheckpointLog(
+            turns_path,
+            key=lambda record: record['key'],
+            log_path=f"{os.path.splitext(turns_path)[0]}.{args.worker}.jsonl" if ledger else None,
+            fsync_every=args.fsync_every,
+            compact_every=args.compact_every,
+        )
+        turn_records = turns.load()
+        live_records = [record for record in turn_records
+                        if record['state'] is not None and record['key'] not in index]
+        if len(live_records) < len(turn_records):
+            turns.reset(live_records)
+        turn_states = {record['key']: record['state'] for record in live_records}
+        print(f"Found {len(turn_states)} unfinished dialogues to continue")
 
     # Initialize empty lists for sorting
     generated_instructions = []
@@ -205,68 +753,331 @@ def main():
     non_generated_instructions = sorted(non_generated_instructions, key=lambda x: x['scan'])
     dataset = generated_instructions + non_generated_instructions
 
-    # Iterate over the dataset
-    num_skipped = 0
-    for item in tqdm(dataset[start_idx:], desc='Generating instructions'):
-        scan_id = item['scan']
-        scenario = item['scenario']
-        key = f"{scan_id}-{scenario}"
-        if key in index:
-            continue
+    # Conversations are exported to a sharded store shared by all workers
+    store = None if args.dry_run else ConversationStore(args.output_dir, max_shard_bytes=args.max_shard_mb * 1024 * 1024)
 
-        scene_graph = SceneGraph(**{
+    def create_scene_graph(item):
+        return SceneGraph(**{
             "objects": item['scenario_objects'],
             "relations": item['scenario_relations']
         })
 
+    # Index the finished dialogues by their content (scenario and scene graph), so
+    # that they can be reused for samples with the same content, e.g. in rescans.
+    # The canonical names of the objects are kept to translate the object ids.
+    memo = {}
+
+    def memoize(item, record):
+        scene_graph = create_scene_graph(item)
+        names = canonical_names(scene_graph)
+        memo.setdefault(dialogue_key(scene_graph, item['scenario'], names), (record, names))
+
+    def find_dialogue(item, scene_graph):
+        """ Find a dialogue with the same content.
+
+        Returns:
+            A tuple (record, mapping) of the dialogue and the map from its object ids
+            to those of this sample, or None if there is no such dialogue.
+        """
+        names = canonical_names(scene_graph)
+        entry = memo.get(dialogue_key(scene_graph, item['scenario'], names))
+        if entry is None:
+            return None
+        record, source_names = entry
+        return record, object_mapping(source_names, names)
+
+    if args.reuse_dialogues != 'off':
+        samples = {(item['scan'], item['scenario']): item for item in dataset}
+        for record in instructions:
+            item = samples.get((record['scan_id'], record['scenario']))
+            if item is not None and parse_steps(record['instructions']) is not None:
+                memoize(item, record)
+        print(f"Indexed {len(memo)} unique dialogues for reuse")
+
+    # Index the generated instructions by scenario and scene objects, to retrieve
+    # similar samples as few-shot examples for the Oracle
+    exemplars = ExemplarIndex()
+
+    def object_labels(item):
+        return {obj['label'] for obj in item['scenario_objects']}
+
+    if args.num_examples > 0:
+        samples = {(item['scan'], item['scenario']): item for item in dataset}
+        for record in instructions:
+            item = samples.get((record['scan_id'], record['scenario']))
+            if item is not None:
+                exemplars.add(item['scenario'], object_labels(item), record['instructions'],
+                              key=(item['scan'], item['scenario']))
+        print(f"Indexed {len(exemplars)} samples as few-shot examples")
+
+    def create_generator(item, scene_graph):
+        nonlocal num_resumed, turns_resumed
+        examples = ''
+        if args.num_examples > 0:
+            results = exemplars.search(item['scenario'], object_labels(item), k=args.num_examples,
+                                       exclude={(item['scan'], item['scenario'])})
+            examples = format_examples(results)
+
         # Start the autobot
         generator = InstructionsGenerator(
             scene_graph,
-            scenario, 
-            num_iterations=3,
-            output_dir='out/3DSSG_Correct_LQ_Filtered',
+            item['scenario'],
+            num_iterations=args.num_iterations,
+            store=store,
+            metadata={'scan_id': item['scan'], 'scenario': item['scenario']},
+            defer_summary=args.defer_summaries,
+            convergence=ConvergenceDetector(args.step_similarity) if args.early_stopping else None,
+            examples=examples,
+            config_dir=args.config_dir,
+            num_branches=args.num_branches,
+            branch_temperatures=args.branch_temperatures,
             verbose=False
         )
-        attempt = True
-        num_attempts = 0
-        while attempt:
-            try:
-                summary, history = generator.generate()
-                attempt = False
-                instructions.append({
-                    'scan_id': scan_id,
-                    'scenario': scenario,
-                    'instructions': summary,
-                    'conversation': history
-                })
-            except RateLimitError:
-                num_attempts += 1
-                if num_attempts > 3:
-                    attempt = False
-                    print(f"Rate limit exceeded. Skipping {key}...")
-                    num_skipped += 1
-                    # if num_skipped > 10:
-                    #     print("Too many rate limit errors. Exiting...")
-                    #     exit()
+
+        # Continue an unfinished dialogue from its last turn
+        key = f"{item['scan']}-{item['scenario']}"
+        state = turn_states.pop(key, None)
+        if state is not None:
+            generator.load_state_dict(state)
+            num_resumed += 1
+            turns_resumed += len(generator.history) - 2
+        if turns is not None:
+            generator.on_turn = lambda generator: turns.append({'key': key, 'state': generator.state_dict()})
+
+        # Skip the Oracle's first answer if a dialogue with the same content exists
+        found = find_dialogue(item, scene_graph) if args.reuse_dialogues == 'seed' and state is None else None
+        if found is not None:
+            record, mapping = found
+            initial_instructions = next(m['content'] for m in record['conversation'] if m['role'] == 'assistant')
+            generator.seed(rename_objects(initial_instructions, mapping))
+
+        return generator
+
+    def reuse_dialogue(item, scene_graph):
+        """ Save a copy of a dialogue with the same content, if there is one. """
+        nonlocal num_reused
+        if args.reuse_dialogues != 'reuse':
+            return False
+
+        found = find_dialogue(item, scene_graph)
+        if found is None:
+            return False
+
+        # The opening message holds the scene graph of this sample, and the turns and
+        # the summary refer to the objects by the ids of this sample
+        record, mapping = found
+        history = copy.deepcopy(record['conversation'])
+        history[1]['content'] = InstructionsGenerator.opening_message(scene_graph, item['scenario'])
+        for message in history[2:]:
+            message['content'] = rename_objects(message['content'], mapping)
+        save_sample(item, rename_objects(record['instructions'], mapping), history,
+                    reused_from=f"{record['scan_id']}-{record['scenario']}")
+        num_reused += 1
+        return True
+
+    def save_sample(item, summary, history, conversation_id=None, reused_from=None, branches=()):
+        record = {
+            'scan_id': item['scan'],
+            'scenario': item['scenario'],
+            'instructions': summary,
+            'conversation': history
+        }
+        if conversation_id is not None:
+            record['conversation_id'] = conversation_id
+        # The other branches of a forked dialogue are stored with the first one
+        if len(branches) > 0:
+            record['branches'] = []
+            for branch in branches:
+                branch_record = {'instructions': branch.summary, 'conversation': branch.history}
+                if branch.conversation_id is not None:
+                    branch_record['conversation_id'] = branch.conversation_id
+                record['branches'].append(branch_record)
+        if reused_from is not None:
+            record['reused_from'] = reused_from
+        elif summary is not None:
+            if args.report:
+                # The report is best-effort and never keeps a sample from being saved
+                try:
+                    full_tokens, compact_tokens = transcript_savings(history, item['scenario'])
+                    summarizer_tokens['full'] += full_tokens
+                    summarizer_tokens['compact'] += compact_tokens
+                except Exception as e:
+                    print(f"Could not count the summarizer tokens: {e}")
+
+            if args.reuse_dialogues != 'off' and parse_steps(summary) is not None:
+                memoize(item, record)
+            if args.num_examples > 0:
+                exemplars.add(item['scenario'], object_labels(item), summary, key=(item['scan'], item['scenario']))
+
+        checkpoint.append(record)
+        if turns is not None:
+            turns.append({'key': f"{item['scan']}-{item['scenario']}", 'state': None})
+        if ledger is not None:
+            ledger.complete(item['scan'], item['scenario'])
+
+    def count_rounds(generator):
+        nonlocal num_dialogues, num_rounds, num_converged, rounds_saved
+        for dialogue in generator.branches:
+            num_dialogues += 1
+            num_rounds += dialogue.iteration
+            if dialogue.rounds_saved > 0:
+                num_converged += 1
+                rounds_saved += dialogue.rounds_saved
+
+    def skip_sample(item, error):
+        nonlocal num_skipped
+        num_skipped += 1
+        if ledger is not None:
+            ledger.fail(item['scan'], item['scenario'], f"{type(error).__name__}: {error}")
+
+    # Build the queue of remaining samples. With a task ledger, samples are claimed
+    # from the ledger one at a time, so that several workers can share the dataset.
+    if ledger is not None:
+        items = {(item['scan'], item['scenario']): item for item in dataset}
+        ledger.add(items.keys())
+        ledger.mark_done(task for task in items if f"{task[0]}-{task[1]}" in index)
+        if args.retry_failed:
+            num_retried = ledger.retry_failed(error_pattern=args.retry_errors)
+            print(f"Retrying {num_retried} failed samples")
+        counts = ledger.counts()
+        print(f"Ledger: {counts[ledger.PENDING]} pending, {counts[ledger.LEASED]} leased, "
+              f"{counts[ledger.DONE]} done, {counts[ledger.FAILED]} failed")
+
+        def claim_samples():
+            for task in ledger.iter_claims(args.worker):
+                if task in items:
+                    yield items[task]
                 else:
-                    wait_time = 30
-                    print(f"Rate limit exceeded. Waiting for {wait_time} seconds before retrying...")
-                    time.sleep(wait_time)
-            except Exception as e:
-                print(f"Error generating instructions for {key}: {e}")
-                attempt = False
-                num_skipped += 1
-                # if num_skipped > 10:
-                #     print("Too many errors. Exiting...")
-                #     exit()
-            
-        # Save the instructions at each 100th iteration
-        with open(save_path, 'w') as f:
-            json.dump(instructions, f, indent=4)
+                    ledger.fail(*task, error='Sample not found in the dataset')
+
+        queue = claim_samples()
+        num_remaining = counts[ledger.PENDING]
+    else:
+        queue = [item for item in dataset[start_idx:]
+                 if f"{item['scan']}-{item['scenario']}" not in index]
+        num_remaining = len(queue)
+
+    if args.dry_run:
+        estimate, rounds = estimate_instructions(queue, instructions, create_scene_graph,
+                                                 config_dir=args.config_dir, num_iterations=args.num_iterations,
+                                                 num_branches=args.num_branches)
+        print()
+        for line in estimate.table(f"Stage 5: instruction generation ({rounds:.2f} follow-up rounds per dialogue, "
+                                   f"without reuse or early stopping)",
+                                   args.concurrency, args.prefill_tps, args.decode_tps):
+            print(line)
+        return
+
+    # Iterate over the dataset
+    num_skipped = 0
+    num_reused = 0
+    num_resumed = 0
+    turns_resumed = 0
+    num_dialogues = 0
+    num_rounds = 0
+    num_converged = 0
+    rounds_saved = 0
+    summarizer_tokens = {'full': 0, 'compact': 0}
+    try:
+        if args.lockstep > 0:
+            def create_tasks():
+                for item in queue:
+                    scene_graph = create_scene_graph(item)
+                    if not reuse_dialogue(item, scene_graph):
+                        yield item, create_generator(item, scene_graph)
+
+            engine = LockstepDialogueEngine(args.lockstep, max_workers=args.max_workers)
+            tasks = create_tasks()
+            for item, generator, error in tqdm(engine.run(tasks), total=num_remaining,
+                                               desc='Generating instructions'):
+                key = f"{item['scan']}-{item['scenario']}"
+                if error is not None:
+                    print(f"Error generating instructions for {key}: {error}")
+                    skip_sample(item, error)
+                    continue
+
+                try:
+                    save_sample(item, generator.summary, generator.history, generator.conversation_id,
+                                branches=generator.branches[1:])
+                    count_rounds(generator)
+                except Exception as e:
+                    print(f"Error generating instructions for {key}: {e}")
+                    skip_sample(item, e)
+
+        else:
+            for item in tqdm(queue, total=num_remaining, desc='Generating instructions'):
+                scan_id = item['scan']
+                scenario = item['scenario']
+                key = f"{scan_id}-{scenario}"
+
+                scene_graph = create_scene_graph(item)
+                if reuse_dialogue(item, scene_graph):
+                    continue
+
+                generator = create_generator(item, scene_graph)
+                attempt = True
+                num_attempts = 0
+                while attempt:
+                    try:
+                        summary, history = generator.generate()
+                        attempt = False
+                        save_sample(item, summary, history, generator.conversation_id,
+                                    branches=generator.branches[1:])
+                        count_rounds(generator)
+                    except RateLimitError as e:
+                        num_attempts += 1
+                        if num_attempts > 3:
+                            attempt = False
+                            print(f"Rate limit exceeded. Skipping {key}...")
+                            skip_sample(item, e)
+                            # if num_skipped > 10:
+                            #     print("Too many rate limit errors. Exiting...")
+                            #     exit()
+                        else:
+                            wait_time = 30
+                            print(f"Rate limit exceeded. Waiting for {wait_time} seconds before retrying...")
+                            time.sleep(wait_time)
+                    except Exception as e:
+                        print(f"Error generating instructions for {key}: {e}")
+                        attempt = False
+                        skip_sample(item, e)
+                        # if num_skipped > 10:
+                        #     print("Too many errors. Exiting...")
+                        #     exit()
+    except KeyboardInterrupt:
+        print("Interrupted. Saving the progress...")
+    finally:
+        # Return the samples this worker still holds to the queue, whatever stopped it
+        if ledger is not None:
+            ledger.release(args.worker)
 
     # Save final instructions
-    with open(save_path, 'w') as f:
-        json.dump(instructions, f, indent=4)
+    checkpoint.close()
+    if turns is not None:
+        turns.close()
+        print(f"Continued {num_resumed} dialogues from their last turn ({turns_resumed} turns not repeated)")
+
+    if args.reuse_dialogues != 'off':
+        print(f"Reused {num_reused} dialogues")
+
+    if num_dialogues > 0:
+        print(f"Follow-up rounds per dialogue: {num_rounds / num_dialogues:.2f} (of at most {args.num_iterations})")
+
+    # Each round saved by early stopping is one Robot and one Oracle turn (except for the
+    # last round, which has no Oracle answer)
+    if args.early_stopping:
+        print(f"Early stopping: {num_converged} dialogues converged, saving {rounds_saved} rounds "
+              f"({2 * rounds_saved - num_converged} LLM calls)")
+
+    # Report how often the model cascades had to escalate, per role
+    for line in CascadeBackend.report():
+        print(line)
+
+    # Report how much the compact transcripts saved on the summarizer calls
+    if summarizer_tokens['full'] > 0:
+        saved = summarizer_tokens['full'] - summarizer_tokens['compact']
+        print(f"Summarizer input: {summarizer_tokens['compact']} tokens instead of "
+              f"{summarizer_tokens['full']} for the full history ({saved / summarizer_tokens['full']:.1%} saved)")
 
 if __name__ == '__main__':
     main()
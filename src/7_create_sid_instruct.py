@@ -1,3 +1,4 @@
+import argparse
 import json
 import os
 import random
@@ -8,6 +9,7 @@ from tqdm import tqdm
 
 # Local imports
 from utils import SceneGraph, load_3dssg
+from utils.summary import is_malformed, repair_summary
 
 
 def create_sample(messages):
@@ -113,6 +115,12 @@ def create_scenario_objects(scene_graph, scenario, pruned_scene_graph):
 
 
 def create_instruction_sample(scene_graph, scenario, pruned_scene_graph, instructions):
+    # Summaries that are not valid JSON are repaired if possible, and skipped otherwise
+    if is_malformed(instructions):
+        instructions = repair_summary(instructions)
+        if instructions is None:
+            return [], None
+
     instructions = list(json.loads(instructions).values())
     instructions_ = ''
     for i, instruction in enumerate(instructions):
@@ -200,7 +208,7 @@ def jsonl2gemma(infile, outfile):
         f.write(converted)
 
 
-def create_sid_instruct(sid_path):
+def create_sid_instruct(sid_path, use_cache=False):
     # Define paths.
     scenarios_file = os.path.join(sid_path, 'raw', 'scenarios_refined.json')
     instructions_file = os.path.join(sid_path, 'instructions_lq.json')
@@ -210,7 +218,7 @@ def create_sid_instruct(sid_path):
     assert os.path.exists(instructions_file), f"{instructions_file} not found."
 
     # Load data.
-    objects, relations = load_3dssg(os.path.join(sid_path, 'raw'))
+    objects, relations = load_3dssg(os.path.join(sid_path, 'raw'), use_cache=use_cache)
     ssg = {
         k: SceneGraph(**{
             'objects': v,
@@ -248,13 +256,8 @@ def create_sid_instruct(sid_path):
     test_samples = []
     num_train_scenarios = 0
     num_test_scenarios = 0
+    num_malformed = 0
     for (scan_id, scenario), instruct in tqdm(instructions.items()):
-        # Count scenarios.
-        if scan_id in train_scans:
-            num_train_scenarios += 1
-        else:
-            num_test_scenarios += 1
-
         samples = []
 
         scene_graph = ssg[scan_id]
@@ -263,31 +266,44 @@ def create_sid_instruct(sid_path):
         # samples.append(create_scene_graph_pruning(scene_graph, scenario, pruned_scene_graph))
         # samples.extend(create_scenario_objects(scene_graph, scenario, pruned_scene_graph))
 
-        instruct_ = instruct['instructions']
-        s, instruct_ = create_instruction_sample(scene_graph, scenario, pruned_scene_graph, instruct_)
-        samples.extend(s)
+        # Every branch of a forked dialogue is a variant of the instructions with its own samples.
+        for dialogue in [instruct] + instruct.get('branches', []):
+            s, instruct_ = create_instruction_sample(scene_graph, scenario, pruned_scene_graph, dialogue['instructions'])
+            if instruct_ is None:
+                num_malformed += 1
+                continue
+            samples.extend(s)
 
-        conversation = instruct['conversation'].copy()
+            conversation = dialogue['conversation'].copy()
 
-        # Remove the first system message.
-        conversation.pop(0)
+            # Remove the first system message.
+            conversation.pop(0)
 
-        # If the last message is a user message, remove it.
-        if conversation[-1]['role'] == 'user':
-            conversation.pop()
+            # If the last message is a user message, remove it.
+            if conversation[-1]['role'] == 'user':
+                conversation.pop()
 
-        conversation.extend([
-            {
-                "role": "user",
-                "content": f"Thank you. I think I have all the information I need to perform the task: {scenario}. Can you summarize the steps?"
-            },
-            {
-                "role": "assistant",
-                "content": instruct_
-            }
-        ])
+            conversation.extend([
+                {
+                    "role": "user",
+                    "content": f"Thank you. I think I have all the information I need to perform the task: {scenario}. Can you summarize the steps?"
+                },
+                {
+                    "role": "assistant",
+                    "content": instruct_
+                }
+            ])
+
+            samples.append(create_sample(conversation))
 
-        samples.append(create_sample(conversation))
+        if len(samples) == 0:
+            continue
+
+        # Count scenarios.
+        if scan_id in train_scans:
+            num_train_scenarios += 1
+        else:
+            num_test_scenarios += 1
 
         if scan_id in train_scans:
             train_samples.extend(samples)
@@ -296,6 +312,7 @@ def create_sid_instruct(sid_path):
 
     print(f"Train scenarios: {num_train_scenarios}")
     print(f"Test scenarios: {num_test_scenarios}")
+    print(f"Skipped {num_malformed} dialogues with malformed instructions")
 
     # Save samples.
     print(f"Writing train samples: {len(train_samples)}")
@@ -333,5 +350,14 @@ def create_sid_instruct(sid_path):
     print(f"Test total tokens: {in_tokens + out_tokens:.2f}M")
 
 
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cache', action='store_true',
+                        help="Load the 3DSSG objects and relationships from a binary cache in the "
+                             "raw data directory, which is built on the first run")
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
-    create_sid_instruct('data/3DSSG')
+    args = parse_args()
+    create_sid_instruct('data/3DSSG', use_cache=args.cache)
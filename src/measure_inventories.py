@@ -0,0 +1,79 @@
+import argparse
+import json
+import os
+
+from tqdm import tqdm
+
+# Local imports
+from utils.inventory import pack_inventory
+from utils.tokens import count_tokens
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare the token counts of the raw and packed object lists "
+                                                 "of the scenario prompts.")
+    parser.add_argument('--data_dir', type=str,
+                        default="data/3DSSG/raw/",
+                        help="Path to the 3DSSG dataset")
+    parser.add_argument('--encoding', type=str, default="cl100k_base",
+                        help="tiktoken encoding used for counting tokens")
+    parser.add_argument('--max_samples', type=int, default=None,
+                        help="Only measure the first N scans")
+    parser.add_argument('--budget', type=int, default=None,
+                        help="Token budget of the packed inventories (see --object_budget in "
+                             "src/1_generate_scenarios.py)")
+    parser.add_argument('--max_attributes', type=int, default=2,
+                        help="Maximum number of attributes kept per label")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    # Load the objects of each scan (as listed in the scenario prompts)
+    objects_file = os.path.join(args.data_dir, "objects.json")
+    with open(objects_file, 'r') as f:
+        scans = json.load(f)['scans'][:args.max_samples]
+    print(f"Loaded {len(scans)} scans from {objects_file}")
+
+    raw_tokens = []
+    packed_tokens = []
+    num_truncated = 0
+    num_dropped = 0
+    num_labels = 0
+    for item in tqdm(scans, desc="Counting tokens"):
+        objects = [{
+            'label': o['label'],
+            'affordances': o.get('affordances', []),
+            'attributes': o['attributes'],
+        } for o in item['objects']]
+        raw_tokens.append(count_tokens(str(objects), args.encoding))
+
+        inventory, dropped = pack_inventory(objects, max_tokens=args.budget, max_attributes=args.max_attributes,
+                                            encoding=args.encoding)
+        packed_tokens.append(count_tokens(inventory, args.encoding))
+        num_labels += len({o['label'] for o in objects})
+        if dropped > 0:
+            num_truncated += 1
+            num_dropped += dropped
+
+    if len(scans) == 0:
+        return
+
+    # Print a summary table
+    raw_total = sum(raw_tokens)
+    print()
+    print(f"{'Format':<10} {'Total':>12} {'Mean':>8} {'Max':>8} {'Saved':>8}")
+    for name, tokens in (('raw', raw_tokens), ('packed', packed_tokens)):
+        total = sum(tokens)
+        print(f"{name:<10} {total:>12} {total / len(scans):>8.1f} {max(tokens):>8} "
+              f"{1 - total / max(raw_total, 1):>8.1%}")
+
+    if args.budget is not None:
+        print()
+        print(f"Budget of {args.budget} tokens: {num_truncated} of {len(scans)} inventories truncated, "
+              f"{num_dropped} of {num_labels} labels dropped")
+
+
+if __name__ == '__main__':
+    main()
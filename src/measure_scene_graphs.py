@@ -0,0 +1,83 @@
+import argparse
+import json
+import os
+
+from tqdm import tqdm
+
+# Local imports
+from utils import SceneGraph
+from utils.relevance import trim_scene_graph
+from utils.tokens import count_tokens
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare the token counts of the scene graph serialization modes.")
+    parser.add_argument('--data_dir', type=str,
+                        default="data/3DSSG/raw/",
+                        help="Path to the 3DSSG dataset")
+    parser.add_argument('--encoding', type=str, default="cl100k_base",
+                        help="tiktoken encoding used for counting tokens")
+    parser.add_argument('--max_samples', type=int, default=None,
+                        help="Only measure the first N samples")
+    parser.add_argument('--budget', type=int, default=None,
+                        help="Also report how the scene graphs are trimmed to this token budget "
+                             "(see `scene_graph_budget` in configs/oracle.py)")
+    parser.add_argument('--budget_mode', type=str, default='default', choices=SceneGraph.SERIALIZATION_MODES,
+                        help="Serialization mode used with the token budget")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    # Load the scenario-specific scene graphs (as sent to the Oracle)
+    scenarios_file = os.path.join(args.data_dir, "scenarios_refined.json")
+    with open(scenarios_file, 'r') as f:
+        dataset = json.load(f)['scans'][:args.max_samples]
+    print(f"Loaded {len(dataset)} samples from {scenarios_file}")
+
+    # Count the tokens of each serialization
+    modes = SceneGraph.SERIALIZATION_MODES
+    tokens = {mode: [] for mode in modes}
+    trimmed_tokens = []
+    num_trimmed = 0
+    objects_kept = []
+    for item in tqdm(dataset, desc="Counting tokens"):
+        scene_graph = SceneGraph(**{
+            "objects": item['scenario_objects'],
+            "relations": item['scenario_relations']
+        })
+        for mode in modes:
+            tokens[mode].append(count_tokens(scene_graph.serialize(mode), args.encoding))
+
+        if args.budget is not None:
+            trimmed = trim_scene_graph(scene_graph, item['scenario'], args.budget,
+                                       mode=args.budget_mode, encoding=args.encoding)
+            trimmed_tokens.append(count_tokens(trimmed.serialize(args.budget_mode), args.encoding))
+            if trimmed is not scene_graph:
+                num_trimmed += 1
+                objects_kept.append(len(trimmed.objects) / max(len(scene_graph.objects), 1))
+
+    if len(dataset) == 0:
+        return
+
+    # Print a summary table
+    baseline = sum(tokens['default'])
+    print()
+    print(f"{'Mode':<10} {'Total':>12} {'Mean':>8} {'Max':>8} {'Saved':>8}")
+    for mode in modes:
+        total = sum(tokens[mode])
+        print(f"{mode:<10} {total:>12} {total / len(dataset):>8.1f} {max(tokens[mode]):>8} "
+              f"{1 - total / max(baseline, 1):>8.1%}")
+
+    if args.budget is not None:
+        total = sum(trimmed_tokens)
+        print()
+        print(f"Budget of {args.budget} tokens ({args.budget_mode}): {num_trimmed} of {len(dataset)} scene graphs trimmed")
+        print(f"- Tokens after trimming: {total} in total, {total / len(dataset):.1f} mean, {max(trimmed_tokens)} max")
+        if num_trimmed > 0:
+            print(f"- Objects kept in the trimmed scene graphs: {sum(objects_kept) / num_trimmed:.1%} on average")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import argparse
+import json
+import os
+
+# Local imports
+from utils import CheckpointLog, parse_shard, shard_path
+from utils.sharding import shard_of
+
+
+STAGES = {
+    # Stage 1: one record per scan
+    'scenarios': dict(
+        output='raw/scenarios.json',
+        field='scans',
+        key=lambda item: item['scan'],
+        scan=lambda item: item['scan'],
+    ),
+    # Stage 5: one record per scenario
+    'instructions': dict(
+        output='instructions_lq.json',
+        field=None,
+        key=lambda item: f"{item['scan_id']}-{item['scenario']}",
+        scan=lambda item: item['scan_id'],
+    ),
+}
+
+
+def load_expected_keys(stage, data_dir):
+    """ Keys of all records the stage is expected to generate. """
+    if stage == 'scenarios':
+        with open(os.path.join(data_dir, 'raw', 'objects.json'), 'r') as f:
+            return {item['scan'] for item in json.load(f)['scans']}
+
+    with open(os.path.join(data_dir, 'raw', 'scenarios_refined.json'), 'r') as f:
+        return {f"{item['scan']}-{item['scenario']}" for item in json.load(f)['scans']}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Merge the shard files of a generation stage.")
+    parser.add_argument('stage', type=str, choices=list(STAGES),
+                        help="Generation stage whose shards to merge")
+    parser.add_argument('--num_shards', type=int, required=True,
+                        help="Number of shards the stage was split into")
+    parser.add_argument('--data_dir', type=str,
+                        default="data/3DSSG",
+                        help="Path to the 3DSSG dataset")
+    parser.add_argument('--force', action='store_true',
+                        help="Merge even if some shard files are missing")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    stage = STAGES[args.stage]
+    output_file = os.path.join(args.data_dir, stage['output'])
+
+    # Records that are already merged are kept, unless a shard has a newer version
+    merged = CheckpointLog(output_file, key=stage['key'], field=stage['field'])
+    records = merged.load()
+    print(f"Loaded {len(records)} records from {output_file}")
+
+    # Merge the shards (including any records still in their checkpoint logs)
+    num_duplicates = 0
+    missing_shards = []
+    for index in range(args.num_shards):
+        shard = parse_shard(f"{index}/{args.num_shards}")
+        shard_file = shard_path(output_file, shard)
+        shard_log = CheckpointLog(shard_file, key=stage['key'], field=stage['field'])
+        shard_records = shard_log.load()
+        if len(shard_records) == 0 and not os.path.exists(shard_file):
+            missing_shards.append(index)
+            print(f"- Shard {index}: not found ({shard_file})")
+            continue
+
+        num_misplaced = 0
+        for record in shard_records:
+            if shard_of(stage['scan'](record), args.num_shards) != index:
+                num_misplaced += 1
+            if stage['key'](record) in merged:
+                num_duplicates += 1
+        merged.reset(list(merged.records.values()) + shard_records)
+
+        print(f"- Shard {index}: {len(shard_records)} records from {shard_file}")
+        if num_misplaced > 0:
+            print(f"  [WARNING] {num_misplaced} records do not belong to this shard")
+
+    if len(missing_shards) > 0 and not args.force:
+        print(f"Missing shards: {missing_shards}. Use --force to merge anyway.")
+        return
+
+    # Validate the coverage of the merged records
+    expected_keys = load_expected_keys(args.stage, args.data_dir)
+    merged_keys = set(merged.records)
+    missing_keys = expected_keys - merged_keys
+    unknown_keys = merged_keys - expected_keys
+    print(f"Merged {len(merged_keys)} records ({num_duplicates} duplicates replaced)")
+    print(f"- Covered {len(expected_keys) - len(missing_keys)} of {len(expected_keys)} expected records")
+    if len(missing_keys) > 0:
+        print(f"- [WARNING] {len(missing_keys)} records are missing, e.g. {sorted(missing_keys)[:3]}")
+    if len(unknown_keys) > 0:
+        print(f"- [WARNING] {len(unknown_keys)} records are not in the dataset, e.g. {sorted(unknown_keys)[:3]}")
+
+    # Save the merged records
+    merged.close()
+    print(f"Saved merged records to {output_file}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 """ LLM prompting package """
 
-from .backend import HuggingFaceBackend, OpenAIBackend, build_prompter, build_llm_from_cfg
+from .backend import CascadeBackend, HuggingFaceBackend, OpenAIBackend, build_prompter, build_llm_from_cfg, prompt_batch
 from .prompt import Prompt
 from .llm import LLM
@@ -1,7 +1,8 @@
 import os
 from typing import Dict, Union
 
-from .base_backend import BaseBackend
+from .base_backend import BaseBackend, prompt_batch
+from .cascade import CascadeBackend
 from .groq import GroqBackend
 from .huggingface import HuggingFaceBackend
 from .openai import OpenAIBackend
@@ -9,13 +10,16 @@ from .openai import OpenAIBackend
 
 __all__ = [
     "BaseBackend",
+    "CascadeBackend",
     "GroqBackend",
     "HuggingFaceBackend",
     "OpenAIBackend",
+    "prompt_batch",
 ]
 
 __dict__ = {
     "BaseBackend": BaseBackend,
+    "CascadeBackend": CascadeBackend,
     "GroqBackend": GroqBackend,
     "HuggingFaceBackend": HuggingFaceBackend,
     "OpenAIBackend": OpenAIBackend,
@@ -1,7 +1,8 @@
 import logging
 import time
 import traceback
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
 
 from ..prompt import Prompt
 
@@ -21,6 +22,10 @@ class BaseBackend:
 
     BACKOFF_TIME = 10 # seconds
 
+    # Whether the backend can let the model call function tools (see `set_tools`)
+    SUPPORTS_TOOLS = False
+    MAX_TOOL_ROUNDS = 8
+
     def __init__(self,
                  temperature: float = 0.5,
                  repetition_penalty: float = 1.0,
@@ -38,14 +43,78 @@ class BaseBackend:
         self.max_retries = max(max_retries, 0)
         self.timeout = timeout
 
+        # Function tools the model can call, and the function that runs the calls
+        self.tools = None
+        self.tool_handler = None
+
     def _ask(self, prompt: Prompt) -> List[str]:
         raise NotImplementedError
 
+    def set_tools(self, tools: List[Dict], handler: Callable[[str, str], str]) -> None:
+        """ Let the model call function tools before it answers.
+
+        Args:
+            tools: Specifications of the tools in the OpenAI format.
+            handler: Function that runs a tool call, given the name of the tool and
+                its arguments as a JSON string, and returns the result as a string.
+        """
+        if not self.SUPPORTS_TOOLS:
+            raise NotImplementedError(f"{self.__class__.__name__} does not support tools.")
+
+        self.tools = tools
+        self.tool_handler = handler
+
+    def _run_tool_calls(self, message: Any, messages: List[Dict]) -> bool:
+        """ Run the tool calls of a chat completion message and add them to the messages.
+
+        Returns:
+            True if the message had tool calls, i.e. the model has to be asked again.
+        """
+        tool_calls = getattr(message, 'tool_calls', None)
+        if not tool_calls:
+            return False
+
+        messages.append({
+            "role": "assistant",
+            "content": message.content,
+            "tool_calls": [{
+                "id": call.id,
+                "type": "function",
+                "function": {"name": call.function.name, "arguments": call.function.arguments},
+            } for call in tool_calls],
+        })
+        for call in tool_calls:
+            messages.append({
+                "role": "tool",
+                "tool_call_id": call.id,
+                "content": self.tool_handler(call.function.name, call.function.arguments),
+            })
+        return True
+
+    def stream(self, prompt: Prompt) -> Iterator[str]:
+        """ Stream the response to a prompt in chunks of text.
+
+        Backends that cannot stream yield the whole response as a single chunk.
+        Closing the iterator early (e.g. by breaking out of a loop over it) stops
+        the generation in backends that stream.
+        """
+        responses = self.prompt(prompt)
+        if responses:
+            yield responses[0]
+
     def prompt(self, prompt: Prompt) -> List[str]:
+        return self._retry(self._ask, prompt)
+
+    def _retry(self, fn: Callable, *args: Any) -> Any:
+        """ Call a function of the API, retrying with exponential backoff on failure.
+
+        Returns:
+            The result of the function, or None if all tries failed.
+        """
         current_try = 0
         while current_try <= self.max_retries:
             try:
-                return self._ask(prompt)
+                return fn(*args)
             except Exception as e:
                 # Log exception
                 logging.error(f"[{self.__class__.__name__}] {type(e)}: {e}")
@@ -60,3 +129,35 @@ class BaseBackend:
                 # Wait and retry
                 time.sleep(backoff)
                 current_try = current_try + 1
+
+
+def prompt_batch(requests: Sequence[Tuple[BaseBackend, Prompt]],
+                 max_workers: Optional[int] = None,
+                 ) -> List[Union[List[str], Exception]]:
+    """ Send a batch of prompts, each to its own backend, in a single round.
+
+    All requests are dispatched concurrently, so that a server with continuous
+    batching (e.g., vLLM) sees the whole batch at once.
+
+    Args:
+        requests: List of (backend, prompt) pairs.
+        max_workers: Maximum number of concurrent API calls. Defaults to one per request.
+
+    Returns:
+        The responses for each request, in order. If a request failed, the exception
+        it raised is returned in its place.
+    """
+    results = [None] * len(requests)
+    if len(requests) == 0:
+        return results
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(requests)) as executor:
+        futures = [executor.submit(backend.prompt, prompt) for backend, prompt in requests]
+        for idx, future in enumerate(futures):
+            try:
+                results[idx] = future.result()
+            except Exception as e:
+                logging.error(f"[prompt_batch] {type(e)}: {e}")
+                results[idx] = e
+
+    return results
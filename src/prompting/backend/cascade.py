@@ -0,0 +1,219 @@
+""" Cascade of LLMs that escalates to larger models when a response is invalid. """
+
+# Python imports
+import json
+import logging
+import threading
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Sequence, Union
+
+# Local imports
+from ..prompt import Prompt
+from .base_backend import BaseBackend
+
+
+# A validator returns an error message for an invalid response, or None if it is valid
+Validator = Callable[[str], Optional[str]]
+
+
+def validate_non_empty(response: str) -> Optional[str]:
+    if not response or not response.strip():
+        return 'empty'
+    return None
+
+
+def validate_json(response: str) -> Optional[str]:
+    """ Check that the response contains a non-empty JSON object (e.g., numbered steps). """
+    if not response:
+        return 'empty'
+
+    start, end = response.find('{'), response.rfind('}')
+    if start == -1 or end < start:
+        return 'no JSON object'
+
+    try:
+        data = json.loads(response[start:end + 1])
+    except json.JSONDecodeError:
+        return 'unparsable JSON'
+
+    if not isinstance(data, dict) or len(data) == 0:
+        return 'empty JSON object'
+    return None
+
+
+VALIDATORS = {
+    'non_empty': validate_non_empty,
+    'json': validate_json,
+}
+
+
+class CascadeBackend(BaseBackend):
+    """ Cascade of backends, from the smallest (fastest) to the largest model.
+
+    Every prompt is first sent to the first backend. If its response fails
+    validation (or the request fails), the prompt is sent to the next backend,
+    and so on. The response of the last backend is returned as is. All backends
+    share the same message history, which only keeps the accepted responses.
+
+    The escalations are counted per cascade name (e.g., the role of the agent)
+    across all instances, see `CascadeBackend.report`.
+
+    Example config:
+        backend_cfg=dict(
+            type="CascadeBackend",
+            init_cfg=dict(
+                name='robot',
+                validators=['non_empty'],
+                stages=[
+                    dict(type="GroqBackend", init_cfg=dict(model='small-model')),
+                    dict(type="GroqBackend", init_cfg=dict(model='large-model')),
+                ],
+            ),
+        )
+
+    Args:
+        stages (list): Configs of the backends (`type` and `init_cfg`), in the
+            order in which they are tried.
+        validators (list): Names of built-in validators (see `VALIDATORS`) or
+            callables returning an error message for an invalid response, or None
+            if it is valid. More validators can be added with `add_validator`.
+        name (str): Name under which the escalations are counted. Defaults to
+            `cascade`.
+    """
+
+    # Escalation statistics per cascade name
+    _stats: Dict[str, Dict] = {}
+    _stats_lock = threading.Lock()
+
+    def __init__(self,
+                 stages: Sequence[Dict],
+                 validators: Sequence[Union[str, Validator]] = (),
+                 name: str = 'cascade',
+                 **kwargs) -> None:
+        super().__init__(**kwargs)
+        from . import build_prompter
+
+        if len(stages) == 0:
+            raise ValueError("A cascade needs at least one backend.")
+
+        self.name = name
+        self.stages = [build_prompter(**cfg) for cfg in stages]
+        self.models = [getattr(stage, 'model', type(stage).__name__) for stage in self.stages]
+        self.validators = []
+        for validator in validators:
+            self.add_validator(validator)
+
+    def add_validator(self, validator: Union[str, Validator]) -> None:
+        if isinstance(validator, str):
+            if validator not in VALIDATORS:
+                raise ValueError(f"Unknown validator: {validator}. Available validators: {list(VALIDATORS)}")
+            validator = VALIDATORS[validator]
+        self.validators.append(validator)
+
+    @property
+    def primary(self) -> BaseBackend:
+        return self.stages[0]
+
+    @property
+    def system_prompt(self) -> Optional[Dict]:
+        return getattr(self.primary, 'system_prompt', None)
+
+    @system_prompt.setter
+    def system_prompt(self, system_prompt: Prompt) -> None:
+        for stage in self.stages:
+            stage.system_prompt = system_prompt
+
+    @property
+    def messages(self) -> List[Dict]:
+        return getattr(self.primary, 'messages', [])
+
+    @messages.setter
+    def messages(self, messages: List[Dict]) -> None:
+        self._sync_history(messages)
+
+    def _sync_history(self, messages: List[Dict]) -> None:
+        for stage in self.stages:
+            if hasattr(stage, 'messages'):
+                stage.messages = list(messages)
+
+    def _build_messages(self, prompt: Prompt) -> List[Dict]:
+        return self.primary._build_messages(prompt)
+
+    def _save_history(self, messages: List[Dict], response: str) -> None:
+        self.primary._save_history(messages, response)
+        self._sync_history(self.messages)
+
+    def set_tools(self, tools: List[Dict], handler: Callable[[str, str], str]) -> None:
+        for stage in self.stages:
+            stage.set_tools(tools, handler)
+
+    def validate(self, response: str) -> Optional[str]:
+        """ Return the first validation error of the response, or None if it is valid. """
+        for validator in self.validators:
+            error = validator(response)
+            if error is not None:
+                return error
+        return None
+
+    def _ask(self, prompt: Prompt) -> List[str]:
+        history = list(self.messages)
+        for level, stage in enumerate(self.stages):
+            last = level == len(self.stages) - 1
+            self._sync_history(history)
+            try:
+                responses = stage.prompt(prompt)
+            except Exception as e:
+                if last:
+                    raise
+                error = f"{type(e).__name__}"
+            else:
+                error = 'no response' if not responses else self.validate(responses[0])
+                if error is None or last:
+                    self._sync_history(getattr(stage, 'messages', history))
+                    self._record(level, error)
+                    return responses
+
+            logging.info(f"[{self.__class__.__name__}:{self.name}] Escalating from "
+                         f"{self.models[level]} to {self.models[level + 1]} ({error})")
+            self._record_escalation(level, error)
+
+    def prompt(self, prompt: Prompt) -> List[str]:
+        # Each stage handles its own retries
+        return self._ask(prompt)
+
+    def _entry(self) -> Dict:
+        return self._stats.setdefault(self.name, {
+            'models': self.models, 'calls': 0, 'answered_by': Counter(), 'escalations': Counter(), 'invalid': 0})
+
+    def _record(self, level: int, error: Optional[str]) -> None:
+        with self._stats_lock:
+            stats = self._entry()
+            stats['calls'] += 1
+            stats['answered_by'][level] += 1
+            if error is not None:
+                stats['invalid'] += 1
+
+    def _record_escalation(self, level: int, error: str) -> None:
+        with self._stats_lock:
+            self._entry()['escalations'][(level, error)] += 1
+
+    @classmethod
+    def stats(cls) -> Dict[str, Dict]:
+        """ Escalation statistics per cascade name. """
+        with cls._stats_lock:
+            return {name: dict(stats) for name, stats in cls._stats.items()}
+
+    @classmethod
+    def report(cls) -> List[str]:
+        """ Escalation rates per cascade name, as lines of text. """
+        lines = []
+        for name, stats in sorted(cls.stats().items()):
+            calls = stats['calls']
+            escalated = calls - stats['answered_by'][0]
+            lines.append(f"{name}: {calls} prompts, {escalated} escalated ({escalated / max(calls, 1):.1%}), "
+                         f"{stats['invalid']} still invalid")
+            for level, model in enumerate(stats['models']):
+                lines.append(f"  - {model}: answered {stats['answered_by'][level]}")
+            for (level, error), count in stats['escalations'].most_common():
+                lines.append(f"  - escalated from {stats['models'][level]}: {count}x {error}")
+        return lines
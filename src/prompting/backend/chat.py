@@ -0,0 +1,176 @@
+""" Shared implementation of the backends for OpenAI-compatible chat APIs. """
+
+# Python imports
+import logging
+from typing import Dict, Iterator, List, Optional
+
+# Local imports
+from ..prompt import Prompt
+from .base_backend import BaseBackend
+
+
+class ChatBackend(BaseBackend):
+    """ Base class for prompters that use an OpenAI-compatible API.
+
+    Keeps the chat history and runs chat completions, streamed completions and tool
+    calls. Subclasses create the OpenAI client in `self.client` and list the models
+    that use the legacy completions endpoint in `COMPLETION_MODELS`.
+
+    Args:
+        model (str): Model to use.
+    """
+
+    SUPPORTS_TOOLS = True
+
+    CHAT_MODELS = []
+    COMPLETION_MODELS = []
+
+    def __init__(self, model: str, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.client = None
+        self.model = model
+        self.system_prompt = None
+        self.messages = []
+        self.use_history = True
+
+    @property
+    def system_prompt(self) -> Optional[Prompt]:
+        return self._system_prompt
+
+    @system_prompt.setter
+    def system_prompt(self, system_prompt: Prompt) -> None:
+        assert system_prompt is None or system_prompt.role == "system", \
+            "System prompt must have role 'system'."
+
+        if system_prompt is None:
+            self._system_prompt = None
+        else:
+            self._system_prompt = {"role": system_prompt.role,
+                                   "content": system_prompt.build()}
+
+    def _parse_response(self, response: str) -> str:
+        return response
+
+    def _build_messages(self, prompt: Prompt) -> List[Dict]:
+        messages = []
+        if self.use_history:
+            messages.extend(self.messages)
+
+        # Add system prompt if it exists
+        if self.system_prompt and len(messages) == 0:
+            messages.append(self.system_prompt)
+
+        # Add user prompt
+        if prompt.image_url is not None and 'vision' in self.model:
+            prompt_content = {
+                "role": prompt.role,
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt.build(),
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": prompt.image_url
+                        }
+                    }
+                ]
+            }
+        else:
+            prompt_content = {
+                "role": prompt.role,
+                "content": prompt.build()
+            }
+        messages.append(prompt_content)
+        return messages
+
+    def _save_history(self, messages: List[Dict], response: str) -> None:
+        if self.use_history:
+            messages.append({"role": "assistant", "content": response})
+            self.messages = messages
+
+    def _ask_chat(self, prompt: Prompt) -> List[str]:
+        messages = self._build_messages(prompt)
+        num_messages = len(messages)
+
+        # Ask OpenAI, and run the tool calls of the model (if any) until it answers
+        kwargs = {}
+        for tool_round in range(self.MAX_TOOL_ROUNDS + 1):
+            if self.tools:
+                kwargs['tools'] = self.tools
+                kwargs['tool_choice'] = 'auto' if tool_round < self.MAX_TOOL_ROUNDS else 'none'
+            choices = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=self.temperature,
+                max_tokens=self.max_tokens,
+                frequency_penalty=self.repetition_penalty,
+                **kwargs,
+            ).choices
+            if not self._run_tool_calls(choices[0].message, messages):
+                break
+        responses = [c.message.content for c in choices]
+
+        # Save history and return the responses. The tool calls and their results are
+        # only needed for this answer, so they are left out of the history.
+        self._save_history(messages[:num_messages], responses[0])
+        return responses
+
+    def stream(self, prompt: Prompt) -> Iterator[str]:
+        # Tool calls and completion models are not streamed
+        if self.tools or self.model in self.COMPLETION_MODELS:
+            yield from super().stream(prompt)
+            return
+
+        # Opening the stream is retried like any other request
+        messages = self._build_messages(prompt)
+        response = self._retry(self._open_stream, messages)
+        if response is None:
+            return
+
+        # Closing the response cancels the request, which stops the generation on the server.
+        # If the connection fails midway, the stream ends with the chunks received so far.
+        chunks = []
+        try:
+            for event in response:
+                content = event.choices[0].delta.content if event.choices else None
+                if content:
+                    chunks.append(content)
+                    yield content
+        except Exception as e:
+            logging.error(f"[{self.__class__.__name__}] Stream interrupted: {type(e)}: {e}")
+        finally:
+            response.close()
+            self._save_history(messages, ''.join(chunks))
+
+    def _open_stream(self, messages: List[Dict]):
+        return self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            frequency_penalty=self.repetition_penalty,
+            stream=True,
+        )
+
+    def _ask_completion(self, prompt: Prompt) -> List[str]:
+        choices = self.client.completions.create(
+            model=self.model,
+            prompt=prompt.build(),
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+        ).choices
+        responses = [c.text for c in choices]
+        return responses
+
+    def _ask(self, prompt: Prompt) -> List[str]:
+        if self.model in self.COMPLETION_MODELS:
+            return self._ask_completion(prompt)
+        return self._ask_chat(prompt)
+
+    def prompt(self, prompt: Prompt) -> List[str]:
+        # OpenAI API handles retries internally, so we don't need to
+        # call out base class's `prompt` method which calls `self._ask`
+        # with a short exponential backoff.
+        return self._ask(prompt)
@@ -1,4 +1,4 @@
-from typing import Union
+from typing import Iterator, Union
 
 from .backend import build_llm_from_cfg
 from .prompt import Prompt
@@ -21,6 +21,7 @@ class LLM:
                 init_cfg = eval(f.read())
         elif not isinstance(init_cfg, dict):
             raise ValueError('init_cfg must be a path to a config file or a dictionary.')
+        self.init_cfg = init_cfg
 
         # Build the prompter
         self.backend = build_llm_from_cfg(init_cfg['backend_cfg'])
@@ -38,9 +39,18 @@ class LLM:
         if user_prompt_cfg:
             self.user_prompt = Prompt.from_cfg(user_prompt_cfg)
 
-    def prompt(self, prompt: Union[Prompt, str], role: str = 'user') -> str:
+    def as_prompt(self, prompt: Union[Prompt, str], role: str = 'user') -> Prompt:
         if isinstance(prompt, str):
             prompt = Prompt(prompt, role)
 
+        return prompt
+
+    def prompt(self, prompt: Union[Prompt, str], role: str = 'user') -> str:
+        prompt = self.as_prompt(prompt, role)
         response = self.backend.prompt(prompt)[0]
-        return response
\ No newline at end of file
+        return response
+
+    def stream(self, prompt: Union[Prompt, str], role: str = 'user') -> Iterator[str]:
+        """ Stream the response to a prompt in chunks of text (see `BaseBackend.stream`). """
+        prompt = self.as_prompt(prompt, role)
+        yield from self.backend.stream(prompt)
@@ -0,0 +1,138 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+from tqdm import tqdm
+
+# Local imports
+from prompting import LLM, CascadeBackend
+from utils import CheckpointLog
+from utils.conversation_store import ConversationStore
+from utils.summary import is_complete_dialogue, is_malformed, repair_summary
+from utils.transcript import summarizer_prompt
+
+
+# Load environment variables
+load_dotenv()
+
+
+def iter_dialogues(item):
+    """ The dialogues of a sample: the sample itself and the other branches of a forked dialogue.
+
+    Each dialogue has its own 'instructions' and 'conversation'.
+    """
+    yield 'main', item
+    for idx, branch in enumerate(item.get('branches', [])):
+        yield f"branch {idx + 1}", branch
+
+
+def summarize(summarizer_cfg, item, dialogue):
+    # Every request gets its own summarizer, since the backends keep a message history
+    summarizer = LLM(init_cfg=summarizer_cfg)
+    return summarizer.prompt(summarizer_prompt(dialogue['conversation'], item['scenario']))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Summarize deferred conversations and repair malformed "
+                                                 "summaries without rerunning the dialogues.")
+    parser.add_argument('--instructions_file', type=str,
+                        default="data/3DSSG/instructions_lq.json",
+                        help="Path to the generated instructions")
+    parser.add_argument('--summarizer_cfg', type=str,
+                        default="configs/summarizer.py",
+                        help="Config of the summarizer used to (re-)summarize the conversations. "
+                             "It may use a different model or endpoint than the dialogues.")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="Number of concurrent summarizer requests")
+    parser.add_argument('--output_dir', type=str,
+                        default="out/3DSSG_Correct_LQ_Filtered",
+                        help="Directory of the conversation store of stage 5. The new summaries of "
+                             "stored conversations are added to it (skipped if it does not exist).")
+    parser.add_argument('--local_only', action='store_true',
+                        help="Only repair the JSON locally, without calling the summarizer")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    # Load the instructions (including samples still in the checkpoint logs)
+    checkpoint = CheckpointLog(args.instructions_file, key=lambda item: f"{item['scan_id']}-{item['scenario']}")
+    instructions = checkpoint.load()
+    print(f"Loaded {len(instructions)} instructions from {args.instructions_file}")
+
+    # Summaries deferred by stage 5 (--defer_summaries) are still missing.
+    # Every branch of a forked dialogue has a summary of its own.
+    dialogues = [(item, name, dialogue) for item in instructions for name, dialogue in iter_dialogues(item)]
+    pending = [entry for entry in dialogues if entry[2]['instructions'] is None]
+    malformed = [entry for entry in dialogues
+                 if entry[2]['instructions'] is not None and is_malformed(entry[2]['instructions'])]
+    print(f"Found {len(pending)} deferred and {len(malformed)} malformed summaries")
+
+    # The conversation store keeps the summaries of the exported conversations up to date
+    store = ConversationStore(args.output_dir) if os.path.isdir(args.output_dir) else None
+
+    def save(item, dialogue, summary, repair):
+        dialogue['summary_repair'] = repair
+        dialogue['instructions'] = summary
+        checkpoint.append(item)
+        if store is not None and dialogue.get('conversation_id') is not None:
+            store.update_summary(dialogue['conversation_id'], summary)
+
+    # First, try to repair the JSON locally
+    num_repaired = 0
+    queue = []
+    for item, name, dialogue in pending + malformed:
+        summary = repair_summary(dialogue['instructions'])
+        if summary is not None:
+            save(item, dialogue, summary, 'json')
+            num_repaired += 1
+        elif is_complete_dialogue(dialogue.get('conversation')):
+            queue.append((item, name, dialogue))
+    print(f"- Repaired {num_repaired} summaries locally")
+    print(f"- {len(pending) + len(malformed) - num_repaired - len(queue)} samples need a new dialogue (incomplete conversation)")
+
+    # Then, (re-)summarize the stored conversations of the rest, with up to
+    # `workers` requests in flight and each summary saved as soon as it arrives
+    num_summarized = 0
+    num_failed = 0
+    if not args.local_only and len(queue) > 0:
+        # The executor is not used as a context manager, which would wait for all queued
+        # summaries on an interrupt. Queued summaries are cancelled instead.
+        executor = ThreadPoolExecutor(max_workers=args.workers)
+        try:
+            futures = {executor.submit(summarize, args.summarizer_cfg, item, dialogue): (item, name, dialogue)
+                       for item, name, dialogue in queue}
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Summarizing"):
+                item, name, dialogue = futures[future]
+                try:
+                    summary = future.result()
+                except Exception as e:
+                    print(f"Error summarizing {item['scan_id']}-{item['scenario']} ({name}): {e}")
+                    num_failed += 1
+                    continue
+
+                if is_malformed(summary):
+                    summary = repair_summary(summary)
+                if summary is None:
+                    num_failed += 1
+                    continue
+
+                save(item, dialogue, summary, 'deferred' if dialogue['instructions'] is None else 'summarizer')
+                num_summarized += 1
+        except KeyboardInterrupt:
+            print("Interrupted. Saving the progress...")
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        print(f"- Summarized {num_summarized} conversations ({num_failed} failed)")
+        for line in CascadeBackend.report():
+            print(line)
+
+    # Save the repaired instructions
+    checkpoint.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,6 @@
+from .checkpoint import CheckpointLog
+from .ledger import TaskLedger
 from .scene_graph import SceneGraph
-from .ssg import load_objects, load_relationships, load_3dssg
+from .scene_graph_index import SceneGraphIndex
+from .ssg import iter_scans, load_objects, load_relationships, load_3dssg
+from .sharding import in_shard, parse_shard, shard_path
@@ -0,0 +1,238 @@
+import fcntl
+import glob
+import json
+import os
+
+
+class CheckpointLog:
+    """ Append-only checkpoint log for records generated one at a time.
+
+    Records are appended to a JSONL log next to the final JSON file instead of
+    rewriting the whole file after every record. The log is periodically compacted
+    into the final JSON file with an atomic replace, so that a crash can at most lose
+    the last partially written line of the log.
+
+    Several processes can share the same final file if each one writes its own log
+    (see `log_path`). Loading replays the logs of all processes. Compaction holds a
+    lock on the final file and only merges the records this process has added or
+    removed since loading into what is already on disk, so that the stale copies
+    of other processes' records are never written back.
+
+    Args:
+        path (str): Path to the final JSON file.
+        key (callable): Function mapping a record to its unique key. When several
+            records have the same key, the last one wins.
+        field (str): If given, the final file is a JSON object holding the list of
+            records under this field (e.g., `{"scans": [...]}`) instead of a plain
+            list of records.
+        log_path (str): Path to the JSONL log. Defaults to `path` with a `.jsonl`
+            extension. Logs of other processes must be named `<stem>.<name>.jsonl`.
+        fsync_every (int): Number of appended records after which the log is synced
+            to disk. Defaults to 10.
+        compact_every (int): Number of appended records after which the log is
+            compacted into the final JSON file. Set to 0 to only compact on `close`.
+            Defaults to 500.
+    """
+
+    def __init__(self, path, key, field=None, log_path=None, fsync_every=10, compact_every=500):
+        self.path = path
+        self.key = key
+        self.field = field
+        self.stem = os.path.splitext(path)[0]
+        self.log_path = log_path or f"{self.stem}.jsonl"
+        self.fsync_every = max(fsync_every, 1)
+        self.compact_every = compact_every
+
+        self.records = {}
+        self._changed = set()  # Keys added or replaced by this process since the last compaction
+        self._removed = {}     # Records removed by this process since the last compaction, by key
+        self._log_file = None
+        self._num_unsynced = 0
+        self._num_uncompacted = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def _read_final(self):
+        if not os.path.exists(self.path):
+            return []
+
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        return data[self.field] if self.field else data
+
+    def load(self):
+        """ Load the records from the final JSON file and replay the logs on top.
+
+        Returns:
+            The list of records, in the order they were first added.
+        """
+        self.records = {}
+        self._changed = set()
+        self._removed = {}
+        for record in self._read_final():
+            self.records[self.key(record)] = record
+
+        log_paths = sorted(set(glob.glob(f"{self.stem}.jsonl") + glob.glob(f"{self.stem}.*.jsonl")))
+        for log_path in log_paths:
+            for record in self.read_log(log_path):
+                key = self.key(record)
+                self.records[key] = record
+                # Our own log is truncated by the next compaction, so its records must be merged
+                if os.path.abspath(log_path) == os.path.abspath(self.log_path):
+                    self._changed.add(key)
+
+        return list(self.records.values())
+
+    @staticmethod
+    def read_log(log_path):
+        """ Read all complete records from a JSONL log.
+
+        A truncated last line (e.g., from a crash in the middle of a write) is skipped.
+        """
+        if not os.path.exists(log_path):
+            return []
+
+        records = []
+        with open(log_path, 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        return records
+
+    @staticmethod
+    def truncate_torn_tail(log_path):
+        """ Cut a JSONL log back to its last complete line.
+
+        A crash in the middle of a write leaves a partial last line. New records
+        would be appended to that line and be lost with it, so it is removed first.
+        """
+        if not os.path.exists(log_path):
+            return
+
+        with open(log_path, 'rb+') as f:
+            size = f.seek(0, os.SEEK_END)
+            end = size
+            while end > 0:
+                start = max(end - 4096, 0)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b'\n')
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end < size:
+                f.truncate(end)
+
+    def reset(self, records):
+        """ Replace the records in memory, e.g., after filtering the loaded records.
+
+        Records that are dropped here are also dropped from the final file with the
+        next compaction, unless another process has replaced them on disk in the
+        meantime.
+        """
+        records = {self.key(record): record for record in records}
+        for key, record in self.records.items():
+            if key not in records:
+                self._removed.setdefault(key, record)
+                self._changed.discard(key)
+        for key, record in records.items():
+            if key not in self.records or self.records[key] != record:
+                self._changed.add(key)
+                self._removed.pop(key, None)
+        self.records = records
+        self._num_uncompacted += 1
+
+    def append(self, record):
+        """ Add a record and append it to the log. """
+        key = self.key(record)
+        self.records[key] = record
+        self._changed.add(key)
+        self._removed.pop(key, None)
+
+        if self._log_file is None:
+            log_dir = os.path.dirname(self.log_path)
+            if log_dir:
+                os.makedirs(log_dir, exist_ok=True)
+            self.truncate_torn_tail(self.log_path)
+            self._log_file = open(self.log_path, 'a')
+
+        self._log_file.write(json.dumps(record) + '\n')
+        self._log_file.flush()
+
+        self._num_unsynced += 1
+        if self._num_unsynced >= self.fsync_every:
+            self.sync()
+
+        self._num_uncompacted += 1
+        if self.compact_every > 0 and self._num_uncompacted >= self.compact_every:
+            self.compact()
+
+    def sync(self):
+        """ Force the appended records to disk. """
+        if self._log_file is not None and self._num_unsynced > 0:
+            os.fsync(self._log_file.fileno())
+        self._num_unsynced = 0
+
+    def compact(self):
+        """ Atomically merge all records into the final JSON file and truncate the log. """
+        self.sync()
+
+        final_dir = os.path.dirname(self.path)
+        if final_dir:
+            os.makedirs(final_dir, exist_ok=True)
+
+        with open(f"{self.path}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            # Keep the records other processes have compacted in the meantime, and only
+            # drop removed records that no other process has replaced since
+            records = {self.key(record): record for record in self._read_final()}
+            for key in self._changed:
+                records[key] = self.records[key]
+            for key, removed in self._removed.items():
+                if key in records and records[key] == removed:
+                    del records[key]
+            self.records = records
+            self._changed = set()
+            self._removed = {}
+
+            data = list(records.values())
+            if self.field:
+                data = {self.field: data}
+
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+        # The log is only truncated once its records are safely in the final file.
+        # If we crash in between, replaying the log on load is harmless.
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+
+        self._num_uncompacted = 0
+
+    def close(self):
+        """ Compact pending records (if any) and close the log. """
+        if self._num_uncompacted > 0 or os.path.exists(self.log_path):
+            self.compact()
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
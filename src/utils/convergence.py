@@ -0,0 +1,76 @@
+import re
+
+from .transcript import parse_steps
+
+
+def _tokens(text):
+    return frozenset(re.findall(r'\w+', text.lower()))
+
+
+def step_similarity(a, b):
+    """ Jaccard similarity of the word sets of two steps. """
+    a, b = _tokens(a), _tokens(b)
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class ConvergenceDetector:
+    """ Detects when successive Oracle answers stop adding new instructions.
+
+    Every answer is split into steps, and a step is new if no step seen so far
+    in the dialogue is similar to it. The dialogue has converged once `patience`
+    answers in a row have at most `max_novelty` (a fraction) new steps. Answers
+    that are not a JSON object of steps are treated as a single step.
+
+    Args:
+        similarity (float): Minimum word overlap (Jaccard similarity) for two steps
+            to count as the same. Defaults to 0.7.
+        max_novelty (float): Maximum fraction of new steps in a converged answer.
+            Defaults to 0.0.
+        patience (int): Number of converged answers in a row before stopping.
+            Defaults to 1.
+    """
+
+    def __init__(self, similarity=0.7, max_novelty=0.0, patience=1):
+        self.similarity = similarity
+        self.max_novelty = max_novelty
+        self.patience = patience
+
+        self.steps = []
+        self.streak = 0
+
+    def novelty(self, steps):
+        """ Fraction of the steps that are not similar to any step seen so far. """
+        if len(steps) == 0:
+            return 0.0
+
+        num_new = sum(1 for step in steps
+                      if all(step_similarity(step, known) < self.similarity for known in self.steps))
+        return num_new / len(steps)
+
+    def update(self, answer):
+        """ Add an Oracle answer and check whether the dialogue has converged.
+
+        Returns:
+            True if the dialogue has converged.
+        """
+        steps = parse_steps(answer)
+        if steps is None:
+            steps = [answer] if answer.strip() else []
+
+        # The first answer only sets the known steps
+        if len(self.steps) > 0 and self.novelty(steps) <= self.max_novelty:
+            self.streak += 1
+        else:
+            self.streak = 0
+        self.steps.extend(steps)
+
+        return self.streak >= self.patience
+
+    def state_dict(self):
+        return {'steps': list(self.steps), 'streak': self.streak}
+
+    def load_state_dict(self, state):
+        self.steps = list(state['steps'])
+        self.streak = state['streak']
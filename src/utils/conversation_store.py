@@ -0,0 +1,193 @@
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import socket
+import uuid
+from time import strftime, gmtime
+
+
+class ConversationStore:
+    """ Rolling store of conversations in size-capped, compressed JSONL shards.
+
+    Every record is appended to the current shard of the writer as a separate gzip
+    member, so that shards stay valid gzip files and single records can be read
+    back through the index without decompressing the whole shard. A new shard is
+    started once the current one exceeds `max_shard_bytes`.
+
+    System prompts are stored once in `prompts.jsonl` and referenced from the
+    conversations by their hash. Each writer (process) writes its own shards, and
+    appends to the shared index and prompt files under a file lock, so several
+    processes can write to the same store concurrently.
+
+    Records are never rewritten. Summaries that are added later (e.g. by the summary
+    pass in src/repair_summaries.py) are appended to `summaries.jsonl` and replace
+    the summary of the record when it is read.
+
+    Layout:
+        <root>/shards/<writer>-<seq>.jsonl.gz  Conversation records
+        <root>/index.jsonl                     One entry per record: id, shard, offset, length
+        <root>/prompts.jsonl                   System prompts by reference
+        <root>/summaries.jsonl                 Updated summaries by record ID
+
+    Args:
+        root (str): Root directory of the store.
+        max_shard_bytes (int): Size after which a new shard is started.
+            Defaults to 64 MB.
+    """
+
+    def __init__(self, root, max_shard_bytes=64 * 1024 * 1024):
+        self.root = root
+        self.max_shard_bytes = max_shard_bytes
+        self.writer = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+        self.shard_dir = os.path.join(root, 'shards')
+        self.index_file = os.path.join(root, 'index.jsonl')
+        self.prompts_file = os.path.join(root, 'prompts.jsonl')
+        self.summaries_file = os.path.join(root, 'summaries.jsonl')
+        os.makedirs(self.shard_dir, exist_ok=True)
+
+        self._shard_seq = 0
+        self._shard_path = None
+        self._prompts = self._load_prompts()
+
+    def _load_prompts(self):
+        prompts = {}
+        if os.path.exists(self.prompts_file):
+            with open(self.prompts_file, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    prompts[entry['ref']] = entry['content']
+        return prompts
+
+    @staticmethod
+    def _append_locked(path, lines):
+        with open(path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _prompt_ref(self, content):
+        """ Store a system prompt (if new) and return its reference. """
+        data = json.dumps(content, sort_keys=True)
+        ref = hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
+        if ref not in self._prompts:
+            self._prompts[ref] = content
+            self._append_locked(self.prompts_file, [json.dumps({'ref': ref, 'content': content}) + '\n'])
+        return ref
+
+    def _current_shard(self):
+        if self._shard_path is None or os.path.getsize(self._shard_path) >= self.max_shard_bytes:
+            self._shard_seq += 1
+            self._shard_path = os.path.join(self.shard_dir, f"{self.writer}-{self._shard_seq:05d}.jsonl.gz")
+            open(self._shard_path, 'ab').close()
+        return self._shard_path
+
+    def add(self, conversation, summary, **metadata):
+        """ Add a conversation to the store.
+
+        Args:
+            conversation: List of messages. The content of system messages is stored
+                by reference.
+            summary: The summary of the conversation.
+            **metadata: Additional fields to store with the record and in the index
+                (e.g., the scan ID and scenario).
+
+        Returns:
+            The unique ID of the record.
+        """
+        record_id = uuid.uuid4().hex
+        messages = []
+        for message in conversation:
+            if message['role'] == 'system':
+                message = {'role': 'system', 'ref': self._prompt_ref(message['content'])}
+            messages.append(message)
+
+        record = dict(metadata)
+        record.update({
+            'id': record_id,
+            'created': strftime("%Y-%m-%dT%H:%M:%SZ", gmtime()),
+            'conversation': messages,
+            'summary': summary,
+        })
+        data = gzip.compress((json.dumps(record) + '\n').encode('utf-8'))
+
+        # Write the record, then index it
+        shard_path = self._current_shard()
+        with open(shard_path, 'ab') as f:
+            offset = f.tell()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        entry = dict(metadata)
+        entry.update({
+            'id': record_id,
+            'shard': os.path.relpath(shard_path, self.root),
+            'offset': offset,
+            'length': len(data),
+        })
+        self._append_locked(self.index_file, [json.dumps(entry) + '\n'])
+        return record_id
+
+    def update_summary(self, record_id, summary):
+        """ Replace the summary of a record, e.g. after summarizing a deferred conversation. """
+        entry = {'id': record_id, 'updated': strftime("%Y-%m-%dT%H:%M:%SZ", gmtime()), 'summary': summary}
+        self._append_locked(self.summaries_file, [json.dumps(entry) + '\n'])
+
+    def summaries(self):
+        """ Map of record ID to its latest updated summary. """
+        summaries = {}
+        if os.path.exists(self.summaries_file):
+            with open(self.summaries_file, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    summaries[entry['id']] = entry['summary']
+        return summaries
+
+    def index(self):
+        """ Map of record ID to index entry. """
+        entries = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    entries[entry['id']] = entry
+        return entries
+
+    def _resolve(self, record, summaries):
+        if record['id'] in summaries:
+            record['summary'] = summaries[record['id']]
+        for message in record['conversation']:
+            if message['role'] == 'system' and 'ref' in message:
+                if message['ref'] not in self._prompts:
+                    self._prompts = self._load_prompts()
+                message['content'] = self._prompts[message.pop('ref')]
+        return record
+
+    def get(self, record_id, entry=None):
+        """ Read a record by ID, with its system prompts and latest summary resolved. """
+        entry = entry or self.index()[record_id]
+        with open(os.path.join(self.root, entry['shard']), 'rb') as f:
+            f.seek(entry['offset'])
+            data = f.read(entry['length'])
+        return self._resolve(json.loads(gzip.decompress(data)), self.summaries())
+
+    def __iter__(self):
+        """ Iterate over all records in the store. """
+        summaries = self.summaries()
+        for shard in sorted(os.listdir(self.shard_dir)):
+            with gzip.open(os.path.join(self.shard_dir, shard), 'rt') as f:
+                for line in f:
+                    yield self._resolve(json.loads(line), summaries)
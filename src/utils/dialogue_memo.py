@@ -0,0 +1,98 @@
+import hashlib
+import json
+import re
+from collections import Counter, defaultdict
+
+from .scene_graph import SceneGraph
+
+
+def _normalize_text(text):
+    return ' '.join(text.lower().split())
+
+
+def canonical_names(scene_graph):
+    """ Canonical names of the objects of a scene graph, independent of their instance ids.
+
+    Objects with the same label are ordered by their attributes and labelled
+    neighbourhood, and renumbered per label in this order (e.g. 'chair#0').
+
+    Returns:
+        Dict from the object ids of the scene graph to their canonical names.
+    """
+    label = SceneGraph._label
+
+    # Describe each object by its label, attributes and relationships
+    outgoing = defaultdict(list)
+    incoming = defaultdict(list)
+    for rel in scene_graph.relationships:
+        outgoing[rel.subject].append((rel.predicate, label(rel.object)))
+        incoming[rel.object].append((rel.predicate, label(rel.subject)))
+
+    signatures = {
+        obj_id: (label(obj_id), sorted(obj.attributes), sorted(outgoing[obj_id]), sorted(incoming[obj_id]))
+        for obj_id, obj in scene_graph.objects.items()
+    }
+
+    # Renumber the objects per label in canonical order
+    names = {}
+    counts = Counter()
+    for obj_id in sorted(signatures, key=lambda obj_id: signatures[obj_id]):
+        obj_label = signatures[obj_id][0]
+        names[obj_id] = f"{obj_label}#{counts[obj_label]}"
+        counts[obj_label] += 1
+    return names
+
+
+def dialogue_key(scene_graph, scenario, names=None):
+    """ Content hash of a dialogue input (scenario and scene graph).
+
+    Instance ids are normalized away (see `canonical_names`), so that rescans of
+    the same room with the same objects, attributes and relationships get the same
+    key even if their objects are numbered differently.
+
+    Args:
+        scene_graph (SceneGraph): The scene graph given to the Oracle.
+        scenario (str): The scenario description.
+        names (dict): Canonical names of the objects, if already computed.
+
+    Returns:
+        Hex digest of the canonical dialogue input.
+    """
+    if names is None:
+        names = canonical_names(scene_graph)
+
+    canonical = {
+        'scenario': _normalize_text(scenario),
+        'objects': sorted([names[obj_id], sorted(obj.attributes)] for obj_id, obj in scene_graph.objects.items()),
+        'relations': sorted([names.get(rel.subject, rel.subject), rel.predicate, names.get(rel.object, rel.object)]
+                            for rel in scene_graph.relationships),
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def object_mapping(source_names, target_names):
+    """ Map the object ids of a scene graph to those of another one with the same dialogue key.
+
+    Args:
+        source_names (dict): Canonical names of the objects of the source scene graph.
+        target_names (dict): Canonical names of the objects of the target scene graph.
+
+    Returns:
+        Dict from the source object ids to the target object ids, for the objects
+        whose ids differ.
+    """
+    target_ids = {name: obj_id for obj_id, name in target_names.items()}
+    return {obj_id: target_ids[name] for obj_id, name in source_names.items()
+            if name in target_ids and target_ids[name] != obj_id}
+
+
+def rename_objects(text, mapping):
+    """ Replace the object ids in a text (e.g. 'chair-12') according to a mapping.
+
+    All ids are replaced at once, so that ids that are swapped by the mapping are
+    not replaced twice.
+    """
+    if text is None or len(mapping) == 0:
+        return text
+    names = '|'.join(re.escape(obj_id) for obj_id in sorted(mapping, key=len, reverse=True))
+    return re.sub(rf'(?<!\w)({names})(?!\w)', lambda match: mapping[match.group(1)], text)
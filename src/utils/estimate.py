@@ -0,0 +1,72 @@
+from collections import OrderedDict
+
+
+def format_duration(seconds):
+    """ Format a duration in seconds, e.g. '2d 3h 15m'. """
+    minutes = int(round(seconds / 60))
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    if days > 0:
+        return f"{days}d {hours}h {minutes}m"
+    if hours > 0:
+        return f"{hours}h {minutes}m"
+    return f"{minutes}m" if minutes > 0 else f"{seconds:.0f}s"
+
+
+class CostEstimate:
+    """ Estimated LLM calls and tokens of a generation stage, per agent.
+
+    The wall time is projected from the per-request throughput of the endpoint,
+    for prompt processing (prefill) and generation (decode), and the number of
+    concurrent requests.
+    """
+
+    def __init__(self):
+        self.agents = OrderedDict()
+
+    def add(self, agent, input_tokens, output_tokens, calls=1):
+        stats = self.agents.setdefault(agent, {'calls': 0, 'input_tokens': 0, 'output_tokens': 0})
+        stats['calls'] += calls
+        stats['input_tokens'] += input_tokens
+        stats['output_tokens'] += output_tokens
+
+    def totals(self):
+        return {
+            key: sum(stats[key] for stats in self.agents.values())
+            for key in ('calls', 'input_tokens', 'output_tokens')
+        }
+
+    @staticmethod
+    def wall_time(stats, concurrency, prefill_tps, decode_tps):
+        """ Projected wall time in seconds if `concurrency` requests run at a time. """
+        busy_time = stats['input_tokens'] / prefill_tps + stats['output_tokens'] / decode_tps
+        return busy_time / max(concurrency, 1)
+
+    def table(self, title, concurrency, prefill_tps, decode_tps):
+        """ Per-agent table of the estimate, as lines of text. """
+        lines = [
+            title,
+            f"{'Agent':<12} {'Calls':>10} {'Input tok':>14} {'Output tok':>14} {'Wall time':>12}",
+        ]
+        rows = list(self.agents.items()) + [('total', self.totals())]
+        for agent, stats in rows:
+            wall_time = self.wall_time(stats, concurrency, prefill_tps, decode_tps)
+            # Calls and tokens may be fractional (expected values) and are rounded for display
+            lines.append(f"{agent:<12} {round(stats['calls']):>10,} {round(stats['input_tokens']):>14,} "
+                         f"{round(stats['output_tokens']):>14,} {format_duration(wall_time):>12}")
+        lines.append(f"(at {concurrency} concurrent requests with {prefill_tps:,.0f} prefill and "
+                     f"{decode_tps:,.0f} decode tokens/s per request)")
+        return lines
+
+
+def add_estimate_args(parser):
+    """ Add the command line arguments of the dry-run estimate to a parser. """
+    parser.add_argument('--dry_run', action='store_true',
+                        help="Only estimate the LLM calls, tokens and wall time of the run, "
+                             "without calling any LLM")
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="Number of concurrent requests for the wall time estimate")
+    parser.add_argument('--prefill_tps', type=float, default=2000,
+                        help="Measured prompt processing throughput of the endpoint (tokens/s per request)")
+    parser.add_argument('--decode_tps', type=float, default=30,
+                        help="Measured generation throughput of the endpoint (tokens/s per request)")
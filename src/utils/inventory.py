@@ -0,0 +1,100 @@
+from collections import Counter
+
+from .tokens import count_tokens
+
+
+# Attribute groups that are kept in a packed inventory, in order of priority.
+# Other groups (e.g. symmetry or lexical) say little about possible scenarios.
+ATTRIBUTE_GROUPS = ('state', 'material', 'color', 'size', 'shape', 'texture')
+
+
+def inventory_entries(objects, max_attributes=2):
+    """ Group the objects of a scan by label, in priority order.
+
+    Args:
+        objects: Objects with a 'label', 'attributes' (dict of attribute groups)
+            and optionally 'affordances'.
+        max_attributes (int): Maximum number of attributes kept per label. The most
+            frequent attributes of the labels' objects are kept, by group priority.
+
+    Returns:
+        List of entries (dicts with 'label', 'count', 'attributes' and 'affordances'),
+        with labels that have affordances first, then by count, then by label.
+    """
+    entries = {}
+    attribute_counts = {}
+    for obj in objects:
+        label = obj['label']
+        if label not in entries:
+            entries[label] = {'label': label, 'count': 0, 'attributes': [], 'affordances': []}
+            attribute_counts[label] = Counter()
+        entry = entries[label]
+        entry['count'] += 1
+        for affordance in obj.get('affordances') or []:
+            if affordance not in entry['affordances']:
+                entry['affordances'].append(affordance)
+        for group, values in (obj.get('attributes') or {}).items():
+            if group in ATTRIBUTE_GROUPS:
+                attribute_counts[label].update((group, value) for value in values)
+
+    for label, entry in entries.items():
+        ranked = sorted(attribute_counts[label].items(),
+                        key=lambda item: (ATTRIBUTE_GROUPS.index(item[0][0]), -item[1], item[0][1]))
+        entry['attributes'] = [value for (_, value), _ in ranked[:max_attributes]]
+
+    return sorted(entries.values(), key=lambda entry: (len(entry['affordances']) == 0, -entry['count'], entry['label']))
+
+
+def format_entry(entry, details=True):
+    """ Format an entry, e.g. 'chair x3 (red, wooden | sit)'. """
+    text = entry['label'] if entry['count'] == 1 else f"{entry['label']} x{entry['count']}"
+    if details:
+        parts = [', '.join(part) for part in (entry['attributes'], entry['affordances']) if part]
+        if parts:
+            text += f" ({' | '.join(parts)})"
+    return text
+
+
+def pack_inventory(objects, max_tokens=None, max_attributes=2, encoding='cl100k_base'):
+    """ Pack the objects of a scan into a compact inventory for a prompt.
+
+    Objects with the same label are merged into one entry with their count, the
+    most informative attributes and their affordances. Within a token budget, the
+    labels are kept in priority order (see `inventory_entries`) and then get their
+    details in the same order, as long as they fit.
+
+    Args:
+        objects: Objects of the scan (see `inventory_entries`).
+        max_tokens (int): Maximum number of tokens of the inventory, or None to keep
+            all labels with their details.
+        max_attributes (int): Maximum number of attributes kept per label.
+        encoding (str): tiktoken encoding used to count the tokens.
+
+    Returns:
+        A tuple (inventory, num_dropped) of the inventory text and the number of
+        labels that did not fit into the budget.
+    """
+    entries = inventory_entries(objects, max_attributes)
+    if max_tokens is None:
+        return '; '.join(format_entry(entry) for entry in entries), 0
+
+    # Entries are joined by '; ', which costs about one token
+    def cost(entry, details):
+        return count_tokens(format_entry(entry, details), encoding) + 1
+
+    kept = []
+    used = 0
+    for entry in entries:
+        entry_cost = cost(entry, details=False)
+        if used + entry_cost > max_tokens:
+            break
+        kept.append([entry, False])
+        used += entry_cost
+
+    for item in kept:
+        extra = cost(item[0], details=True) - cost(item[0], details=False)
+        if extra > 0 and used + extra <= max_tokens:
+            item[1] = True
+            used += extra
+
+    return '; '.join(format_entry(entry, details) for entry, details in kept), len(entries) - len(kept)
@@ -0,0 +1,70 @@
+import json
+
+
+class JSONObjectStream:
+    """ Incremental parser for the JSON objects in a streamed text.
+
+    The text is fed in chunks as it arrives, and every top-level JSON object (e.g.
+    each element of a JSON array of objects) is returned as soon as its closing
+    brace arrives. Objects with single-quoted strings are accepted as well, and
+    objects that cannot be parsed are skipped.
+    """
+
+    def __init__(self):
+        self.buffer = ''
+        self.pos = 0        # Position up to which the buffer has been scanned
+        self.start = None   # Start of the current top-level object
+        self.depth = 0
+        self.quote = None   # Quote character of the current string, if in a string
+        self.escape = False
+
+    def feed(self, chunk):
+        """ Add a chunk of text.
+
+        Returns:
+            The objects completed by this chunk, as dicts.
+        """
+        self.buffer += chunk
+        objects = []
+        while self.pos < len(self.buffer):
+            char = self.buffer[self.pos]
+            if self.quote is not None:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == self.quote:
+                    self.quote = None
+            elif char in '"\'' and self.depth > 0:
+                self.quote = char
+            elif char == '{':
+                if self.depth == 0:
+                    self.start = self.pos
+                self.depth += 1
+            elif char == '}' and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    obj = self._parse(self.buffer[self.start:self.pos + 1])
+                    if obj is not None:
+                        objects.append(obj)
+                    self.start = None
+            self.pos += 1
+
+        # Drop the text before the current object
+        keep = self.start if self.start is not None else self.pos
+        self.buffer = self.buffer[keep:]
+        self.pos -= keep
+        if self.start is not None:
+            self.start = 0
+        return objects
+
+    @staticmethod
+    def _parse(text):
+        for candidate in (text, text.replace("'", '"')):
+            try:
+                obj = json.loads(candidate)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(obj, dict):
+                return obj
+        return None
@@ -0,0 +1,187 @@
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+
+class TaskLedger:
+    """ Durable ledger of generation tasks backed by SQLite.
+
+    Each task is identified by a (scan, scenario) pair, where the scenario is left
+    empty for per-scan tasks. A task is `pending` until a worker claims it, which
+    marks it `leased` for a limited time. The worker then marks it `done` or `failed`
+    together with the error message. Leases of workers that died expire and the task
+    becomes claimable again. Claims are atomic, so several worker processes can
+    share one ledger.
+
+    Args:
+        path (str): Path to the SQLite database. Created if it does not exist.
+        lease_time (float): Seconds after which a leased task can be claimed by
+            another worker. Defaults to 1800.
+        timeout (float): Seconds to wait for a lock held by another worker.
+            Defaults to 60.
+    """
+
+    PENDING = 'pending'
+    LEASED = 'leased'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, path, lease_time=1800, timeout=60):
+        self.path = path
+        self.lease_time = lease_time
+
+        db_dir = os.path.dirname(path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        self.db = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                scan TEXT NOT NULL,
+                scenario TEXT NOT NULL DEFAULT '',
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                worker TEXT,
+                lease_expires REAL,
+                updated_at REAL,
+                PRIMARY KEY (scan, scenario)
+            )
+        ''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, scan)')
+
+    def close(self):
+        self.db.close()
+
+    @contextmanager
+    def _transaction(self):
+        # The connection is in autocommit mode, so that we control when the write
+        # lock is taken. Taking it upfront makes read-then-update sequences atomic.
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def add(self, tasks):
+        """ Add tasks to the ledger. Tasks that already exist are left unchanged.
+
+        Args:
+            tasks: Iterable of (scan, scenario) pairs.
+
+        Returns:
+            The number of newly added tasks.
+        """
+        now = time.time()
+        with self._transaction():
+            before = self.db.total_changes
+            self.db.executemany(
+                'INSERT OR IGNORE INTO tasks (scan, scenario, updated_at) VALUES (?, ?, ?)',
+                ((scan, scenario, now) for scan, scenario in tasks))
+            return self.db.total_changes - before
+
+    def mark_done(self, tasks):
+        """ Mark tasks as done, e.g., when they are already in the output files. """
+        now = time.time()
+        with self._transaction():
+            self.db.executemany(
+                'UPDATE tasks SET status = ?, error = NULL, updated_at = ? WHERE scan = ? AND scenario = ?',
+                ((self.DONE, now, scan, scenario) for scan, scenario in tasks))
+
+    def claim(self, worker, limit=1):
+        """ Atomically claim pending tasks (or tasks with an expired lease).
+
+        Args:
+            worker (str): Name of the claiming worker.
+            limit (int): Maximum number of tasks to claim.
+
+        Returns:
+            List of claimed (scan, scenario) pairs. Empty if no task is left.
+        """
+        now = time.time()
+        with self._transaction():
+            tasks = self.db.execute(
+                'SELECT scan, scenario FROM tasks '
+                'WHERE status = ? OR (status = ? AND lease_expires < ?) '
+                'ORDER BY scan, scenario LIMIT ?',
+                (self.PENDING, self.LEASED, now, limit)).fetchall()
+            self.db.executemany(
+                'UPDATE tasks SET status = ?, worker = ?, attempts = attempts + 1, '
+                'lease_expires = ?, updated_at = ? WHERE scan = ? AND scenario = ?',
+                ((self.LEASED, worker, now + self.lease_time, now, scan, scenario)
+                 for scan, scenario in tasks))
+
+        return [tuple(task) for task in tasks]
+
+    def iter_claims(self, worker):
+        """ Claim tasks one by one until none is left. """
+        while True:
+            tasks = self.claim(worker)
+            if len(tasks) == 0:
+                return
+            yield tasks[0]
+
+    def complete(self, scan, scenario=''):
+        with self._transaction():
+            self.db.execute(
+                'UPDATE tasks SET status = ?, error = NULL, lease_expires = NULL, updated_at = ? '
+                'WHERE scan = ? AND scenario = ?',
+                (self.DONE, time.time(), scan, scenario))
+
+    def fail(self, scan, scenario='', error=None):
+        with self._transaction():
+            self.db.execute(
+                'UPDATE tasks SET status = ?, error = ?, lease_expires = NULL, updated_at = ? '
+                'WHERE scan = ? AND scenario = ?',
+                (self.FAILED, None if error is None else str(error), time.time(), scan, scenario))
+
+    def release(self, worker):
+        """ Return all tasks leased by a worker to the queue, e.g., when it is interrupted.
+
+        The claim does not count as an attempt.
+        """
+        with self._transaction():
+            self.db.execute(
+                'UPDATE tasks SET status = ?, attempts = MAX(attempts - 1, 0), lease_expires = NULL, '
+                'updated_at = ? WHERE status = ? AND worker = ?',
+                (self.PENDING, time.time(), self.LEASED, worker))
+
+    def retry_failed(self, max_attempts=None, error_pattern=None):
+        """ Return failed tasks to the queue.
+
+        Args:
+            max_attempts (int): Only retry tasks with fewer attempts than this.
+            error_pattern (str): Only retry tasks whose error matches this SQL LIKE
+                pattern, e.g. '%RateLimitError%'.
+
+        Returns:
+            The number of tasks returned to the queue.
+        """
+        query = 'UPDATE tasks SET status = ?, updated_at = ? WHERE status = ?'
+        params = [self.PENDING, time.time(), self.FAILED]
+        if max_attempts is not None:
+            query += ' AND attempts < ?'
+            params.append(max_attempts)
+        if error_pattern is not None:
+            query += ' AND error LIKE ?'
+            params.append(error_pattern)
+
+        with self._transaction():
+            return self.db.execute(query, params).rowcount
+
+    def counts(self):
+        """ Number of tasks per status. """
+        counts = {self.PENDING: 0, self.LEASED: 0, self.DONE: 0, self.FAILED: 0}
+        for status, count in self.db.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status'):
+            counts[status] = count
+        return counts
+
+    def failures(self):
+        """ List of (scan, scenario, attempts, error) for all failed tasks. """
+        return self.db.execute(
+            'SELECT scan, scenario, attempts, error FROM tasks WHERE status = ? ORDER BY scan, scenario',
+            (self.FAILED,)).fetchall()
@@ -0,0 +1,162 @@
+import math
+import re
+from collections import Counter, defaultdict
+
+from .scene_graph import SceneGraph, SceneObject, SceneRelationship
+from .tokens import count_tokens
+
+
+def _tokenize(text):
+    """ Lowercase words without digits, with a naive plural stemming. """
+    words = re.findall(r'[a-z]+', text.lower().replace('-', ' ').replace('_', ' '))
+    return [word[:-1] if len(word) > 3 and word.endswith('s') and not word.endswith('ss') else word
+            for word in words]
+
+
+def bm25_scores(documents, query, k1=1.2, b=0.75):
+    """ Okapi BM25 score of each document (list of tokens) for a query (list of tokens). """
+    if len(documents) == 0:
+        return []
+
+    avg_len = sum(len(doc) for doc in documents) / len(documents) or 1
+    df = Counter(term for doc in documents for term in set(doc))
+    query_terms = set(query)
+
+    scores = []
+    for doc in documents:
+        tf = Counter(doc)
+        score = 0.0
+        for term in query_terms:
+            if tf[term] == 0:
+                continue
+            idf = math.log(1 + (len(documents) - df[term] + 0.5) / (df[term] + 0.5))
+            score += idf * tf[term] * (k1 + 1) / (tf[term] + k1 * (1 - b + b * len(doc) / avg_len))
+        scores.append(score)
+    return scores
+
+
+def entry_text(entry, mode='default', alias='o1'):
+    """ Text of an object or relationship as it is serialized in a mode (see `SceneGraph.serialize`).
+
+    The modes that merge entries (grouping relationships, counting objects) are
+    costed as if the entry stood on its own, which is an upper bound.
+
+    Args:
+        entry (SceneObject | SceneRelationship): The entry.
+        mode (str): Serialization mode of the scene graph.
+        alias (str): Alias of an object in the aliased modes, e.g. the longest one.
+    """
+    if mode == 'default':
+        return repr(entry)
+
+    aliased = mode in ('aliased', 'compact')
+    if isinstance(entry, SceneObject):
+        attributes = [attr for attr in entry.attributes if attr]
+        attributes = f"[{', '.join(attributes)}]" if attributes else ''
+        if aliased:
+            return f"{alias}={SceneGraph._label(entry.id)}{attributes}"
+        return f"obj-{entry.id}{':' if attributes else ''}{attributes}"
+
+    subject, obj = (alias, alias) if aliased else (entry.subject, entry.object)
+    if mode in ('grouped', 'compact'):
+        return f"{subject} -> {entry.predicate} [{obj}]"
+    return f"rel-{entry.id}:({subject}, {entry.predicate}, {obj})"
+
+
+def trim_scene_graph(scene_graph, scenario, max_tokens, mode='default', encoding='cl100k_base'):
+    """ Trim a scene graph to the objects most relevant to a scenario within a token budget.
+
+    Objects are ranked by the BM25 score of their label and attributes (and the
+    predicates and labels of their relationships, with a lower weight) against the
+    scenario. Objects are added in order of their score, each followed by its
+    one-hop neighbours, as long as they fit into the budget. A neighbour is only
+    added together with its best relationship to the object, so that no budget is
+    spent on neighbours that end up unconnected. Other relationships are kept if
+    both of their objects are kept and they fit into the budget.
+
+    The entries are costed as they are serialized in the given mode (see
+    `entry_text`), so the budget holds for that mode.
+
+    Args:
+        scene_graph (SceneGraph): The scene graph to trim.
+        scenario (str): The scenario description.
+        max_tokens (int): Maximum number of tokens of the serialized scene graph.
+        mode (str): Serialization mode of the scene graph (see `SceneGraph.serialize`).
+        encoding (str): tiktoken encoding used to count the tokens (see `get_encoding`).
+
+    Returns:
+        The trimmed scene graph, or the scene graph itself if it fits into the budget.
+    """
+    if count_tokens(scene_graph.serialize(mode), encoding) <= max_tokens:
+        return scene_graph
+
+    objects = list(scene_graph.objects.values())
+    neighbours = defaultdict(set)
+    relations_of = defaultdict(list)
+    for rel in scene_graph.relationships:
+        neighbours[rel.subject].add(rel.object)
+        neighbours[rel.object].add(rel.subject)
+        relations_of[rel.subject].append(rel)
+        relations_of[rel.object].append(rel)
+
+    # Score the objects and relationships against the scenario
+    query = _tokenize(scenario)
+    object_scores = bm25_scores([_tokenize(' '.join([SceneGraph._label(obj.id)] + obj.attributes))
+                                 for obj in objects], query)
+    relation_scores = bm25_scores([_tokenize(f"{SceneGraph._label(rel.subject)} {rel.predicate} "
+                                             f"{SceneGraph._label(rel.object)}")
+                                   for rel in scene_graph.relationships], query)
+    relation_score = {id(rel): score for rel, score in zip(scene_graph.relationships, relation_scores)}
+    score = {}
+    for obj, obj_score in zip(objects, object_scores):
+        context = max((relation_score[id(rel)] for rel in relations_of[obj.id]), default=0.0)
+        score[obj.id] = obj_score + 0.5 * context
+
+    # Entries are joined by '; ', which costs about one token
+    alias = f"o{len(objects)}"
+
+    def cost(entry):
+        return count_tokens(entry_text(entry, mode, alias), encoding) + 1
+
+    trimmed = SceneGraph()
+    kept_relations = set()
+    used = 0
+
+    def add_relationship(rel):
+        nonlocal used
+        trimmed.add_relationship(SceneRelationship(rel.id, rel.subject, rel.predicate, rel.object))
+        kept_relations.add(id(rel))
+        used += cost(rel)
+
+    def add_object(obj_id, via=None):
+        nonlocal used
+        if obj_id in trimmed.objects:
+            return
+        obj = scene_graph.objects[obj_id]
+        obj_cost = cost(obj)
+        if used + obj_cost + (cost(via) if via is not None else 0) > max_tokens:
+            return
+        trimmed.add_object(SceneObject(obj.id, list(obj.attributes)))
+        used += obj_cost
+        if via is not None:
+            add_relationship(via)
+
+        # Keep the other relationships to the objects that are already kept, best first
+        for rel in sorted(relations_of[obj_id], key=lambda rel: -relation_score[id(rel)]):
+            if id(rel) not in kept_relations and rel.subject in trimmed.objects and rel.object in trimmed.objects \
+                    and used + cost(rel) <= max_tokens:
+                add_relationship(rel)
+
+    ranking = sorted(scene_graph.objects, key=lambda obj_id: (-score[obj_id], -len(neighbours[obj_id])))
+    for obj_id in ranking:
+        add_object(obj_id)
+        if obj_id not in trimmed.objects:
+            continue
+        for neighbour in sorted(neighbours[obj_id], key=lambda obj_id: -score[obj_id]):
+            links = [rel for rel in relations_of[obj_id] if neighbour in (rel.subject, rel.object)]
+            add_object(neighbour, via=max(links, key=lambda rel: relation_score[id(rel)]))
+
+    # Keep the order of the original scene graph
+    trimmed.objects = {obj_id: trimmed.objects[obj_id] for obj_id in scene_graph.objects if obj_id in trimmed.objects}
+    trimmed.relationships.sort(key=lambda rel: rel.id)
+    return trimmed
@@ -0,0 +1,111 @@
+import heapq
+import math
+import re
+from collections import defaultdict
+
+from .transcript import format_steps, parse_steps
+
+
+# Words that say nothing about the task
+STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'at', 'for', 'from', 'in', 'into', 'is', 'it', 'of', 'on', 'or', 'the', 'their',
+    'to', 'up', 'with', 'wants', 'want', 'person', 'someone', 'needs', 'need',
+])
+
+
+class ExemplarIndex:
+    """ In-memory index of generated instructions for few-shot retrieval.
+
+    Each entry is described by the words of its scenario and the labels of its
+    scene objects. A query scores entries by the IDF-weighted overlap of their
+    features, normalized by the feature counts of both sides. Only entries that
+    share a selective feature with the query (one that appears in at most
+    `max_df` of the entries, e.g. most scenario words, but not 'floor') are
+    scored. They are found through an inverted index.
+
+    Args:
+        object_weight (float): Weight of the object label features relative to the
+            scenario words. Defaults to 0.5.
+        max_df (float): Maximum fraction of entries a feature may appear in to
+            select candidates. Defaults to 0.1.
+    """
+
+    def __init__(self, object_weight=0.5, max_df=0.1):
+        self.object_weight = object_weight
+        self.max_df = max_df
+        self.entries = []
+        self.postings = defaultdict(list)
+
+    @staticmethod
+    def features(scenario, labels):
+        words = {f"w:{word}" for word in re.findall(r'[a-z]+', scenario.lower()) if word not in STOP_WORDS}
+        objects = {f"o:{label.lower()}" for label in labels}
+        return words | objects
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, scenario, labels, instructions, key=None):
+        """ Add generated instructions to the index.
+
+        Args:
+            scenario (str): The scenario of the instructions.
+            labels: Labels of the objects in the scene graph (without instance ids).
+            instructions (str): The instructions as a JSON object of steps. Entries
+                whose instructions cannot be parsed are not added.
+            key: Identifier of the entry (e.g., scan ID and scenario), used to exclude
+                it from the results.
+
+        Returns:
+            True if the entry was added.
+        """
+        steps = parse_steps(instructions)
+        if steps is None:
+            return False
+
+        features = self.features(scenario, labels)
+        idx = len(self.entries)
+        self.entries.append({'key': key, 'scenario': scenario, 'steps': steps, 'features': features})
+        for feature in features:
+            self.postings[feature].append(idx)
+        return True
+
+    def _weight(self, feature):
+        idf = math.log((len(self.entries) + 1) / (len(self.postings[feature]) + 1)) + 1
+        return idf * (self.object_weight if feature.startswith('o:') else 1.0)
+
+    def search(self, scenario, labels, k=2, exclude=()):
+        """ Find the entries most similar to a scenario and its scene objects.
+
+        Returns:
+            Up to `k` (score, entry) pairs, best first.
+        """
+        features = self.features(scenario, labels)
+        weights = {feature: self._weight(feature) for feature in features if self.postings.get(feature)}
+
+        # Select the candidates through the selective features (or all shared features if
+        # there are none)
+        max_postings = max(self.max_df * len(self.entries), 1)
+        selective = [feature for feature in weights if len(self.postings[feature]) <= max_postings]
+        candidates = set()
+        for feature in selective or weights:
+            candidates.update(self.postings[feature])
+
+        results = []
+        for idx in candidates:
+            entry = self.entries[idx]
+            if entry['key'] in exclude:
+                continue
+            score = sum(weights[feature] for feature in entry['features'].intersection(weights))
+            results.append((score / math.sqrt(len(features) * len(entry['features'])), idx))
+        return [(score, self.entries[idx]) for score, idx in heapq.nlargest(k, results)]
+
+
+def format_examples(results):
+    """ Format retrieved entries as few-shot examples for the Oracle prompt. """
+    if len(results) == 0:
+        return ''
+
+    examples = [f"Task: {entry['scenario']}\n{format_steps(entry['steps'])}" for _, entry in results]
+    return ("\n\nFor reference, these are instructions given for similar tasks in other scenes:\n\n"
+            + '\n\n'.join(examples) + "\n\n")
@@ -0,0 +1,85 @@
+import bisect
+from collections import Counter
+
+
+def inventory_key(labels):
+    """ Canonical key of an object inventory: the sorted multiset of its labels. """
+    return tuple(sorted(label.lower() for label in labels))
+
+
+def multiset_jaccard(a, b):
+    """ Jaccard similarity of two label multisets (given as Counters). """
+    union = sum((a | b).values())
+    if union == 0:
+        return 1.0
+    return sum((a & b).values()) / union
+
+
+class ScenarioCache:
+    """ Cache of validated scenarios by the object inventory of their scan.
+
+    Rescans of the same room have (nearly) the same objects, so they can share
+    their scenarios instead of prompting the LLM for each scan. Scans with exactly
+    the same multiset of object labels match directly. With a `threshold` below 1,
+    the most similar inventory by multiset Jaccard similarity matches as well. Since
+    the similarity of two multisets is at most the ratio of their sizes, only
+    inventories of a similar size are compared.
+
+    Args:
+        threshold (float): Minimum similarity for an inventory to match. Defaults
+            to 1.0, i.e. only identical inventories match.
+    """
+
+    def __init__(self, threshold=1.0):
+        self.threshold = threshold
+        self.exact = {}
+        self.entries = []  # (size, scan_id, counts, scenarios), sorted by size
+        self.hits = Counter()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, scan_id, labels, scenarios):
+        """ Add the validated scenarios of a scan. """
+        key = inventory_key(labels)
+        self.exact.setdefault(key, []).append((scan_id, scenarios))
+        bisect.insort(self.entries, (len(key), scan_id, Counter(key), scenarios), key=lambda entry: entry[0])
+
+    def lookup(self, labels, exclude=None, count=True):
+        """ Find the scenarios of a scan with a matching inventory.
+
+        Args:
+            labels: Labels of the objects in the scan.
+            exclude: Scan ID that must not match (e.g. the scan itself).
+            count (bool): Count a match in `hits`. Disable to only check for a match.
+
+        Returns:
+            A tuple (scan_id, scenarios, similarity), or None if no scan matches.
+        """
+        key = inventory_key(labels)
+        for scan_id, scenarios in self.exact.get(key, []):
+            if scan_id != exclude:
+                if count:
+                    self.hits['exact'] += 1
+                return scan_id, scenarios, 1.0
+
+        if self.threshold >= 1.0:
+            return None
+
+        # Only inventories within the size bounds can reach the threshold
+        size = len(key)
+        counts = Counter(key)
+        lower = bisect.bisect_left(self.entries, size * self.threshold, key=lambda entry: entry[0])
+        best = None
+        for other_size, scan_id, other_counts, scenarios in self.entries[lower:]:
+            if other_size * self.threshold > size:
+                break
+            if scan_id == exclude:
+                continue
+            similarity = multiset_jaccard(counts, other_counts)
+            if similarity >= self.threshold and (best is None or similarity > best[2]):
+                best = (scan_id, scenarios, similarity)
+
+        if best is not None and count:
+            self.hits['similar'] += 1
+        return best
@@ -1,4 +1,5 @@
 import re
+from collections import Counter, OrderedDict
 
 import networkx as nx
 import matplotlib.pyplot as plt
@@ -26,6 +27,9 @@ class SceneRelationship:
 
 
 class SceneGraph:
+    # Formats for serializing the scene graph in prompts (see `serialize`)
+    SERIALIZATION_MODES = ('default', 'grouped', 'counted', 'aliased', 'compact')
+
     def __init__(self, objects=None, relations=None) -> None:
         self._objects = objects
         self._relations = relations
@@ -69,6 +73,24 @@ class SceneGraph:
     def add_relationship(self, rel):
         self.relationships.append(rel)
 
+    def unknown_objects(self, text):
+        """ Object names in a text (e.g. 'chair-12') that are not in the scene graph.
+
+        Only names with the label of an object in the scene graph count, so that
+        other words with a number (e.g. 'step-2') are not taken for objects. The
+        name may have a prefix, as in 'obj-chair-12'.
+        """
+        labels = {self._label(obj_id) for obj_id in self.objects}
+        unknown = set()
+        for name in re.findall(r'\b[a-zA-Z][\w-]*-\d+\b', text):
+            label, _, instance_id = name.rpartition('-')
+            parts = label.split('-')
+            matches = [candidate for candidate in ('-'.join(parts[i:]) for i in range(len(parts)))
+                       if candidate in labels]
+            if matches and all(f"{match}-{instance_id}" not in self.objects for match in matches):
+                unknown.add(f"{matches[0]}-{instance_id}")
+        return sorted(unknown)
+
     def to_json(self):
         return {
             'objects': {obj.id: obj.attributes for obj in self.objects.values()},
@@ -80,6 +102,84 @@ class SceneGraph:
         relationships_str = '; '.join([str(rel) for rel in self.relationships])
         return f"{objects_str}; {relationships_str}"
 
+    @staticmethod
+    def _label(obj_id):
+        """ Object label without the instance id, e.g. 'chair' for 'chair-12'. """
+        label, _, instance_id = obj_id.rpartition('-')
+        return label if label and instance_id.isdigit() else obj_id
+
+    def serialize(self, mode='default') -> str:
+        """ Serialize the scene graph for a prompt.
+
+        Modes other than 'default' trade the regular `obj-`/`rel-` syntax for fewer
+        tokens, and all of them drop empty attributes and attribute lists, so that
+        no entry ends in `[]`:
+            - 'default': Same as `repr`, one entry per object and relationship.
+            - 'grouped': Relationships are grouped by subject and predicate, so that
+              each subject is named once, e.g. `chair-1 -> standing on [floor-2]`.
+            - 'counted': Objects with the same label and attributes that do not
+              take part in any relationship are collapsed into one counted entry,
+              e.g. `obj-chair x3:[red]`. The others are declared one by one, since
+              the relationships refer to them by name.
+            - 'aliased': Objects get short local aliases (`o1=chair[red]`), which
+              are used in the relationships instead of the full names.
+            - 'compact': All of the above.
+        """
+        if mode == 'default':
+            return repr(self)
+        if mode not in self.SERIALIZATION_MODES:
+            raise ValueError(f"Unknown serialization mode: {mode}. "
+                             f"Available modes: {self.SERIALIZATION_MODES}")
+
+        grouped = mode in ('grouped', 'compact')
+        counted = mode in ('counted', 'compact')
+        aliased = mode in ('aliased', 'compact')
+
+        def attributes_of(obj):
+            return tuple(attr for attr in obj.attributes if attr)
+
+        def attributes_str(obj, sep=':'):
+            attributes = attributes_of(obj)
+            return f"{sep}[{', '.join(attributes)}]" if attributes else ''
+
+        # Declare the objects
+        related = {rel.subject for rel in self.relationships} | {rel.object for rel in self.relationships}
+        names = {}
+        declarations = []
+        counts = Counter()
+        for obj in self.objects.values():
+            if counted and obj.id not in related:
+                counts[(self._label(obj.id), attributes_of(obj))] += 1
+            elif aliased:
+                names[obj.id] = f"o{len(names) + 1}"
+                declarations.append(f"{names[obj.id]}={self._label(obj.id)}{attributes_str(obj, sep='')}")
+            else:
+                declarations.append(f"obj-{obj.id}{attributes_str(obj)}")
+
+        for (label, attributes), count in counts.items():
+            entry = label if count == 1 else f"{label} x{count}"
+            if attributes:
+                entry += f"{'' if aliased else ':'}[{', '.join(attributes)}]"
+            declarations.append(entry if aliased else f"obj-{entry}")
+
+        # Declare the relationships
+        def name(obj_id):
+            return names.get(obj_id, obj_id)
+
+        if grouped:
+            groups = OrderedDict()
+            for rel in self.relationships:
+                groups.setdefault(rel.subject, OrderedDict()).setdefault(rel.predicate, []).append(rel.object)
+            for subject, predicates in groups.items():
+                targets = ', '.join(f"{predicate} [{', '.join(name(o) for o in objects)}]"
+                                    for predicate, objects in predicates.items())
+                declarations.append(f"{name(subject)} -> {targets}")
+        else:
+            for rel in self.relationships:
+                declarations.append(f"rel-{rel.id}:({name(rel.subject)}, {rel.predicate}, {name(rel.object)})")
+
+        return '; '.join(declarations)
+
     def visualize(self, save_path, title='Scene Graph', orig_img=None):
         G = nx.DiGraph()
         node_colors = []
@@ -0,0 +1,159 @@
+import json
+from collections import defaultdict, deque
+
+from .scene_graph import SceneGraph
+
+
+def _normalize(text):
+    return '-'.join(text.lower().replace('_', ' ').replace('-', ' ').split())
+
+
+class SceneGraphIndex:
+    """ In-memory indexes over a scene graph, exposed as tools for an LLM.
+
+    The Oracle can query the scene graph through these tools instead of getting
+    the whole scene graph in its prompt (see `TOOLS` for their specification).
+
+    Args:
+        scene_graph (SceneGraph): The scene graph to index.
+        max_results (int): Maximum number of results returned by a tool call, to
+            keep the tool responses short. Defaults to 50.
+    """
+
+    TOOLS = [
+        {
+            "type": "function",
+            "function": {
+                "name": "find_objects",
+                "description": "Find the objects in the scene with a label and/or an attribute. "
+                               "Returns the object names (e.g. 'chair-12') with their attributes.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "label": {"type": "string", "description": "Object label, e.g. 'chair'"},
+                        "attribute": {"type": "string", "description": "Attribute, e.g. 'wooden'"},
+                    },
+                },
+            },
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "relations_of",
+                "description": "List the relationships of an object as (subject, predicate, object).",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "object": {"type": "string", "description": "Object name, e.g. 'chair-12'"},
+                    },
+                    "required": ["object"],
+                },
+            },
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "neighbors",
+                "description": "List the objects within k relationships of an object.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "object": {"type": "string", "description": "Object name, e.g. 'chair-12'"},
+                        "k": {"type": "integer", "description": "Number of hops (default 1)"},
+                    },
+                    "required": ["object"],
+                },
+            },
+        },
+    ]
+
+    def __init__(self, scene_graph, max_results=50):
+        self.scene_graph = scene_graph
+        self.max_results = max_results
+
+        self.by_label = defaultdict(list)
+        self.by_attribute = defaultdict(list)
+        for obj_id, obj in scene_graph.objects.items():
+            self.by_label[_normalize(SceneGraph._label(obj_id))].append(obj_id)
+            for attribute in obj.attributes:
+                self.by_attribute[_normalize(attribute)].append(obj_id)
+
+        self.relations = defaultdict(list)
+        self.adjacency = defaultdict(set)
+        for rel in scene_graph.relationships:
+            self.relations[rel.subject].append(rel)
+            self.relations[rel.object].append(rel)
+            self.adjacency[rel.subject].add(rel.object)
+            self.adjacency[rel.object].add(rel.subject)
+
+    def _lookup(self, index, key):
+        """ Objects with exactly this key, or with keys containing it if there are none. """
+        key = _normalize(key)
+        if key in index:
+            return set(index[key])
+        return {obj_id for other, obj_ids in index.items() if key in other for obj_id in obj_ids}
+
+    def _resolve(self, name):
+        for candidate in (name, _normalize(name)):
+            if candidate in self.scene_graph.objects:
+                return candidate
+        raise KeyError(f"Unknown object: {name}. Use find_objects to get the object names.")
+
+    def overview(self):
+        """ Short description of the scene for the prompt, independent of its size. """
+        return (f"a scene with {len(self.scene_graph.objects)} objects and "
+                f"{len(self.scene_graph.relationships)} relationships, which you can query with the "
+                f"tools {', '.join(tool['function']['name'] for tool in self.TOOLS)}")
+
+    def find_objects(self, label=None, attribute=None):
+        matches = set(self.scene_graph.objects)
+        if label:
+            matches &= self._lookup(self.by_label, label)
+        if attribute:
+            matches &= self._lookup(self.by_attribute, attribute)
+        if not label and not attribute:
+            matches = set()
+
+        ordered = [obj_id for obj_id in self.scene_graph.objects if obj_id in matches]
+        return {obj_id: self.scene_graph.objects[obj_id].attributes for obj_id in ordered[:self.max_results]}
+
+    def relations_of(self, object):
+        obj_id = self._resolve(object)
+        return [(rel.subject, rel.predicate, rel.object) for rel in self.relations[obj_id][:self.max_results]]
+
+    def neighbors(self, object, k=1):
+        obj_id = self._resolve(object)
+        k = int(k)
+
+        # Breadth-first search up to k hops
+        distances = {obj_id: 0}
+        queue = deque([obj_id])
+        while queue:
+            current = queue.popleft()
+            if distances[current] >= k:
+                continue
+            for neighbour in sorted(self.adjacency[current]):
+                if neighbour not in distances:
+                    distances[neighbour] = distances[current] + 1
+                    queue.append(neighbour)
+
+        del distances[obj_id]
+        return sorted(distances, key=lambda name: (distances[name], name))[:self.max_results]
+
+    def call(self, name, arguments):
+        """ Run a tool call and return its result as a JSON string.
+
+        Args:
+            name (str): Name of the tool.
+            arguments (str): Arguments of the call as a JSON object.
+        """
+        tools = {'find_objects': self.find_objects, 'relations_of': self.relations_of, 'neighbors': self.neighbors}
+        try:
+            if name not in tools:
+                raise KeyError(f"Unknown tool: {name}")
+            result = tools[name](**json.loads(arguments or '{}'))
+        except (KeyError, TypeError, ValueError) as e:
+            # str() of a KeyError is the repr of its message, so the message is taken as is
+            message = e.args[0] if isinstance(e, KeyError) and len(e.args) == 1 else str(e)
+            result = {'error': str(message)}
+        return json.dumps(result)
@@ -0,0 +1,51 @@
+import hashlib
+import os
+import re
+
+
+def parse_shard(spec):
+    """ Parse a shard specification of the form 'i/N' into a tuple (i, N).
+
+    Returns None if no specification is given.
+    """
+    if spec is None:
+        return None
+
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', spec)
+    if match is None:
+        raise ValueError(f"Invalid shard specification: {spec}. Expected 'i/N'.")
+
+    index, num_shards = int(match.group(1)), int(match.group(2))
+    if num_shards < 1 or not 0 <= index < num_shards:
+        raise ValueError(f"Invalid shard specification: {spec}. Expected 0 <= i < N.")
+
+    return index, num_shards
+
+
+def shard_of(scan_id, num_shards):
+    """ Deterministically assign a scan to one of `num_shards` shards.
+
+    Uses a stable hash of the scan ID (unlike Python's `hash`, which is salted per
+    process), so that every machine computes the same partition.
+    """
+    digest = hashlib.md5(scan_id.encode('utf-8')).hexdigest()
+    return int(digest, 16) % num_shards
+
+
+def in_shard(scan_id, shard):
+    """ Check if a scan belongs to a shard (i, N). Every scan belongs to shard None. """
+    if shard is None:
+        return True
+
+    index, num_shards = shard
+    return shard_of(scan_id, num_shards) == index
+
+
+def shard_path(path, shard):
+    """ Path of the shard file for an output file, e.g. 'scenarios-shard-0-of-4.json'. """
+    if shard is None:
+        return path
+
+    index, num_shards = shard
+    stem, ext = os.path.splitext(path)
+    return f"{stem}-shard-{index}-of-{num_shards}{ext}"
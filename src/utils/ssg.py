@@ -1,5 +1,8 @@
 import json
 import os
+import re
+
+import numpy as np
 
 
 def load_objects(data_dir):
@@ -29,15 +32,212 @@ def load_objects(data_dir):
     return scan_objects, id2global, global2label
 
 
-def load_relationships(data_dir, id2global, global2label):
-    # Define a list of relations to ignore
-    ignore_list = [
-        'none',
-        'same symmetry as',
-        'same as',
-        'same object type',
-    ]
+# Relations that are ignored
+IGNORED_RELATIONS = [
+    'none',
+    'same symmetry as',
+    'same as',
+    'same object type',
+]
+
+
+class Vocabulary:
+    """ Interned labels and predicates with integer codes, shared by the relation tables of all scans. """
+
+    def __init__(self):
+        self.strings = []
+        self.codes = {}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def code(self, string):
+        code = self.codes.get(string)
+        if code is None:
+            code = self.codes[string] = len(self.strings)
+            self.strings.append(string)
+        return code
+
+    def encode(self, strings):
+        """ Encode an array of strings, interning each distinct string once. """
+        uniques, inverse = np.unique(np.asarray(strings), return_inverse=True)
+        codes = np.fromiter((self.code(string) for string in uniques.tolist()), dtype=np.int64, count=len(uniques))
+        return codes[inverse.reshape(-1)]
+
+
+class RelationTable:
+    """ Relationships of one scan as integer-coded columns.
+
+    The instance ids, global ids and relation ids are kept as integers, and the
+    labels and predicates as codes into a shared `Vocabulary`, so that relations
+    can be selected with array operations. The global ids are not interned, since
+    they are distinct in every scan and would only grow the vocabulary. The named relations (in the format of
+    `load_relationships`) are only built by `to_dicts`.
+    """
+
+    COLUMNS = ('subject', 'object', 'subject_global', 'object_global',
+               'subject_label', 'object_label', 'relation_id', 'predicate')
+
+    def __init__(self, vocab, **columns):
+        self.vocab = vocab
+        for name in self.COLUMNS:
+            setattr(self, name, columns[name])
+
+    def __len__(self):
+        return len(self.predicate)
+
+    def __getitem__(self, rows):
+        """ Select relations by a boolean mask or indices. """
+        return RelationTable(self.vocab, **{name: getattr(self, name)[rows] for name in self.COLUMNS})
+
+    @classmethod
+    def from_relations(cls, relations, vocab):
+        """ Encode named relations (in the format of `load_relationships`). """
+        num_relations = len(relations)
+
+        def column(key, dtype=object):
+            if dtype is object:
+                return np.fromiter((rel[key] for rel in relations), dtype=object, count=num_relations)
+            return np.fromiter((int(rel[key]) for rel in relations), dtype=dtype, count=num_relations)
+
+        # Split each distinct name into its label and instance id (labels may contain hyphens)
+        names, inverse = np.unique(np.concatenate([column('subject_name'), column('object_name')]),
+                                   return_inverse=True)
+        parts = [name.rpartition('-') for name in names.tolist()]
+        instance_ids = np.fromiter((int(instance_id) for _, _, instance_id in parts), dtype=np.int64, count=len(parts))
+        labels = vocab.encode(np.fromiter((label for label, _, _ in parts), dtype=object, count=len(parts)))
+        subject_rows, object_rows = inverse[:num_relations], inverse[num_relations:]
+        return cls(
+            vocab,
+            subject=instance_ids[subject_rows],
+            object=instance_ids[object_rows],
+            subject_global=column('subject_id', np.int64),
+            object_global=column('object_id', np.int64),
+            subject_label=labels[subject_rows],
+            object_label=labels[object_rows],
+            relation_id=column('relation_id', np.int64),
+            predicate=vocab.encode(column('relation_name')),
+        )
+
+    def between(self, global_ids):
+        """ Mask of the relations whose subject and object are both among the given global ids. """
+        global_ids = np.fromiter((int(global_id) for global_id in global_ids), dtype=np.int64)
+        return np.isin(self.subject_global, global_ids) & np.isin(self.object_global, global_ids)
+
+    def to_dicts(self):
+        strings = self.vocab.strings
+        columns = zip(*(getattr(self, name).tolist() for name in self.COLUMNS))
+        return [{
+            'subject_id': str(subject_global),
+            'subject_name': f"{strings[subject_label]}-{subject}",
+            'object_id': str(object_global),
+            'object_name': f"{strings[object_label]}-{obj}",
+            'relation_id': str(relation_id),
+            'relation_name': strings[predicate],
+        } for subject, obj, subject_global, object_global, subject_label, object_label, relation_id, predicate
+            in columns]
+
+
+def encode_relationships(relationships, id2global, global2label, vocab):
+    """ Convert the relationships of one scan into a `RelationTable`.
+
+    The instance ids are mapped to global ids and labels by a binary search in the
+    sorted instance ids of the scan, and the ignored relations are removed with a
+    mask over the predicate codes.
+
+    Args:
+        relationships: Relationships of the scan as [subject id, object id,
+            relation id, relation name], with the instance ids of the scan.
+        id2global (dict): Map from the instance ids of the scan to global ids.
+        global2label (dict): Map from global ids to labels.
+        vocab (Vocabulary): Vocabulary of the labels and predicates.
+
+    Raises:
+        KeyError: If a relationship refers to an instance id that is not an object
+            of the scan (as the lookups by name in `resolve_relationships`).
+    """
+    num_relations = len(relationships)
+    subject = np.fromiter((rel[0] for rel in relationships), dtype=np.int64, count=num_relations)
+    obj = np.fromiter((rel[1] for rel in relationships), dtype=np.int64, count=num_relations)
+    relation_id = np.fromiter((rel[2] for rel in relationships), dtype=np.int64, count=num_relations)
+    predicate = vocab.encode(np.fromiter((rel[3] for rel in relationships), dtype=object, count=num_relations))
+
+    # Sorted instance ids of the scan, with their global ids and the codes of their labels
+    instance_ids = np.fromiter((int(instance_id) for instance_id in id2global), dtype=np.int64, count=len(id2global))
+    global_ids = np.fromiter((int(global_id) for global_id in id2global.values()),
+                             dtype=np.int64, count=len(id2global))
+    label_codes = vocab.encode(np.fromiter((global2label[global_id] for global_id in id2global.values()),
+                                           dtype=object, count=len(id2global)))
+    order = np.argsort(instance_ids, kind='stable')
+    instance_ids, global_ids, label_codes = instance_ids[order], global_ids[order], label_codes[order]
+
+    # Find the rows of the subjects and objects. Ids outside the range of the scan
+    # (including negative ids) are clipped to a valid row and then fail the match.
+    rows = []
+    for ids in (subject, obj):
+        row = np.clip(np.searchsorted(instance_ids, ids), 0, max(len(instance_ids) - 1, 0))
+        unknown = ids != instance_ids[row] if len(instance_ids) > 0 else np.ones(len(ids), dtype=bool)
+        if unknown.any():
+            raise KeyError(str(ids[unknown][0]))
+        rows.append(row)
+    subject_row, object_row = rows
+
+    keep = ~np.isin(predicate, [vocab.code(name) for name in IGNORED_RELATIONS])
+    return RelationTable(
+        vocab,
+        subject=subject[keep],
+        object=obj[keep],
+        subject_global=global_ids[subject_row[keep]],
+        object_global=global_ids[object_row[keep]],
+        subject_label=label_codes[subject_row[keep]],
+        object_label=label_codes[object_row[keep]],
+        relation_id=relation_id[keep],
+        predicate=predicate[keep],
+    )
+
+
+def resolve_relationships(relationships, id2global, global2label):
+    """ Resolve the relationships of one scan to named relations.
+
+    Args:
+        relationships: Relationships of the scan as [subject id, object id,
+            relation id, relation name], with the instance ids of the scan.
+        id2global (dict): Map from the instance ids of the scan to global ids.
+        global2label (dict): Map from global ids to labels.
+    """
+    relations = []
+    for rel in relationships:
+        # Read relation data (subject, object, relation, relation_name)
+        subject_id = str(rel[0])   # subject instance id
+        object_id = str(rel[1])    # object instance id
+        relation_id = str(rel[2])  # relation id
+        relation_name = rel[3]     # relation name
+
+        # Map instance ids to global ids
+        subject_id_global = id2global[subject_id]
+        object_id_global = id2global[object_id]
 
+        # Get object names
+        subject_name = global2label[subject_id_global]
+        object_name = global2label[object_id_global]
+
+        # Skip if relation is in ignore list
+        if relation_name in IGNORED_RELATIONS:
+            continue
+
+        relations.append({
+            'subject_id': subject_id_global,
+            'subject_name': f"{subject_name}-{subject_id}",
+            'object_id': object_id_global,
+            'object_name': f"{object_name}-{object_id}",
+            'relation_id': relation_id,
+            'relation_name': relation_name
+        })
+
+    return relations
+
+
+def load_relationships(data_dir, id2global, global2label):
     # Load relationships data
     relations_file = os.path.join(data_dir, 'relationships.json')
     with open(relations_file, 'r') as f:
@@ -46,43 +246,199 @@ def load_relationships(data_dir, id2global, global2label):
     scan_relations = {}
     for s in relations_data:
         scan_id = s['scan']
+        scan_relations[scan_id] = resolve_relationships(s['relationships'], id2global[scan_id], global2label)
+
+    return scan_relations
 
-        # Get scan relations
-        relations = []
-        for rel in s['relationships']:
-            # Read relation data (subject, object, relation, relation_name)
-            subject_id = str(rel[0])   # subject instance id
-            object_id = str(rel[1])    # object instance id
-            relation_id = str(rel[2])  # relation id
-            relation_name = rel[3]     # relation name
-
-            # Map instance ids to global ids
-            subject_id_global = id2global[scan_id][subject_id]
-            object_id_global = id2global[scan_id][object_id]
-
-            # Get object names
-            subject_name = global2label[subject_id_global]
-            object_name = global2label[object_id_global]
-
-            # Skip if relation is in ignore list
-            if relation_name in ignore_list:
+
+def iter_json_array(path, key='scans', chunk_size=1 << 20, encoding=None, offsets=False):
+    """ Iterate over the elements of a top-level array in a JSON file without loading the file.
+
+    The file is read in chunks and each element is decoded as soon as it is
+    complete, so only one element (and one chunk) is held in memory at a time.
+
+    Args:
+        path (str): Path to a JSON file with an object like {key: [...]}.
+        key (str): Key of the array in the top-level object.
+        chunk_size (int): Number of characters read at a time.
+        encoding (str): Encoding of the file. Defaults to the platform default.
+        offsets (bool): Also yield the character offsets of each element in the
+            file, as tuples (element, start, end).
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding=encoding, newline='' if offsets else None) as f:
+        buffer = ''
+        consumed = 0  # Number of characters of the file before the buffer
+        eof = False
+
+        def read():
+            nonlocal buffer, eof
+            chunk = f.read(chunk_size)
+            eof = chunk == ''
+            buffer += chunk
+
+        # Find the start of the array
+        while True:
+            match = re.search(r'"%s"\s*:\s*\[' % re.escape(key), buffer)
+            if match is not None:
+                consumed += match.end()
+                buffer = buffer[match.end():]
+                break
+            if eof:
+                raise ValueError(f"No array '{key}' found in {path}")
+            read()
+
+        pos = 0
+        while True:
+            # Skip the separators between the elements
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buffer):
+                if eof:
+                    raise ValueError(f"Unexpected end of file in {path}")
+                consumed += len(buffer)
+                buffer, pos = '', 0
+                read()
                 continue
+            if buffer[pos] == ']':
+                return
 
-            relations.append({
-                'subject_id': subject_id_global,
-                'subject_name': f"{subject_name}-{subject_id}",
-                'object_id': object_id_global,
-                'object_name': f"{object_name}-{object_id}",
-                'relation_id': relation_id,
-                'relation_name': relation_name
-            })
+            # The element is incomplete if it cannot be decoded or is not followed by a
+            # separator yet (e.g. a number cut off by the chunk), unless the file has ended
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+                complete = eof or re.compile(r'\s*[,\]]').match(buffer, end) is not None
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                consumed += pos
+                buffer, pos = buffer[pos:], 0
+                read()
+                continue
 
-        scan_relations[scan_id] = relations
+            yield (element, consumed + pos, consumed + end) if offsets else element
+            pos = end
+            if pos > chunk_size:
+                consumed += pos
+                buffer, pos = buffer[pos:], 0
 
-    return scan_relations
 
+def index_json_array(path, key='scans', id_key='scan'):
+    """ Index the elements of a top-level array in a JSON file by their id.
+
+    The file is read as Latin-1, which maps every byte to one character, so that
+    the offsets are byte offsets. This does not change the boundaries of the
+    elements, since the bytes of multi-byte UTF-8 characters are never ASCII.
+    Only the ids are decoded back to UTF-8.
+
+    Returns:
+        Dict from the id of each element to its (start, end) byte offsets.
+    """
+    return {element[id_key].encode('latin-1').decode('utf-8'): (start, end)
+            for element, start, end in iter_json_array(path, key, encoding='latin-1', offsets=True)}
+
+
+def iter_scans(data_dir, relationships=True, use_cache=False, columnar=False):
+    """ Iterate over the scans of 3DSSG one at a time, with bounded memory.
+
+    The scans of objects.json and relationships.json are streamed and joined by
+    scan ID. The relationships are resolved with the ids and labels of the scan's
+    own objects. If the two files do not list the same scans in the same order,
+    relationships.json is indexed by scan ID once (see `index_json_array`) and the
+    relationships of each scan are read on demand, so memory stays bounded either way.
+
+    Args:
+        data_dir (str): Directory with objects.json and relationships.json.
+        relationships (bool): Also read the relationships. Otherwise only the
+            objects are read and the relations are None.
+        use_cache (bool): Read the scans from the binary cache (see `SSGCache`)
+            instead, which is built on the first use.
+        columnar (bool): Yield the relations of each scan as a `RelationTable`, with
+            a vocabulary of labels and predicates shared by all scans, instead of a
+            list of named relations.
+
+    Yields:
+        A tuple (scan_id, objects, relations) for each scan in objects.json, in the
+        format of `load_3dssg` (relations is an empty list if the scan has none).
+    """
+    vocab = Vocabulary()
+    if use_cache:
+        from .ssg_cache import SSGCache
+        for scan_id, objects, relations in SSGCache(data_dir).ensure().iter_scans():
+            if not relationships:
+                relations = None
+            elif columnar:
+                relations = RelationTable.from_relations(relations or [], vocab)
+            else:
+                relations = relations or []
+            yield scan_id, objects, relations
+        return
+
+    objects_iter = iter_json_array(os.path.join(data_dir, 'objects.json'))
+    if not relationships:
+        for s in objects_iter:
+            yield s['scan'], s['objects'], None
+        return
+
+    # The relationships are streamed alongside the objects as long as both files list
+    # the same scans in the same order. Otherwise, the relationships of each scan
+    # are read from their byte offsets in the file.
+    relations_path = os.path.join(data_dir, 'relationships.json')
+    relations_iter = iter_json_array(relations_path)
+    next_relations = next(relations_iter, None)
+    index = None
+    relations_file = None
+    try:
+        for s in objects_iter:
+            scan_id = s['scan']
+            objects = s['objects']
+
+            if index is None and next_relations is not None and next_relations['scan'] != scan_id:
+                relations_iter.close()
+                index = index_json_array(relations_path)
+                relations_file = open(relations_path, 'rb')
+                next_relations = None
+
+            if index is not None:
+                scan_relationships = []
+                if scan_id in index:
+                    start, end = index[scan_id]
+                    relations_file.seek(start)
+                    scan_relationships = json.loads(relations_file.read(end - start).decode('utf-8'))['relationships']
+            elif next_relations is not None:
+                scan_relationships = next_relations['relationships']
+                next_relations = next(relations_iter, None)
+            else:
+                scan_relationships = []
+
+            id2global = {str(o['id']): str(o['global_id']) for o in objects}
+            global2label = {str(o['global_id']): f"{o['label']}" for o in objects}
+            if columnar:
+                yield scan_id, objects, encode_relationships(scan_relationships, id2global, global2label, vocab)
+            else:
+                yield scan_id, objects, resolve_relationships(scan_relationships, id2global, global2label)
+    finally:
+        if relations_file is not None:
+            relations_file.close()
+
+
+def load_3dssg(data_dir, use_cache=False):
+    """ Load the objects and relationships of all scans.
+
+    Args:
+        data_dir (str): Directory with objects.json and relationships.json.
+        use_cache (bool): Load the scans from a binary cache (see `SSGCache`),
+            which is built on the first use and whenever the JSON files change.
+
+    Returns:
+        A tuple (scan_objects, scan_relations) of dicts by scan ID.
+    """
+    if use_cache:
+        from .ssg_cache import SSGCache
+        return SSGCache(data_dir).ensure().load_all()
 
-def load_3dssg(data_dir):
     scan_objects, id2global, global2label = load_objects(data_dir)
     scan_relations = load_relationships(data_dir, id2global, global2label)
     return scan_objects, scan_relations
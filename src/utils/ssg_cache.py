@@ -0,0 +1,195 @@
+import gc
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+
+
+class SSGCache:
+    """ Binary cache of the 3DSSG objects and relationships, indexed by scan.
+
+    The objects and the resolved relationships of each scan (as returned by
+    `load_objects` and `load_relationships`) are stored as one pickled record in
+    a single data file, with an index of the byte offsets of the scans. Loading a
+    scan reads only its own record, and loading all scans avoids parsing the JSON
+    files and rebuilding the id maps.
+
+    The records are pickled dicts rather than memory-mappable columns, because every
+    stage consumes the scans as dicts (`SceneGraph`, the prompts) and would convert
+    columns straight back. Only the offsets are memory-mapped. Scans that need
+    columns build a `RelationTable` from the records (see `iter_scans`).
+
+    The cache is rebuilt when one of the source files changes. A source file is
+    unchanged if its size and modification time match, or otherwise if its SHA-256
+    hash matches (e.g. after copying the dataset). In that case the new modification
+    time is written to the index, so the file is not hashed again on the next use.
+
+    Args:
+        data_dir (str): Directory with objects.json and relationships.json.
+        cache_dir (str): Directory of the cache. Defaults to `3dssg_cache` in the
+            data directory.
+    """
+
+    VERSION = 1
+    SOURCES = ('objects.json', 'relationships.json')
+
+    def __init__(self, data_dir, cache_dir=None):
+        self.data_dir = data_dir
+        self.cache_dir = cache_dir or os.path.join(data_dir, '3dssg_cache')
+        self.index_path = os.path.join(self.cache_dir, 'index.json')
+        self.offsets_path = os.path.join(self.cache_dir, 'offsets.npy')
+        self.data_path = os.path.join(self.cache_dir, 'scans.bin')
+
+        self._index = None
+        self._offsets = None
+
+    @staticmethod
+    def _hash(path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def _fingerprint(self, name, with_hash=True):
+        stat = os.stat(os.path.join(self.data_dir, name))
+        fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        if with_hash:
+            fingerprint['sha256'] = self._hash(os.path.join(self.data_dir, name))
+        return fingerprint
+
+    def is_valid(self):
+        """ Whether the cache exists and was built from the current source files. """
+        if not os.path.exists(self.index_path):
+            return False
+        with open(self.index_path, 'r') as f:
+            index = json.load(f)
+        if index.get('version') != self.VERSION:
+            return False
+
+        refreshed = False
+        for name in self.SOURCES:
+            cached = index['sources'].get(name)
+            if cached is None:
+                return False
+            current = self._fingerprint(name, with_hash=False)
+            if current['size'] != cached['size']:
+                return False
+            if current['mtime_ns'] != cached['mtime_ns']:
+                if self._hash(os.path.join(self.data_dir, name)) != cached['sha256']:
+                    return False
+                cached['mtime_ns'] = current['mtime_ns']
+                refreshed = True
+
+        if refreshed:
+            self._write_index(index)
+        self._index = index
+        return True
+
+    def _write_index(self, index):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def build(self):
+        """ Convert the JSON files into the cache. """
+        from .ssg import load_objects, load_relationships
+
+        scan_objects, id2global, global2label = load_objects(self.data_dir)
+        scan_relations = load_relationships(self.data_dir, id2global, global2label)
+
+        # The index is written last, so an interrupted build leaves no valid cache
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+
+        scans = {}
+        offsets = [0]
+        with open(self.data_path, 'wb') as f:
+            for scan_id, objects in scan_objects.items():
+                record = pickle.dumps((objects, scan_relations.get(scan_id)), protocol=pickle.HIGHEST_PROTOCOL)
+                f.write(record)
+                scans[scan_id] = len(offsets) - 1
+                offsets.append(offsets[-1] + len(record))
+        np.save(self.offsets_path, np.asarray(offsets, dtype=np.int64))
+
+        index = {
+            'version': self.VERSION,
+            'sources': {name: self._fingerprint(name) for name in self.SOURCES},
+            'scans': scans,
+        }
+        self._write_index(index)
+
+        self._index = index
+        self._offsets = None
+
+    def ensure(self):
+        """ Build the cache unless it is valid. Returns self. """
+        if not self.is_valid():
+            self.build()
+        return self
+
+    @property
+    def offsets(self):
+        if self._offsets is None:
+            self._offsets = np.load(self.offsets_path, mmap_mode='r')
+        return self._offsets
+
+    @property
+    def scan_ids(self):
+        return list(self._index['scans'])
+
+    def __contains__(self, scan_id):
+        return scan_id in self._index['scans']
+
+    def load_scan(self, scan_id):
+        """ Load the objects and relationships of one scan.
+
+        Returns:
+            A tuple (objects, relations), where relations is None if the scan has no
+            relationships data.
+        """
+        row = self._index['scans'][scan_id]
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        with open(self.data_path, 'rb') as f:
+            f.seek(start)
+            return pickle.loads(f.read(end - start))
+
+    def iter_scans(self):
+        """ Iterate over the scans in the cache, one record at a time.
+
+        Yields:
+            A tuple (scan_id, objects, relations) for each scan.
+        """
+        with open(self.data_path, 'rb') as f:
+            for scan_id, row in self._index['scans'].items():
+                start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+                f.seek(start)
+                objects, relations = pickle.loads(f.read(end - start))
+                yield scan_id, objects, relations
+
+    def load_all(self):
+        """ Load all scans, in the same format as `load_3dssg`. """
+        with open(self.data_path, 'rb') as f:
+            data = memoryview(f.read())
+
+        # The records create millions of small objects without reference cycles, so the
+        # garbage collector is paused instead of scanning them over and over
+        offsets = self.offsets
+        scan_objects = {}
+        scan_relations = {}
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for scan_id, row in self._index['scans'].items():
+                objects, relations = pickle.loads(data[int(offsets[row]):int(offsets[row + 1])])
+                scan_objects[scan_id] = objects
+                if relations is not None:
+                    scan_relations[scan_id] = relations
+        finally:
+            if gc_enabled:
+                gc.enable()
+        return scan_objects, scan_relations
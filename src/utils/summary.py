@@ -0,0 +1,70 @@
+import ast
+import json
+import re
+
+from .transcript import parse_steps
+
+
+def is_malformed(summary):
+    """ Check if a summary is not a JSON object of instructions. """
+    if not isinstance(summary, str) or summary.startswith('Error: Error code'):
+        return True
+
+    try:
+        steps = json.loads(summary)
+    except json.JSONDecodeError:
+        return True
+
+    return not isinstance(steps, dict) or len(steps) == 0
+
+
+def is_complete_dialogue(conversation):
+    """ Check if a dialogue ran through, i.e. has Oracle answers and no API errors. """
+    if not conversation:
+        return False
+
+    contents = [m['content'] for m in conversation if isinstance(m.get('content'), str)]
+    if any(content.startswith('Error: Error code') for content in contents):
+        return False
+
+    return any(m['role'] == 'assistant' for m in conversation)
+
+
+def repair_summary(summary):
+    """ Try to turn a malformed summary into a JSON object of instructions.
+
+    Handles the most common ways in which LLMs break the requested format: text
+    around the JSON object, Python-style quotes, trailing commas, and plain numbered
+    lists instead of JSON.
+
+    Returns:
+        The repaired summary as a JSON string, or None if it cannot be repaired.
+    """
+    if not isinstance(summary, str) or summary.startswith('Error: Error code'):
+        return None
+
+    steps = parse_steps(summary)
+    if steps is None:
+        start, end = summary.find('{'), summary.rfind('}')
+        if start != -1 and end > start:
+            candidate = re.sub(r',\s*([}\]])', r'\1', summary[start:end + 1])
+            try:
+                steps = json.loads(candidate)
+            except json.JSONDecodeError:
+                try:
+                    steps = ast.literal_eval(candidate)
+                except (ValueError, SyntaxError):
+                    steps = None
+            if isinstance(steps, dict) and len(steps) > 0:
+                steps = [str(step) for step in steps.values()]
+            else:
+                steps = None
+
+    if steps is None:
+        # Numbered list, e.g. "1. Go to the kitchen"
+        steps = re.findall(r'^\s*\d+[.)]\s+(.+?)\s*$', summary, flags=re.MULTILINE)
+
+    if len(steps) == 0:
+        return None
+
+    return json.dumps({str(i + 1): step for i, step in enumerate(steps)})
@@ -0,0 +1,45 @@
+import logging
+import re
+from functools import lru_cache
+
+
+class ApproximateEncoding:
+    """ Offline stand-in for a tiktoken encoding.
+
+    Splits the text like the pre-tokenizer of cl100k_base (words with their leading
+    space, runs of up to three digits, punctuation and whitespace) and counts each
+    piece as one token. Common words are single tokens in cl100k_base, so this is
+    close for the English text and object names of the prompts, and undercounts
+    rare long words.
+    """
+
+    PATTERN = re.compile(r"'(?:s|t|re|ve|m|ll|d)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+|_")
+
+    def encode(self, text, **kwargs):
+        return self.PATTERN.findall(text)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name='cl100k_base'):
+    """ Get a tiktoken encoding, or an `ApproximateEncoding` if it cannot be loaded.
+
+    tiktoken downloads the encodings on their first use, so it is not available
+    offline (or when tiktoken is not installed). Pass `name=None` to always use the
+    approximate counter.
+    """
+    if name is None:
+        return ApproximateEncoding()
+
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        logging.warning(f"Could not load the tiktoken encoding {name} ({type(e).__name__}: {e}). "
+                        f"Token counts are approximate.")
+        return ApproximateEncoding()
+
+
+def count_tokens(text, encoding='cl100k_base'):
+    """ Count the number of tokens in a text with a tiktoken encoding (see `get_encoding`). """
+    return len(get_encoding(encoding).encode(text, disallowed_special=()))
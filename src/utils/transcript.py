@@ -0,0 +1,82 @@
+import json
+
+from .tokens import count_tokens
+
+
+def parse_steps(text):
+    """ Parse a JSON object of numbered instructions into a list of steps.
+
+    The JSON object may be surrounded by other text. Returns None if the text does
+    not contain such an object.
+    """
+    if not isinstance(text, str):
+        return None
+
+    start, end = text.find('{'), text.rfind('}')
+    if start == -1 or end < start:
+        return None
+
+    try:
+        steps = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+
+    if not isinstance(steps, dict) or len(steps) == 0:
+        return None
+
+    return [step if isinstance(step, str) else json.dumps(step) for step in steps.values()]
+
+
+def format_steps(steps):
+    return '\n'.join(f"{i + 1}. {step}" for i, step in enumerate(steps))
+
+
+def encode_transcript(history, scenario):
+    """ Encode a dialogue history compactly for the summarizer.
+
+    The system prompt and the opening request (which contains the serialized scene
+    graph) are dropped, the scenario is stated once, and JSON instruction lists are
+    collapsed to numbered lines.
+
+    Args:
+        history: List of messages in the dialogue, as recorded by the generator.
+        scenario: The scenario the dialogue is about.
+
+    Returns:
+        The encoded transcript.
+    """
+    lines = [f"Task: {scenario}"]
+    opening_skipped = False
+    for message in history:
+        role = message['role']
+        content = message['content']
+        if role == 'system':
+            continue
+        if role == 'user' and not opening_skipped:
+            opening_skipped = True
+            continue
+
+        if role == 'assistant':
+            steps = parse_steps(content)
+            if steps is not None:
+                content = format_steps(steps)
+            lines.append(f"Oracle:\n{content}")
+        else:
+            lines.append(f"Robot: {content.strip()}")
+
+    return '\n\n'.join(lines)
+
+
+def summarizer_prompt(history, scenario):
+    """ Build the prompt asking the summarizer to summarize a dialogue. """
+    transcript = encode_transcript(history, scenario)
+    prompt = f"Here is the conversation history:\n\n{transcript}\n\n"
+    prompt += "Keeping in mind the task, summarize the conversation. Final instructions should be arranged logically and have all the necessary steps without any irrelevant information or redundant steps."
+    return prompt
+
+
+def transcript_savings(history, scenario):
+    """ Number of tokens of the full JSON history and of the encoded transcript. """
+    full_tokens = count_tokens(json.dumps(history))
+    compact_tokens = count_tokens(encode_transcript(history, scenario))
+    return full_tokens, compact_tokens
@@ -0,0 +1,46 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from utils.checkpoint import CheckpointLog  # noqa: E402
+
+
+def make_log(tmp_path):
+    return CheckpointLog(str(tmp_path / 'out.json'), key=lambda record: record['k'], compact_every=0)
+
+
+def test_append_after_torn_tail(tmp_path):
+    log = make_log(tmp_path)
+    log.load()
+    log.append({'k': 1, 'v': 'a'})
+    log._log_file.close()
+
+    # Simulate a crash in the middle of writing the second record
+    with open(log.log_path, 'a') as f:
+        f.write('{"k": 2, "v')
+
+    log = make_log(tmp_path)
+    assert [record['k'] for record in log.load()] == [1]
+    log.append({'k': 3, 'v': 'c'})
+    log._log_file.close()
+
+    with open(log.log_path, 'r') as f:
+        lines = f.read().splitlines()
+    assert [json.loads(line)['k'] for line in lines] == [1, 3]
+    assert [record['k'] for record in make_log(tmp_path).load()] == [1, 3]
+
+
+def test_torn_tail_without_complete_lines(tmp_path):
+    log_path = tmp_path / 'out.jsonl'
+    log_path.write_text('{"k": 1')
+    CheckpointLog.truncate_torn_tail(str(log_path))
+    assert log_path.read_text() == ''
+
+
+def test_complete_log_is_kept(tmp_path):
+    log_path = tmp_path / 'out.jsonl'
+    log_path.write_text('{"k": 1}\n{"k": 2}\n')
+    CheckpointLog.truncate_torn_tail(str(log_path))
+    assert log_path.read_text() == '{"k": 1}\n{"k": 2}\n'